@@ -0,0 +1,46 @@
+"""
+Compression of recorded command output before it is sent to the LLM.
+
+Every file in benchmarks/corpus is the raw stdout+stderr of a real command
+(pip installs, a wget progress bar, coloured `ls`, `cat` of a .pyc, Python
+tracebacks, gcc warnings, ...). Each is split into lines the way AsyncShell
+splits them, compressed, and reported with its compression ratio.
+
+    python benchmarks/output_compression.py [-v]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from output_compressor import compress_output
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def main():
+    verbose = "-v" in sys.argv[1:]
+    total_in = total_out = 0
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        with open(os.path.join(CORPUS_DIR, name), "rb") as f:
+            lines = f.read().decode(errors="replace").split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+
+        start = time.perf_counter()
+        compressed = compress_output([("stdout", line) for line in lines])
+        elapsed = time.perf_counter() - start
+
+        total_in += compressed.original_chars
+        total_out += compressed.compressed_chars
+        print(f"{name:>32}: {len(lines):>6} lines, {compressed.original_chars:>7} -> {compressed.compressed_chars:>6} chars "
+              f"({compressed.ratio:5.1f}x) in {elapsed * 1000:6.1f} ms")
+        if verbose:
+            print("\n".join(f"    {entry.text}" for entry in compressed.entries))
+
+    print(f"{'total':>32}: {total_in} -> {total_out} chars ({total_in / max(total_out, 1):.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
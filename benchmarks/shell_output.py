@@ -0,0 +1,74 @@
+"""
+Throughput of the shell output pipeline, in lines per second.
+
+Runs commands that print a lot of output through an AsyncShell: once without
+an output callback, once with a callback that logs every batch to a file the
+way Brain._drain_shell does, and once also recording into an OutputStore as
+leased shells do.
+
+    python benchmarks/shell_output.py [lines]
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from shell import AsyncShell
+from output_store import OutputStore
+
+COMMANDS = {
+    "short lines": "seq 1 {n}",
+    "long lines": "yes 'the quick brown fox jumps over the lazy dog, again and again and again' | head -n {n}",
+}
+
+
+async def measure(command, lines, callback=None, store=False):
+    shell = AsyncShell()
+    await shell.start()
+    shell.set_output_callback(callback)
+    if store:
+        shell.output_store = OutputStore()
+    start = time.monotonic()
+    result = await shell.run(command.format(n=lines), timeout=600)
+    elapsed = time.monotonic() - start
+    await shell.stop()
+    if store:
+        shell.output_store.close()
+    assert result.exit_code == 0, result
+    return lines / elapsed
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    log_file = tempfile.NamedTemporaryFile(suffix=".log", delete=False)
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.FileHandler(log_file.name))
+    logger.propagate = False
+    calls = []
+
+    def log_batch(batch, skipped):
+        calls.append(len(batch) + skipped)
+        logger.debug(f"Brain received {len(batch) + skipped} lines from shell ({skipped} not passed on)")
+
+    for name, command in COMMANDS.items():
+        raw = asyncio.run(measure(command, lines))
+        calls.clear()
+        logged = asyncio.run(measure(command, lines, log_batch))
+        callbacks = len(calls)
+        stored = asyncio.run(measure(command, lines, log_batch, store=True))
+        print(f"{name:>12}: {raw:>12,.0f} lines/s without callback, "
+              f"{logged:>12,.0f} lines/s with logging callback ({callbacks} callbacks), "
+              f"{stored:>12,.0f} lines/s with callback and output store")
+
+    print(f"log file: {os.path.getsize(log_file.name):,} bytes")
+    os.remove(log_file.name)
+
+
+if __name__ == "__main__":
+    main()
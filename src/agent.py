@@ -1,48 +1,153 @@
-import os
-# from mistralai import Mistral
-from openai import OpenAI 
-import discord
-import asyncio
+import re
+import threading
+from collections import deque
+
+from langchain_core.messages import HumanMessage, SystemMessage
 
-OPENAI_MODEL = "gpt-4o"
 SYSTEM_PROMPT = "Your task is to translate english to bash commands. Respond in a single bash command that can be run directly in the shell, don't use any formatting and respond in plaintext"
 
+# Requests this short that ask to look something up are answered with a single command
+SIMPLE_TASK_MAX_WORDS = 15
+# Only questions and read-only lookups count; "find", "get" and "check" are
+# left out since they as often start requests that change things ("get rid of").
+SIMPLE_TASK_START_RE = re.compile(
+    r"^(?:please\s+)?(?:what|what's|whats|which|who|where|how\s+(?:much|many|big|long|old)|is|are|does|do|show|list|print|"
+    r"display|count|tell\s+me|give\s+me)\b",
+    re.IGNORECASE,
+)
+# Anything that joins clauses or changes something goes through the full agent graph
+COMPOUND_TASK_RE = re.compile(r"\b(?:and|then|after|afterwards|finally|also|plus|but|or)\b|[,;&|>`$\n]", re.IGNORECASE)
+MUTATING_TASK_RE = re.compile(
+    r"\b(?:rm|remove|delete|del|erase|wipe|purge|prune|clean|clear|empty|truncate|overwrite|get\s+rid|kill|pkill|stop|"
+    r"terminate|restart|reboot|shutdown|shut\s+down|start|launch|run|execute|install|uninstall|upgrade|update|build|"
+    r"create|make|touch|mkdir|write|edit|modify|change|set|reset|rename|move|mv|copy|cp|chmod|chown|mount|unmount|"
+    r"enable|disable|download|clone|fetch|pull|push|commit|deploy|train|fix|debug|implement|setup|set\s+up|format|"
+    r"free\s+up|compress|extract|unzip|save|send|steps?|script|plot|analy[sz]e|compare)\b",
+    re.IGNORECASE,
+)
+# Commands the single-shot path may run: read-only programs, with no redirection or chaining
+READ_ONLY_COMMANDS = {
+    "ls", "cat", "head", "tail", "wc", "grep", "egrep", "du", "df", "free", "ps", "uptime", "uname", "whoami", "id",
+    "pwd", "date", "hostname", "nproc", "lscpu", "lsblk", "nvidia-smi", "which", "whereis", "printenv", "echo",
+    "stat", "file", "tree", "sort", "uniq", "cut", "column", "awk", "lsof", "ss", "netstat", "find", "basename",
+    "dirname", "realpath", "python", "python3", "pip", "pip3", "nvcc", "gcc", "git", "docker",
+}
+# Options that make one of them write, delete or run other programs
+MUTATING_OPTIONS = {
+    "find": {"-delete", "-exec", "-execdir", "-ok", "-okdir", "-fprint", "-fprint0", "-fprintf", "-fls"},
+    "sort": {"-o", "--output"},
+    "tree": {"-o"},
+    "awk": {"-i", "--include"},
+    "git": {"--output", "-o", "--ext-diff"},
+}
+# Programs that are only read-only with one of these as their first argument
+READ_ONLY_SUBCOMMANDS = {
+    "pip": {"list", "show", "freeze", "--version", "-V"},
+    "pip3": {"list", "show", "freeze", "--version", "-V"},
+    "python": {"--version", "-V"},
+    "python3": {"--version", "-V"},
+    "nvcc": {"--version", "-V"},
+    "gcc": {"--version"},
+    "git": {"status", "log", "diff", "show", "--version"},
+    "docker": {"ps", "images", "version", "info", "--version"},
+}
+CODE_FENCE_RE = re.compile(r"^```[\w-]*\n?|\n?```$")
+LATENCY_SAMPLES = 200       # Recent task latencies kept per path for the metrics
+
+
+def is_simple_task(task):
+    """
+    Whether a request is trivial enough for the single-shot path: a short
+    question or lookup, like "what's my disk usage", that one read-only
+    command answers. Requests that join several clauses or change anything
+    go through the full agent graph.
+    """
+    task = task.strip()
+    if len(task.split()) > SIMPLE_TASK_MAX_WORDS:
+        return False
+    if not SIMPLE_TASK_START_RE.match(task):
+        return False
+    return not COMPOUND_TASK_RE.search(task) and not MUTATING_TASK_RE.search(task)
+
+
+def _is_mutating_option(program, arg):
+    """Whether `arg` is one of MUTATING_OPTIONS, also with its value attached (`--output=x`, `-ox`)"""
+    for option in MUTATING_OPTIONS.get(program, ()):
+        if arg.split("=", 1)[0] == option:
+            return True
+        # A one-letter option takes its value straight after it
+        if len(option) == 2 and arg.startswith(option):
+            return True
+    return False
+
+
+def is_read_only_command(command):
+    """
+    Whether a command the single-shot path got back only reads: one program
+    from READ_ONLY_COMMANDS, or a pipe of them, with no redirection, command
+    substitution or chaining, and no options that make it write.
+    """
+    command = command.strip()
+    if not command or "\n" in command or re.search(r"[;&<>`]|\$\(", command):
+        return False
+    for part in command.split("|"):
+        words = part.split()
+        if not words or words[0] not in READ_ONLY_COMMANDS:
+            return False
+        program, args = words[0], words[1:]
+        if program in READ_ONLY_SUBCOMMANDS and (not args or args[0] not in READ_ONLY_SUBCOMMANDS[program]):
+            return False
+        if any(_is_mutating_option(program, arg) for arg in args):
+            return False
+        if program == "awk" and "system" in part:
+            return False
+    return True
+
 
 class MistralAgent:
-    def __init__(self):
-        # MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
-        # self.client = Mistral(api_key=MISTRAL_API_KEY)
-        OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")  # Update env variable
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
-
-    async def run_async(self, message: discord.Message):
-        # The simplest form of an agent
-        # Send the message's content to Mistral's API and return Mistral's response
-
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": message.content},
-        ]
-
-        response = await self.client.chat.complete_async(
-            model=MISTRAL_MODEL,
-            messages=messages,
-        )
-
-        return response.choices[0].message.content
-
-    def run(self, message: str):
-        # The simplest form of an agent
-        # Send the message's content to Mistral's API and return Mistral's response
-
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": message},
-        ]
-
-        response = self.client.chat.complete(
-            model=MISTRAL_MODEL,
-            messages=messages,
-        )
-
-        return response.choices[0].message.content
\ No newline at end of file
+    """
+    The simplest form of an agent: one LLM call that turns a request into a
+    single bash command. Uses a chat model shared with the Brains (see
+    brain.AgentModels), so its calls go through the same LLMScheduler.
+    """
+    def __init__(self, llm):
+        self.llm = llm
+
+    def _messages(self, message):
+        content = getattr(message, "content", message)  # A discord.Message or plain text
+        return [SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content=content)]
+
+    @staticmethod
+    def _command(response):
+        return CODE_FENCE_RE.sub("", response.content.strip()).strip()
+
+    async def run_async(self, message):
+        return self._command(await self.llm.ainvoke(self._messages(message)))
+
+    def run(self, message):
+        return self._command(self.llm.invoke(self._messages(message)))
+
+
+_latencies = {"single_shot": deque(maxlen=LATENCY_SAMPLES), "graph": deque(maxlen=LATENCY_SAMPLES)}
+_task_counts = {"single_shot": 0, "graph": 0}
+_latencies_lock = threading.Lock()
+
+
+def record_task_latency(path, seconds):
+    """Record how long a task took on the "single_shot" or "graph" path"""
+    with _latencies_lock:
+        _latencies[path].append(seconds)
+        _task_counts[path] += 1
+
+
+def get_path_stats():
+    with _latencies_lock:
+        stats = {}
+        for path, samples in _latencies.items():
+            times = sorted(samples)
+            stats[path] = {
+                "tasks": _task_counts[path],
+                "avg": round(sum(times) / len(times), 1) if times else 0.0,
+                "p95": round(times[int(len(times) * 0.95)], 1) if times else 0.0,
+            }
+        return stats
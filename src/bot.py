@@ -12,12 +12,23 @@ import time
 import asyncio
 import random
 
-from shell import InteractiveShell
-from brain import Brain
+from brain import Brain, set_checkpointer
+from checkpoints import open_checkpointer, TaskRecords
+from llm_scheduler import PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from task_queue import TaskQueue, TaskQueueFull
+from shell_pool import ShellPool, ShellPoolExhausted
+from brain_worker import BrainWorkerPool
+import llm_scheduler
+import agent
+import streaming
+import model_router
+import retry_policy
+import llm_cache
 from gui import discord_gui
 
 
 PREFIX = "!"
+OUTPUT_PAGE_LINES = 50  # Lines !output shows when no last line is given
 
 import certifi
 os.environ["SSL_CERT_FILE"] = certifi.where()
@@ -39,8 +50,8 @@ bot.remove_command('help')
 
 discord_gui.setup(bot)
 
-# Import the Mistral agent from the agent.py file
-# agent = MistralAgent()
+# Trivial !agent requests are answered by agent.py's single-shot MistralAgent
+# inside each task's Brain; the rest go through the full agent graph
 
 
 # Get the token from the environment variables
@@ -53,9 +64,28 @@ bot.brain = brain
 # bot.allowed_user_ids = ALLOWED_USER_IDS
 
 active_brains = {}  # Dictionary to track active brain instances by thread ID
+bot.active_brains = active_brains
+
+# Admission control for !agent: tasks beyond the concurrency caps wait in this queue
+task_queue = TaskQueue()
+queued_tasks = {}   # Thread ID -> TaskTicket of tasks still waiting to start
+task_tickets = {}   # Thread ID -> TaskTicket of tasks that have started
+
+# Graph checkpoints and the list of unfinished tasks, kept across restarts
+task_records = TaskRecords()
+checkpointer = None
+
+# Warm bash shells shared by !agent tasks and !gui sessions
+shell_pool = ShellPool()
+bot.shell_pool = shell_pool
 
 default_model = "mistral-large-latest"
 
+# With BRAIN_WORKERS > 0, !agent tasks run in that many worker processes instead of in the bot's
+brain_workers = int(os.getenv("BRAIN_WORKERS", "0"))
+worker_pool = BrainWorkerPool(brain_workers) if brain_workers > 0 else None
+bot.worker_pool = worker_pool
+
 # Create a function to send a shutdown message
 async def send_shutdown_message():
     """Send a message when the bot is shutting down"""
@@ -77,10 +107,20 @@ async def on_ready():
     https://discordpy.readthedocs.io/en/latest/api.html#discord.on_ready
     """
     logger.info(f"{bot.user} has connected to Discord!")
+    global checkpointer
+    first_ready = checkpointer is None  # on_ready fires again on reconnects
+    if first_ready:
+        checkpointer = await open_checkpointer()
+        set_checkpointer(checkpointer)
+    await shell_pool.start()
+    if worker_pool is not None:
+        await worker_pool.start()
     brain.discord_loop = asyncio.get_running_loop()
     channel = bot.get_channel(1339738567177670748)
     brain.channel = channel
     brain.start()
+    if first_ready:
+        await resume_agent_tasks()
     
 
 @bot.command()
@@ -135,6 +175,17 @@ async def ping(ctx, *, arg=None):
 async def debug_state(ctx):
     # Create a readable summary of the current state
     state_summary = brain.get_debug_info()
+    state_summary += "\n\n=== SHELL POOL ===\n" + "\n".join(f"{k}: {v}" for k, v in shell_pool.get_stats().items())
+    if worker_pool is not None:
+        state_summary += "\n\n=== BRAIN WORKERS ===\n" + "\n".join(f"{k}: {v}" for k, v in (await worker_pool.get_stats()).items())
+    state_summary += "\n\n=== TASK QUEUE ===\n" + "\n".join(f"{k}: {v}" for k, v in task_queue.get_stats().items())
+    state_summary += "\n\n=== TASK PATHS (seconds) ===\n" + "\n".join(f"{k}: {v}" for k, v in agent.get_path_stats().items())
+    state_summary += "\n\n=== FIRST OUTPUT (seconds) ===\n" + "\n".join(f"{k}: {v}" for k, v in streaming.get_first_output_stats().items())
+    state_summary += "\n\n=== MODEL ROUTES (seconds) ===\n" + "\n".join(f"{k}: {v}" for k, v in model_router.get_route_stats().items())
+    state_summary += "\n\n=== LLM RETRIES ===\n" + "\n".join(f"{k}: {v}" for k, v in retry_policy.get_retry_stats().items())
+    state_summary += "\n\n=== LLM CACHE ===\n" + "\n".join(f"{k}: {v}" for k, v in llm_cache.get_response_cache().get_stats().items())
+    for model, stats in llm_scheduler.get_all_stats().items():
+        state_summary += f"\n\n=== LLM SCHEDULER ({model}) ===\n" + "\n".join(f"{k}: {v}" for k, v in stats.items())
     
     # Split into chunks if needed (Discord has 2000 character limit)
     chunks = [state_summary[i:i+1900] for i in range(0, len(state_summary), 1900)]
@@ -142,11 +193,43 @@ async def debug_state(ctx):
     for chunk in chunks:
         await ctx.send(f"```\n{chunk}\n```")
 
+def _queue_position_message(position):
+    return f"⏳ **Queued** - position {position} in line. The task will start when a slot frees up."
+
+async def stop_task_brain(thread_id):
+    """Shut down a thread's task and free its shell and queue slot. Returns False if it had no task."""
+    ticket = queued_tasks.pop(thread_id, None)
+    if ticket is not None:
+        task_queue.cancel(ticket)
+        task_records.finish(thread_id)
+        return True
+    thread_brain = active_brains.pop(thread_id, None)
+    if thread_brain is None:
+        return False
+    await thread_brain.shutdown()
+    if thread_brain.shell is not None:  # Tasks in brain workers release their shell there
+        await shell_pool.release(thread_brain.shell)
+    ticket = task_tickets.pop(thread_id, None)
+    if ticket is not None:
+        task_queue.release(ticket)
+    task_records.finish(thread_id)
+    if checkpointer is not None:
+        await checkpointer.adelete_thread(str(thread_id))  # Killed tasks aren't resumed
+    return True
+
+bot.stop_task_brain = stop_task_brain
+
 @bot.command(name="agent", help="Run an AI agent task in a new thread")
 async def agent_command(ctx, *, task=None):
     """Execute a task using the AI agent in a dedicated thread"""
 
         
+    # `!agent --background <task>` queues the task behind interactive ones
+    priority = PRIORITY_INTERACTIVE
+    if task and task.startswith("--background"):
+        priority = PRIORITY_BACKGROUND
+        task = task[len("--background"):].strip()
+
     # Make sure a task was provided
     if not task:
         await ctx.send("Please provide a task for the agent to execute. For example: `!agent Build a sentiment analysis tool`")
@@ -162,14 +245,88 @@ async def agent_command(ctx, *, task=None):
         await ctx.send("🛑! agent can only be run as a new process in the channel. Please exit the thread and go back to the channel")
         return
     
-    # Create a new Brain instance specifically for this task
-    task_brain = Brain()
+    global default_model
+    await run_agent_task(task_thread, task, ctx.author.id, priority, default_model, ack=ctx.send)
+
+async def run_agent_task(task_thread, task, user_id, priority, model, ack=None):
+    """
+    Queue a task for its thread and run it once admitted. `ack` is called
+    with short notes for the channel the task was started from.
+    """
+    # Recorded until it finishes, so the task can be resumed if the bot restarts
+    task_records.add(task_thread.id, task, model, priority, user_id)
+
+    # Wait for a free slot if too many tasks are running
+    try:
+        ticket = task_queue.submit(user_id, priority)
+    except TaskQueueFull:
+        task_records.finish(task_thread.id)
+        await task_thread.send("🚦 **Too many tasks are waiting right now.** Please try again in a few minutes.")
+        return
+    if not ticket.admitted.is_set():
+        queue_msg = await task_thread.send(_queue_position_message(ticket.position))
+
+        async def show_position(position):
+            try:
+                await queue_msg.edit(content=_queue_position_message(position))
+            except discord.HTTPException:
+                pass
+        ticket.on_position = show_position
+        queued_tasks[task_thread.id] = ticket
+        if ack is not None:
+            await ack(f"Task queued in thread: {task_thread.mention}")
+        try:
+            admitted = await task_queue.wait(ticket)
+        finally:
+            queued_tasks.pop(task_thread.id, None)
+        if not admitted:
+            return  # Cancelled with !kill while waiting
+        await queue_msg.edit(content="▶️ **Your turn - starting the task.**")
+    task_tickets[task_thread.id] = ticket
+
+    # The task gives up its slot and its shell once it's done, even if the thread stays open,
+    # so the tasks admitted in its place don't wait for shells
+    def task_done():
+        task_queue.release(ticket)
+        task_records.finish(task_thread.id)
+        shell = task_brain.detach_shell() if task_brain is not None else None
+        if shell is not None:
+            asyncio.create_task(shell_pool.release(shell))
+
+    task_brain = None
+
+    if worker_pool is not None:
+        # The task runs in a worker process, which posts its messages back to the thread
+        await task_thread.send(f"🧠 **Processing Task**:\n> {task}")
+        try:
+            task_brain = await worker_pool.start_task(task_thread, task, model, priority)
+        except RuntimeError as e:
+            task_tickets.pop(task_thread.id, None)
+            task_done()
+            await task_thread.send(f"❌ **Error:** {e}")
+            return
+        task_brain.on_task_done = task_done
+        active_brains[task_thread.id] = task_brain
+        if ack is not None:
+            await ack(f"Task started in thread: {task_thread.mention}")
+        return
+
+    # Create a new Brain instance specifically for this task, on a warm shell.
+    # Its checkpoints are keyed by the thread, so a restarted task picks up where it left off.
+    try:
+        shell = await shell_pool.lease()
+    except ShellPoolExhausted as e:
+        task_tickets.pop(task_thread.id, None)
+        task_done()
+        await task_thread.send(f"❌ **Error:** {e}. Please try again in a few minutes.")
+        return
+    task_brain = Brain(shell=shell, priority=priority, task_id=task_thread.id, shell_pool=shell_pool)
+    task_brain.on_task_done = task_done
     
     # Set up the new brain
     task_brain.discord_loop = asyncio.get_running_loop()
     task_brain.channel = task_thread  # Set the channel directly to the thread
-    global default_model
-    task_brain.start(default_model=default_model)
+    task_brain.start(default_model=model)
     
     # Store this brain in our active_brains dictionary
     active_brains[task_thread.id] = task_brain
@@ -181,7 +338,22 @@ async def agent_command(ctx, *, task=None):
     task_brain.submit_msg(task, message_obj=thread_msg)
     
     # Acknowledge in the original channel
-    await ctx.send(f"Task started in thread: {task_thread.mention}")
+    if ack is not None:
+        await ack(f"Task started in thread: {task_thread.mention}")
+
+async def resume_agent_tasks():
+    """Reattach the tasks that were still running or queued when the bot last stopped"""
+    for thread_id, task, model, priority, user_id in task_records.unfinished():
+        try:
+            task_thread = bot.get_channel(thread_id) or await bot.fetch_channel(thread_id)
+        except discord.HTTPException:
+            task_thread = None
+        if task_thread is None or getattr(task_thread, "archived", False):
+            task_records.finish(thread_id)
+            continue
+        logger.info(f"Resuming agent task in thread {thread_id}")
+        await task_thread.send("🔌 **The bot restarted** - picking this task back up.")
+        asyncio.create_task(run_agent_task(task_thread, task, user_id, priority, model))
 
 @bot.command(name="kill", help="Stop the current agent task")
 async def kill_command(ctx):
@@ -193,27 +365,72 @@ async def kill_command(ctx):
     
     thread_id = ctx.channel.id
     
+    # A task still waiting for a slot just leaves the queue
+    if thread_id in queued_tasks:
+        await stop_task_brain(thread_id)
+        await ctx.send("✅ **Task removed from the queue**")
     # Check if this thread has an active brain
-    if thread_id in active_brains:
-        # Get the brain
-        thread_brain = active_brains[thread_id]
-        
+    elif thread_id in active_brains:
         # Send feedback message
         await ctx.send("🛑 **Terminating task...**")
         
-        # Shutdown the brain
-        success = thread_brain.shutdown()
-        
-        # Remove from active brains
-        if success:
-            del active_brains[thread_id]
+        # Shutdown the brain, releasing its shell and queue slot
+        if await stop_task_brain(thread_id):
             await ctx.send("✅ **Task terminated successfully**")
         else:
             await ctx.send("⚠️ **Error terminating task**")
     else:
         await ctx.send("No active task found in this thread.")
 
-@bot.command(name="toggle", help="Toggle between GPT 4o and Mistral models.")
+@bot.command(name="cancel", help="Cancel the command the agent is currently running")
+async def cancel_command(ctx):
+    """Interrupt the running shell command of this thread's task, keeping the task alive"""
+    if not isinstance(ctx.channel, discord.Thread):
+        await ctx.send("This command can only be used within a task thread.")
+        return
+
+    thread_brain = active_brains.get(ctx.channel.id)
+    if thread_brain is None:
+        await ctx.send("No active task found in this thread.")
+        return
+
+    if await thread_brain.cancel_command():
+        await ctx.send("⏹️ **Cancelling the running command...** The agent will continue with the next step.")
+    else:
+        await ctx.send("No command is running right now.")
+
+@bot.command(name="output", help="Show lines of a command's full output, e.g. !output 12 5000 5100")
+async def output_command(ctx, command_id: int = None, start: int = 1, end: int = None):
+    """Read a range of a task command's output back from its shell's output store"""
+    if not isinstance(ctx.channel, discord.Thread):
+        await ctx.send("This command can only be used within a task thread.")
+        return
+
+    thread_brain = active_brains.get(ctx.channel.id)
+    if thread_brain is None:
+        await ctx.send("No active task found in this thread.")
+        return
+
+    if end is None:
+        end = start + OUTPUT_PAGE_LINES - 1
+    # Without a command id, the task's latest command is shown
+    found = await thread_brain.read_output(command_id, max(start, 1) - 1, end)
+    if found is None:
+        if command_id is None:
+            await ctx.send("No command output recorded yet.")
+        else:
+            await ctx.send(f"No output recorded for command {command_id}.")
+        return
+
+    info, lines = found
+    header = f"**Command {info.command_id}:** `{info.command.strip()[:100]}` (lines {start}-{min(end, info.num_lines)} of {info.num_lines})"
+    body = "\n".join(line for _, line in lines) or "(no output in this range)"
+    chunks = [body[i:i+1900] for i in range(0, len(body), 1900)]
+    await ctx.send(header)
+    for chunk in chunks:
+        await ctx.send(f"```\n{chunk}\n```")
+
+@bot.command(name="toggle", help="Toggle the preferred provider between OpenAI and Mistral models.")
 async def toggle_command(ctx):
     global default_model
     if default_model == "mistral-large-latest":
@@ -221,7 +438,13 @@ async def toggle_command(ctx):
     else:
         default_model = "mistral-large-latest"
     
-    await ctx.send(f"Model toggled to {default_model}")
+    # Each node runs on its own model of the preferred provider (see model_router)
+    provider = model_router.provider_of(default_model)
+    routes = ", ".join(
+        f"{route}: {models[provider]}" for route, models in
+        ((route, model_router.TIER_MODELS[tier]) for route, tier in model_router.ROUTE_TIERS.items())
+    )
+    await ctx.send(f"Preferred provider toggled to {provider} ({routes})")
 
 @bot.command(name="help", help="Show detailed help information about all commands")
 async def help_command(ctx):
@@ -253,6 +476,8 @@ async def help_command(ctx):
             "• Breaks down the task into steps\n"
             "• Executes commands automatically\n"
             "• Provides progress updates and summary\n"
+            "• Waits in line when the bot is busy\n"
+            "• `--background` lets other tasks go first\n"
             "```"
         ),
         inline=False
@@ -318,14 +543,44 @@ async def help_command(ctx):
         inline=False
     )
 
+    embed.add_field(
+        name="⏹️ !cancel",
+        value=(
+            "Cancel the command the agent is running\n"
+            "> `!cancel`\n"
+            "```\n"
+            "• Interrupts a hung or slow command\n"
+            "• The task and its shell keep going\n"
+            "• Only available in task threads\n"
+            "```"
+        ),
+        inline=False
+    )
+
+    embed.add_field(
+        name="📜 !output",
+        value=(
+            "Page through the full output of the task's commands\n"
+            "> `!output [command] [first line] [last line]`\n"
+            "```\n"
+            "• Defaults to the latest command\n"
+            f"• Shows {OUTPUT_PAGE_LINES} lines unless a last line is given\n"
+            "• Only available in task threads\n"
+            "```"
+        ),
+        inline=False
+    )
+
     embed.add_field(
         name="🔄 !toggle",
         value=(
-            "Toggle between GPT 4o and Mistral models\n"
+            "Toggle the preferred provider between OpenAI and Mistral models\n"
             "> `!toggle`\n"
             "```\n"
             "• Mistral is faster but less intelligent (default).\n"
-            "• GPT 4o is slower but more intelligent.\n"
+            "• OpenAI (GPT 4o) is slower but more intelligent.\n"
+            "• Planning uses the large model, commands the small one.\n"
+            "• Calls fail over to the other provider when one is throttled.\n"
             "```"
         ),
         inline=False
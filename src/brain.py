@@ -1,8 +1,10 @@
+import re
+import shlex
 import threading
 import time
-import queue
-from shell import InteractiveShell
 import asyncio
+import uuid
+from collections import deque
 from datetime import datetime
 
 from typing import Annotated
@@ -15,7 +17,6 @@ from langchain_core.messages import AIMessage, HumanMessage
 
 from langchain_mistralai import ChatMistralAI
 from langchain_openai import ChatOpenAI
-from langchain_core.rate_limiters import InMemoryRateLimiter
 
 import logging
 
@@ -24,8 +25,40 @@ from prompts import *
 import os
 
 from Logging import LoggingCallbackHandler
+from output_compressor import compress_output, clean_line
+from shell_pool import ShellPoolExhausted
+from llm_scheduler import get_scheduler, estimate_tokens, PRIORITY_INTERACTIVE
+from agent import MistralAgent, is_simple_task, is_read_only_command, record_task_latency
+from context_builder import build_context
+from streaming import LiveMessage, astream_structured, record_first_output
+from model_router import MODEL_PROVIDERS, provider_of, route_models, record_call
+from llm_cache import CACHED_NODES, get_response_cache
+from retry_policy import RATE_LIMITED, FATAL, BREAKER_WAIT_MAX, classify_error, retry_after, retry_delay, get_breaker, record_retry
 
-CONTEXT_WINDOW = 25
+PROGRESS_UPDATES_KEPT = 25  # recent progress updates kept for !debug and progress reports
+COMMAND_TIMEOUT = 300  # seconds a single agent command may run before it's interrupted
+COMMAND_IDLE_TIMEOUT = 120  # seconds a command may go without printing anything
+SHELL_PROGRESS_INTERVAL = 2  # seconds between progress updates sampled from shell output
+OUTPUT_PREVIEW_HEAD = 20  # first lines of a command's output shown to the LLM
+OUTPUT_PREVIEW_TAIL = 20  # last lines of a command's output shown to the LLM
+OUTPUT_PREVIEW_LINE_CHARS = 300  # longer lines are cut short in previews
+OUTPUT_TAIL_WINDOW = 1000  # lines read back from the store to build the tail of a truncated result
+OUTPUT_REQUEST_MAX_LINES = 100  # lines returned for one output request
+OUTPUT_READS_PER_STEP = 3  # output requests in a row before the agent has to move on
+REPLAN_EVERY_STEPS = 5  # successful commands in a row before the plan is reviewed anyway
+MAX_PARALLEL_STEPS = 4  # independent plan steps run at the same time, each in its own shell
+SINGLE_SHOT_OUTPUT_CHARS = 3000  # output of a single-shot command posted to Discord
+STEP_LOG_OUTPUT_LINES = 10  # last lines of each command's output kept in the step log
+STEP_LOG_OUTPUT_CHARS = 800
+SUMMARY_LOG_ENTRIES = 30  # newest step log entries in the running summary
+TEMPLATE_SUMMARY_MAX_COMMANDS = 3  # tasks this short are summarised from the step log without an LLM call
+# Output that means a command went wrong even though it exited 0, so the plan needs another look
+UNEXPECTED_OUTPUT_RE = re.compile(
+    r"Traceback \(most recent call last\)|command not found|No such file or directory|Permission denied"
+    r"|\b(?:error|fatal|failed|cannot)\b",
+    re.IGNORECASE,
+)
+PLAN_LINE_RE = re.compile(r"^\s*(?:\*\*)?(\d+)[.)]\s*(?:\*\*)?\s*(.+)$")
 
 class State(TypedDict):
     # Messages have the type "list". The `add_messages` function
@@ -34,29 +67,250 @@ class State(TypedDict):
     messages: Annotated[list, add_messages]
     plan: Annotated[list, add_messages]
     done: bool
+    output_reads: int  # output requests made since the last command ran
+    # The plan as a list of {"description", "status", "depends_on"} dicts, status being "pending",
+    # "done" or "failed" and depends_on the 1-based numbers of the steps it waits for (None: the previous one)
+    steps: list
+    steps_since_replan: int  # commands that moved the plan on without replanning
+    replan_reason: str  # why execution wants the plan reviewed, or None to carry on with the next step
+    # One {"step", "command", "exit_code", "ok", "output"} dict per command run, the basis of the running summary
+    step_log: list
+
+def parse_plan_steps(plan):
+    """The numbered steps of a plan written as text, for models that leave the structured list empty"""
+    steps = []
+    for line in plan.splitlines():
+        match = PLAN_LINE_RE.match(line)
+        if match:
+            steps.append({"description": match.group(2).strip(), "status": "pending", "depends_on": None})
+    return steps
+
+def plan_steps(response_steps):
+    """Plan step dicts from the PlanSteps of a planning or replanning response"""
+    return [
+        {
+            "description": step.description,
+            "status": "done" if step.finished else "pending",
+            "depends_on": step.depends_on,
+        }
+        for step in response_steps
+    ]
+
+def ready_steps(steps):
+    """Indexes of the unfinished steps whose dependencies are all finished, in order"""
+    ready = []
+    for i, step in enumerate(steps):
+        if step["status"] == "done":
+            continue
+        depends_on = step.get("depends_on")
+        if depends_on is None:
+            depends_on = [i] if i else []   # Just the previous step (numbered from 1)
+        if all(not 1 <= n <= len(steps) or steps[n - 1]["status"] == "done" for n in depends_on):
+            ready.append(i)
+    return ready
+
+def format_plan_steps(steps, current=None):
+    """The structured plan as text for a prompt, marking each step's status"""
+    lines = ["Plan steps:"]
+    for i, step in enumerate(steps):
+        status = "current" if i == current else step["status"]
+        line = f"{i + 1}. [{status}] {step['description']}"
+        depends_on = step.get("depends_on")
+        if depends_on is not None:
+            line += f" (after {', '.join(map(str, depends_on))})" if depends_on else " (no dependencies)"
+        lines.append(line)
+    return "\n".join(lines)
+
+def format_step_log(step_log, max_entries=SUMMARY_LOG_ENTRIES):
+    """
+    The running summary of a task: one line per command run, with its plan
+    step, outcome and last line of output. Rendered from the step log as it
+    grows, so it costs no LLM call.
+    """
+    if not step_log:
+        return "Progress so far: no commands have run yet."
+    lines = ["Progress so far:"]
+    if len(step_log) > max_entries:
+        ok = sum(entry["ok"] for entry in step_log[:-max_entries])
+        lines.append(f"- {len(step_log) - max_entries} earlier commands ({ok} succeeded)")
+    for entry in step_log[-max_entries:]:
+        step = f"step {entry['step']}: " if entry["step"] else ""
+        outcome = "ok" if entry["ok"] else f"failed (exit code {entry['exit_code']})"
+        last_line = entry["output"].rsplit("\n", 1)[-1][:120]
+        lines.append(f"- {step}`{entry['command'][:120]}` -> {outcome}" + (f": {last_line}" if last_line else ""))
+    return "\n".join(lines)
+
+class AgentModels:
+    """
+    The chat model client for one model and its structured-output wrappers.
+    Built once per model and shared by every Brain, so tasks reuse the
+    client's HTTP connections instead of opening their own.
+    """
+    def __init__(self, model):
+        self.name = model
+        # One scheduler per model for the whole process, so all tasks share the provider's limits
+        self.scheduler = get_scheduler(model)
+
+        if MODEL_PROVIDERS.get(model) == "mistral":
+            self.llm = ChatMistralAI(model=model, rate_limiter=self.scheduler, callbacks=[self.scheduler.usage_handler])
+        elif MODEL_PROVIDERS.get(model) == "openai":
+            self.llm = ChatOpenAI(model=model, rate_limiter=self.scheduler, callbacks=[self.scheduler.usage_handler])
+        else:
+            raise ValueError(f"Invalid model: {model}")
+
+        # self.llm = ChatOpenAI(model="gpt-4o", rate_limiter=self.scheduler)
+        # self.llm = ChatMistralAI(model="codestral-latest", rate_limiter=self.scheduler)
+
+        self.execution_llm = self.llm.with_structured_output(ExecutionFormatter)
+        # Planning, replanning and the summary are made as plain tool calls, so their
+        # output can be shown while it streams in (see streaming.py)
+        self.planning_stream_llm = self.llm.bind_tools([PlanningFormatter], tool_choice="any")
+        self.replanning_stream_llm = self.llm.bind_tools([ReplanningFormatter], tool_choice="any")
+        self.summarize_stream_llm = self.llm.bind_tools([SummarizeFormatter], tool_choice="any")
+
+_agent_models = {}
+_agent_graph = None
+_checkpointer = None
+_agent_lock = threading.Lock()
+
+def get_agent_models(model):
+    """The shared AgentModels for `model`, created on first use"""
+    with _agent_lock:
+        if model not in _agent_models:
+            _agent_models[model] = AgentModels(model)
+        return _agent_models[model]
+
+def _task_brain(config):
+    """The Brain a graph run belongs to"""
+    return config["configurable"]["brain"]
+
+async def _planning_node(state: State, config):
+    return await _task_brain(config)._planning(state)
+
+async def _execution_node(state: State, config):
+    return await _task_brain(config)._execution(state)
+
+async def _replanning_node(state: State, config):
+    return await _task_brain(config)._replanning(state)
+
+async def _summarize_node(state: State, config):
+    return await _task_brain(config)._summarize(state)
+
+def build_agent_graph():
+    """
+    Build the agent's graph. It's the same for every task: each node looks up
+    the Brain it runs for in the run config (`config["configurable"]["brain"]`,
+    which carries the task's shell, Discord thread, models and logger) and
+    calls the matching method, so the graph is compiled once per process.
+    """
+    graph_builder = StateGraph(State)
+    graph_builder.add_node("planning", _planning_node)
+    graph_builder.add_node("execution", _execution_node)
+    graph_builder.add_node("replanning", _replanning_node)
+    graph_builder.add_node("summarize", _summarize_node)
+
+    graph_builder.add_edge(START, "planning")
+
+    graph_builder.add_edge("planning", "execution")
+    graph_builder.add_conditional_edges(
+        "execution",
+        lambda state, config: _task_brain(config)._route_execution(state),
+        {"execution": "execution", "replanning": "replanning"}
+    )
+    graph_builder.add_conditional_edges(
+        "replanning",
+        lambda state, config: _task_brain(config)._route_tools(state),
+        {"summarize": "summarize", "execution": "execution"}
+    )
+    graph_builder.add_edge("summarize", END)
+
+    return graph_builder.compile(checkpointer=_checkpointer)
+
+def set_checkpointer(checkpointer):
+    """
+    Save the agent graph's state with `checkpointer` (see checkpoints.py)
+    after every node, so runs can be resumed. Must be called before the
+    graph is first used.
+    """
+    global _checkpointer
+    with _agent_lock:
+        assert _agent_graph is None, "The agent graph was already compiled without a checkpointer"
+        _checkpointer = checkpointer
+
+def get_agent_graph():
+    """The compiled agent graph, built on first use"""
+    global _agent_graph
+    with _agent_lock:
+        if _agent_graph is None:
+            _agent_graph = build_agent_graph()
+        return _agent_graph
 
 class Brain:
-    def __init__(self):
+    def __init__(self, shell=None, priority=PRIORITY_INTERACTIVE, task_id=None, shell_pool=None):
         self.channel = None
         self.discord_loop = None
         self.active_thread = None  # Store reference to active thread
         self.original_message = None  # Store the original message object
         
-        self.incoming_msg_buffer = queue.Queue()        # thread safe
-        self.shell_out_buffer = queue.Queue()           # thread safe
+        self.incoming_msg_buffer = asyncio.Queue()
+        # The brain runs as tasks on the discord loop: one working through
+        # submitted messages and one sending periodic progress updates
+        self.main_task = None
+        self.progress_task = None
+        self.background_tasks = set()   # Fire-and-forget tasks, referenced so they aren't collected
+        self.on_task_done = None        # Optional callback run each time a submitted task finishes
 
         # Progress tracking
         self.current_state = "idle"
-        self.progress_updates = []
+        self.progress_updates = deque(maxlen=PROGRESS_UPDATES_KEPT)
         self.last_progress_time = None
         self.progress_update_interval = 30  # send progress updates every 30 seconds for long-running tasks
 
         self.logger = self._setup_logger()
         self.logging_handler = LoggingCallbackHandler(self.logger)
         
-        self.shell = InteractiveShell()
-        self.shell.set_output_callback(self._drain_shell)
-        self.shell.start()   
+        # Shell leased from the ShellPool by whoever created this brain; it is
+        # returned to the pool by them as well, so the brain never stops it
+        self.shell = shell
+        if self.shell:
+            self.shell.set_output_callback(self._drain_shell)
+        self.output_store = None    # The shell's OutputStore, kept by `detach_shell` for !output
+        # Pool to lease extra shells from for plan steps that run in parallel (None to run them one by one)
+        self.shell_pool = shell_pool
+        self.branch_shells = set()
+        # Shell output seen by `_drain_shell`, for the current command and in total
+        self.command_output_lines = 0
+        self.shell_lines_received = 0
+        self.shell_lines_skipped = 0    # Lines the shell's OutputBatcher didn't pass on
+        self.last_shell_progress = 0.0
+        # Characters of command output before and after compression, for !debug
+        self.output_chars_raw = 0
+        self.output_chars_compressed = 0
+        self.last_compression_ratio = 1.0
+        # LLM round trips and wall time of the current task, and totals for !debug
+        self.task_started = None
+        self.task_llm_calls = 0
+        self.task_replans_skipped = 0
+        self.task_parallel_saved = 0.0   # Seconds saved by running independent steps at the same time
+        self.task_first_output = None    # Seconds until the first streamed response was visible in Discord
+        self.task_retries = 0            # LLM calls retried after a rate limit or transient error
+        self.task_cache_hits = 0         # LLM calls answered from the response cache
+        self.last_task_report = None
+        self.total_llm_calls = 0
+        self.total_replans_skipped = 0
+        self.total_parallel_saved = 0.0
+        self.max_prompt_tokens = 0  # Largest estimated prompt sent, bounded by context_builder's budget
+        # Priority of this brain's LLM calls in the model's shared LLMScheduler
+        self.priority = priority
+        self.scheduler = None
+        # Identifies the task in the scheduler and in graph checkpoints; the
+        # bot uses the task's Discord thread id so it can resume it after a restart
+        self.task_id = task_id if task_id is not None else uuid.uuid4().hex
+        # Shared model clients and graph, set by start()
+        self.models = None
+        self.graph = None
+        self.models_used = set()   # Models this brain's calls were routed to (see model_router)
+        self.response_cache = None
         self._shutdown_flag = False
     
     def _setup_logger(self):
@@ -131,248 +385,885 @@ class Brain:
         return logger
     
     def start(self, default_model="mistral-large-latest"):
-        self.graph_builder = StateGraph(State)
-        self.rate_limiter = InMemoryRateLimiter(
-            requests_per_second=0.1,  # <-- Super slow! We can only make a request once every 10 seconds!!
-            check_every_n_seconds=0.1,  # Wake up every 100 ms to check whether allowed to make a request,
-            max_bucket_size=10,  # Controls the maximum burst size.
-        )
-
+        if self.main_task is not None and not self.main_task.done():
+            return  # Already running (on_ready fires again on reconnects)
         self.base_model_type = default_model
+        # The model clients and the compiled graph are shared by every Brain;
+        # the graph reaches this brain through the run config (see build_agent_graph)
+        self.models = get_agent_models(self.base_model_type)
+        self.scheduler = self.models.scheduler
+        self.graph = get_agent_graph()
+        # Responses to prompts seen before, shared by every Brain (see llm_cache)
+        self.response_cache = get_response_cache()
+
+        # Must be called from the discord loop, which the brain's tasks run on
+        self.discord_loop = asyncio.get_running_loop()
+        self.main_task = asyncio.create_task(self._brain_main())
+        self.progress_task = asyncio.create_task(self._progress_loop())
+
+    def _route_execution(self, state: State):
+        if state["done"]:
+            return "replanning"
+        # Let the model read more of an earlier command's output before moving on
+        reads = state.get("output_reads", 0)
+        if reads:
+            return "execution" if reads < OUTPUT_READS_PER_STEP else "replanning"
+        # A command that went as planned moves straight on to the next step
+        if state.get("steps") and state.get("replan_reason") is None:
+            return "execution"
+        return "replanning"
 
-        if self.base_model_type == "mistral-large-latest":
-            self.llm = ChatMistralAI(model=self.base_model_type, rate_limiter=self.rate_limiter)
-        elif self.base_model_type == "gpt-4o":
-            self.llm = ChatOpenAI(model=self.base_model_type, rate_limiter=self.rate_limiter)
+    def _route_tools(self, state: State):
+        if state["done"]:
+            self._add_state_transition("routing", "Task complete, moving to summarization")
+            return "summarize"
+        else: 
+            self._add_state_transition("routing", "Continuing execution")
+            return "execution"
+
+    async def _planning(self, state: State) -> State:
+        self._start_background(self._show_thinking(5))
+        self._add_state_transition("planning", "Started planning phase")
+        self.logger.info("Starting planning phase")
+        prompt = state["messages"][-1].content + planning_prompt
+        render = lambda args: "\n\n📋 **Initial Plan:**\n" + args["plan"] + "\n" if args.get("plan") else None
+        response, live = await self._stream_structured(
+            "planning", lambda models: models.planning_stream_llm, PlanningFormatter, prompt, render
+        )
+        self.logger.debug(f"Planning response: {response.plan}")
+
+        if 'PLAN MARKED UNSAFE' in response.plan:
+            plan_message = "This agent command is unsafe. Please try another command."
         else:
-            raise ValueError(f"Invalid model: {self.base_model_type}")
+            plan_message = render({"plan": response.plan})
+        await self._finish_streamed(live, plan_message)
 
-        # self.base_model_type = "mistral-large-latest"
-        # self.base_model_type = "gpt-4o"
-        # self.llm = ChatOpenAI(model=self.base_model_type, rate_limiter=self.rate_limiter)
-        # self.base_model_type = "codestral-latest"
-        # self.llm = ChatMistralAI(model=self.base_model_type, rate_limiter=self.rate_limiter)
+        self._add_progress_update("Planning phase complete")
+        steps = plan_steps(response.steps) or parse_plan_steps(response.plan)
+        return {
+            "messages": [AIMessage(content=response.plan)],
+            "done": False,
+            "steps": steps,
+            "steps_since_replan": 0,
+            "replan_reason": None
+        }
 
-        self.planning_llm = self.llm.with_structured_output(PlanningFormatter)
-        self.execution_llm = self.llm.with_structured_output(ExecutionFormatter)
-        self.replanning_llm = self.llm.with_structured_output(ReplanningFormatter)
-        self.summarize_llm = self.llm.with_structured_output(SummarizeFormatter)
-
-        def route_tools(state: State):
-            if state["done"]:
-                self._add_state_transition("routing", "Task complete, moving to summarization")
-                return "summarize"
-            else: 
-                self._add_state_transition("routing", "Continuing execution")
-                return "execution"
-
-        def planning(state: State) -> State:
-            if self.discord_loop:
-                asyncio.run_coroutine_threadsafe(self._show_thinking(5), self.discord_loop)
-            self._add_state_transition("planning", "Started planning phase")
-            self.logger.info("Starting planning phase")
-            def planning_call():
-                return self.planning_llm.invoke(state["messages"][-1].content + planning_prompt)
-            
-            response = self.retry_with_exponential_backoff(planning_call)
-            self.logger.debug(f"Planning response: {response.plan}")
+    async def _execution(self, state: State):
+        self._start_background(self._show_thinking(5))
+        self._add_state_transition("execution", "Executing next command")
 
-            if 'PLAN MARKED UNSAFE' in response:
-                plan_message = "This agent command is unsafe. Please try another command."
-            else:
-                plan_message = "\n\n📋 **Initial Plan:**\n" + response.plan + "\n"
-            # Create thread for the first message
-            self.send_discord_msg(plan_message)
-            
-            self._add_progress_update("Planning phase complete")
+        steps = [dict(step) for step in state.get("steps") or []]
+        # Steps that don't depend on each other run at the same time in separate shells
+        ready = ready_steps(steps)
+        if len(ready) > 1 and self.shell_pool is not None and not state.get("output_reads"):
+            return await self._parallel_execution(state, steps, ready[:MAX_PARALLEL_STEPS])
+
+        current = next((i for i, step in enumerate(steps) if step["status"] != "done"), None)
+        plan = format_plan_steps(steps, current) if steps else None
+        messages = build_context(state["messages"], execution_prompt, plan, summary=format_step_log(state.get("step_log")))
+        async def execution_call(models):
+            self._count_llm_call()
+            return await models.execution_llm.ainvoke(messages)
+
+        response = await self._cached_call("execution", ExecutionFormatter, messages, execution_call)
+
+        if response.unsafe:
+            self.logger.info("[PLAN MARKED UNSAFE] {}")
+
+        # The model asked to see more of a previous command's output instead of running something
+        if response.output_request is not None and not response.command.strip() and not response.batch:
+            request = response.output_request
+            header, output = self._read_command_output(request)
+            self.logger.info(f"[OUTPUT REQUESTED] {header}")
+            self._add_progress_update(f"Reading output: {header}")
+            await self.send_discord_msg(f"\n\n🔎 **Reading Output:** {header}")
             return {
-                "messages": state["messages"] + [planning_prompt, AIMessage(content=response.plan)],
-                "done": False
+                "messages": [AIMessage(content=f"Read output: {request.model_dump_json(exclude_none=True)}"), HumanMessage(content=output)],
+                "done": False,
+                "output_reads": state.get("output_reads", 0) + 1,
+                "replan_reason": "the agent read back earlier output instead of running a command"
             }
-            
-        def execution(state: State):    
-            if self.discord_loop:
-                asyncio.run_coroutine_threadsafe(self._show_thinking(5), self.discord_loop)
-            self._add_state_transition("execution", "Executing next command")
-
-            messages = state["messages"][-CONTEXT_WINDOW:] + [HumanMessage(content=execution_prompt)] 
-            def execution_call():
-                return self.execution_llm.invoke(messages)
-            
-            response = self.retry_with_exponential_backoff(execution_call)
-            
-            if response.unsafe:
-                self.logger.info("[PLAN MARKED UNSAFE] {}")
-            
-            # Log the command being executed
-            self.logger.info(f"[COMMAND EXECUTED] {response.command}")
-            self._add_progress_update(f"Executing: {response.command}")
-            
-            # Send command execution message to Discord
-            command_message = f"\n\n⚙️ **Executing Command:**\n```bash\n{response.command}\n```"
-            self.send_discord_msg(command_message)
-            
-            self.shell.execute_command(response.command)
 
-            cur_shell_outputs = []
+        batch = self._response_batch(response)
+        commands = "\n".join(c.command for c in batch)
 
-            # TODO: we need something more robust than waiting
-            self._add_progress_update("Waiting for command output...")
-            time.sleep(1)
-            while not self.shell_out_buffer.empty():
-                cur_shell_outputs.append(self.shell_out_buffer.get())
-            
-            tool_content_string = f"Shell output: \n {'\n'.join(cur_shell_outputs)}"
-            tool_output = HumanMessage(content=tool_content_string)
-            self._add_progress_update("Received command output")
-
-            # TODO: when will we see this error string? is this a linux thing?
-            if "[ERROR]" in tool_content_string:
-                self._add_state_transition("error", "Command execution failed")
-                self.send_discord_msg("❌ **Error:**\n" + tool_content_string)
-                return {
-                    "messages": messages,
-                    "done": True
-                }
+        # Log the commands being executed
+        self.logger.info(f"[COMMAND EXECUTED] {commands}")
+        self._add_progress_update(f"Executing: {commands}")
+
+        # Send command execution message to Discord
+        title = "Executing Command" if len(batch) == 1 else f"Executing {len(batch)} Commands"
+        command_message = f"\n\n⚙️ **{title}:**\n```bash\n{commands}\n```"
+        await self.send_discord_msg(command_message)
+
+        self._add_progress_update("Waiting for command output...")
+        self.command_output_lines = 0
+        results = await self.shell.run_batch(
+            [(c.command, c.stop_on_failure) for c in batch], timeout=COMMAND_TIMEOUT, idle_timeout=COMMAND_IDLE_TIMEOUT
+        )
 
+        if len(batch) == 1:
+            tool_content_string = self._format_command_result(results[0])
+        else:
+            parts = []
+            for i, c in enumerate(batch):
+                if i < len(results):
+                    parts.append(f"Command {i + 1}/{len(batch)}: `{c.command}`\n{self._format_command_result(results[i])}")
+                else:
+                    parts.append(f"Command {i + 1}/{len(batch)}: `{c.command}` was not run because command {len(results)} failed")
+            tool_content_string = "\n\n".join(parts)
+        tool_output = HumanMessage(content=tool_content_string)
+        last = results[-1]
+        self._add_progress_update(
+            f"Received output of {len(results)}/{len(batch)} commands (last exit code {last.exit_code}, "
+            f"{sum(r.duration for r in results):.1f}s, {self.command_output_lines} lines, "
+            f"compressed {self.last_compression_ratio:.1f}x)"
+        )
+
+        # The shell itself failed (not the command), so there's nothing left to run commands in
+        if last.error:
+            self._add_state_transition("error", "Command execution failed")
+            await self.send_discord_msg("❌ **Error:**\n" + tool_content_string)
             return {
-                "messages": messages + [execution_prompt, AIMessage(content=response.command), tool_output],
-                "done": False
+                "done": True
             }
 
-        def replanning(state: State):
-            if self.discord_loop:
-                asyncio.run_coroutine_threadsafe(self._show_thinking(5), self.discord_loop)
-            self._add_state_transition("replanning", "Analyzing results and updating plan")
-            # wrap in SystemPrompt
-            messages = state["messages"][-CONTEXT_WINDOW:] + [HumanMessage(content="PLAN: " + replanning_prompt)]
-            def replanning_call():
-                return self.replanning_llm.invoke(messages)
-            
-            response = self.retry_with_exponential_backoff(replanning_call)
+        # Only go back to the LLM for a new plan when something didn't go as planned.
+        # Failures of commands the model said could fail (stop_on_failure off) don't count.
+        steps_since_replan = state.get("steps_since_replan", 0) + len(results)
+        reason = None
+        finished = []
+        step_log = list(state.get("step_log") or [])
+        for i, (c, result) in enumerate(zip(batch, results)):
+            step_log.append(self._step_log_entry(current, c.command, result))
+            if reason is not None:
+                continue
+            reason = self._replan_reason(result, allow_failure=not c.stop_on_failure)
+            if reason is not None:
+                if len(batch) > 1:
+                    reason = f"command {i + 1} of the batch failed: {reason}"
+                if current is not None:
+                    steps[current]["status"] = "failed"
+                continue
+            if c.finishes_step and current is not None:
+                steps[current]["status"] = "done"
+                finished.append(current)
+                current = next((j for j, step in enumerate(steps) if step["status"] != "done"), None)
+        reason = await self._check_replan(steps, finished, reason, steps_since_replan)
+
+        return {
+            "messages": [AIMessage(content=commands), tool_output],
+            "done": False,
+            "output_reads": 0,
+            "steps": steps,
+            "step_log": step_log,
+            "steps_since_replan": steps_since_replan,
+            "replan_reason": reason
+        }
+
+    def _step_log_entry(self, step, command, result):
+        """A step log entry for a command run for plan step `step` (an index, or None)"""
+        output = compress_output(result.lines[-STEP_LOG_OUTPUT_LINES * 4:]).text.strip()
+        output = "\n".join(output.splitlines()[-STEP_LOG_OUTPUT_LINES:])[-STEP_LOG_OUTPUT_CHARS:]
+        return {
+            "step": step + 1 if step is not None else None,
+            "command": command,
+            "exit_code": result.exit_code,
+            "ok": result.ok and not result.cancelled,
+            "output": output,
+        }
+
+    def _response_batch(self, response):
+        """The commands an execution response asks for; a single command is a batch of one"""
+        batch = [c for c in response.batch if c.command.strip()]
+        if not batch:
+            batch = [BatchCommand(command=response.command, stop_on_failure=True, finishes_step=response.finishes_step)]
+        return batch
+
+    async def _check_replan(self, steps, finished, reason, steps_since_replan):
+        """
+        Decide whether the plan needs another look after commands ran, given
+        the reason a command result gave (if any). Announces the steps that
+        were finished when it doesn't.
+        """
+        if reason is None:
+            if not steps:
+                reason = "there is no step-by-step plan to follow"
+            elif all(step["status"] == "done" for step in steps):
+                reason = "every step of the plan is finished"
+            elif steps_since_replan >= REPLAN_EVERY_STEPS:
+                reason = f"{steps_since_replan} commands ran since the plan was last reviewed"
+
+        if reason is None:
+            self.task_replans_skipped += 1
+            self.total_replans_skipped += 1
+            if finished:
+                self._add_progress_update(f"Step {finished[-1] + 1} done, moving on without replanning")
+                await self.send_discord_msg("\n\n" + "\n".join(
+                    f"✅ **Step {i + 1}/{len(steps)} done:** {steps[i]['description']}" for i in finished
+                ))
+        else:
+            self.logger.info(f"Replanning because {reason}")
+        return reason
+
+    async def _parallel_execution(self, state: State, steps, ready):
+        """
+        Carry out several independent plan steps at once. The execution LLM
+        is asked for each step's commands separately, then each step runs in
+        its own shell: the first in the task's shell, the others in shells
+        leased from the ShellPool, started in the same working directory.
+        Their results are merged into one message and into the plan.
+        """
+        numbers = ", ".join(str(i + 1) for i in ready)
+        self._add_progress_update(f"Running steps {numbers} in parallel")
+
+        async def plan_branch(i):
+            others = ", ".join(str(j + 1) for j in ready if j != i)
+            plan = (
+                format_plan_steps(steps, i)
+                + f"\nSteps {others} are being carried out at the same time in other shells. "
+                + f"Only carry out step {i + 1}, and don't read the output of earlier commands."
+            )
+            messages = build_context(state["messages"], execution_prompt, plan, summary=format_step_log(state.get("step_log")))
+            async def execution_call(models):
+                self._count_llm_call()
+                return await models.execution_llm.ainvoke(messages)
+            return await self._cached_call("execution", ExecutionFormatter, messages, execution_call)
+
+        responses = await asyncio.gather(*[plan_branch(i) for i in ready])
+        batches = [self._response_batch(response) for response in responses]
+        branches = [(i, batch) for i, batch in zip(ready, batches) if any(c.command.strip() for c in batch)]
+        if not branches:
+            return {"replan_reason": "the agent had no commands to run for the next steps", "output_reads": 0}
+
+        # The first branch runs in the task's own shell; the others get a shell each, in the same directory.
+        # When the pool is out of shells, the branches without one wait for a later round instead.
+        cwd = self.shell.cwd()
+        shells = [self.shell]
+        try:
+            for _ in branches[1:]:
+                try:
+                    shell = await self.shell_pool.lease(timeout=0)
+                except ShellPoolExhausted:
+                    break
+                shell.set_output_callback(self._drain_shell)
+                self.branch_shells.add(shell)
+                shells.append(shell)
+                if cwd:
+                    await shell.run(f"cd {shlex.quote(cwd)}")
+            branches = branches[:len(shells)]
+            numbers = ", ".join(str(i + 1) for i, _ in branches)
+            await self.send_discord_msg("\n\n⚙️ **Running steps in parallel:**\n" + "\n".join(
+                f"**Step {i + 1}:**\n```bash\n" + "\n".join(c.command for c in batch) + "\n```" for i, batch in branches
+            ))
+
+            self.command_output_lines = 0
+            started = time.monotonic()
+            results = await asyncio.gather(*[
+                shell.run_batch([(c.command, c.stop_on_failure) for c in batch], timeout=COMMAND_TIMEOUT, idle_timeout=COMMAND_IDLE_TIMEOUT)
+                for shell, (_, batch) in zip(shells, branches)
+            ])
+            elapsed = time.monotonic() - started
+
+            # Keep every branch's output in the task's OutputStore, so the model can read it back later
+            for shell, branch_results in zip(shells[1:], results[1:]):
+                for result in branch_results:
+                    self._adopt_output(shell.output_store, result)
+        finally:
+            for shell in shells[1:]:
+                self.branch_shells.discard(shell)
+                await self.shell_pool.release(shell)
+
+        # How long the same commands would have taken one after another
+        sequential = sum(result.duration for branch_results in results for result in branch_results)
+        self.task_parallel_saved += max(sequential - elapsed, 0.0)
+        self.total_parallel_saved += max(sequential - elapsed, 0.0)
+        self.logger.info(
+            f"Ran steps {numbers} in parallel in {elapsed:.1f}s, {sequential:.1f}s one after another "
+            f"({sequential / max(elapsed, 0.001):.1f}x)"
+        )
+
+        # Merge the branches back into the plan
+        parts = []
+        finished = []
+        reason = None
+        commands_run = 0
+        step_log = list(state.get("step_log") or [])
+        for (i, batch), branch_results in zip(branches, results):
+            step_log += [self._step_log_entry(i, c.command, result) for c, result in zip(batch, branch_results)]
+            branch_reason = None
+            for c, result in zip(batch, branch_results):
+                branch_reason = self._replan_reason(result, allow_failure=not c.stop_on_failure)
+                if branch_reason is not None:
+                    break
+            if branch_results[-1].error:
+                branch_reason = branch_reason or branch_results[-1].error
+            commands_run += len(branch_results)
+            if branch_reason is not None:
+                steps[i]["status"] = "failed"
+                reason = reason or f"step {i + 1} failed: {branch_reason}"
+            elif any(c.finishes_step for c in batch):
+                steps[i]["status"] = "done"
+                finished.append(i)
+
+            outputs = []
+            for n, c in enumerate(batch):
+                if n < len(branch_results):
+                    outputs.append(f"`{c.command}`\n{self._format_command_result(branch_results[n])}")
+                else:
+                    outputs.append(f"`{c.command}` was not run because an earlier command failed")
+            parts.append(f"Step {i + 1} ({steps[i]['description']}):\n" + "\n\n".join(outputs))
+
+        self._add_progress_update(f"Steps {numbers} ran in parallel in {elapsed:.1f}s ({sequential:.1f}s of commands)")
+        steps_since_replan = state.get("steps_since_replan", 0) + commands_run
+        reason = await self._check_replan(steps, finished, reason, steps_since_replan)
+        commands = "\n".join(f"# step {i + 1}\n" + "\n".join(c.command for c in batch) for i, batch in branches)
+        return {
+            "messages": [AIMessage(content=commands), HumanMessage(content="\n\n".join(parts))],
+            "done": False,
+            "output_reads": 0,
+            "step_log": step_log,
+            "steps": steps,
+            "steps_since_replan": steps_since_replan,
+            "replan_reason": reason
+        }
+
+    def _adopt_output(self, branch_store, result):
+        """Copy a command's output from a branch shell's OutputStore into the task shell's"""
+        store = self.shell.output_store
+        if store is None:
+            return
+        lines = branch_store.read_lines(result.command_id) if branch_store and result.command_id else result.lines
+        result.command_id = store.begin_command(result.command)
+        for stream, line in lines:
+            store.append(stream, [line])
+        store.end_command(result.exit_code)
+
+    def _replan_reason(self, result, allow_failure=False):
+        """
+        Why a command's result needs the plan reviewed, or None if it went as
+        expected. With `allow_failure` only an interrupted command counts.
+        """
+        if result.cancelled:
+            return f"the command was interrupted ({result.cancelled})"
+        if not result.finished:
+            return "the command did not finish"
+        if allow_failure:
+            return None
+        if result.exit_code != 0:
+            return f"the command exited with code {result.exit_code}"
+        for _, line in result.lines:
+            match = UNEXPECTED_OUTPUT_RE.search(line)
+            if match:
+                return f"its output contains `{match.group(0)}`"
+        return None
+
+    async def _replanning(self, state: State):
+        self._start_background(self._show_thinking(5))
+        self._add_state_transition("replanning", "Analyzing results and updating plan")
+        prompt = "PLAN: " + replanning_prompt
+        if state.get("replan_reason"):
+            prompt += f"\nReplanning because {state['replan_reason']}."
+        plan = format_plan_steps(state["steps"]) if state.get("steps") else None
+        messages = build_context(state["messages"], prompt, plan, summary=format_step_log(state.get("step_log")))
 
-            changes_message = (
+        def render(args):
+            if not args.get("explanation") and not args.get("new_plan"):
+                return None
+            return (
                 "\n\n---\n\n"
                 "# 🔄 **Progress Report**\n\n"
                 "## 📝 **Analysis & Reasoning:**\n"
-                f"{response.explanation}\n\n"
+                f"{args.get('explanation') or '…'}\n\n"
                 "## 📋 **Updated Execution Plan:**\n"
-                f"\n{response.new_plan}\n\n\n"
+                f"\n{args.get('new_plan') or '…'}\n\n\n"
             )
 
-            # Send to the thread - no need to create a new one
-            self.send_discord_msg(changes_message)
-            
-            if response.done:
-                self._add_progress_update("Task complete, preparing summary")
+        response, live = await self._stream_structured(
+            "replanning", lambda models: models.replanning_stream_llm, ReplanningFormatter, messages, render
+        )
+        await self._finish_streamed(live, render({"explanation": response.explanation, "new_plan": response.new_plan}))
+
+        if response.done:
+            self._add_progress_update("Task complete, preparing summary")
+        else:
+            self._add_progress_update("Plan updated, continuing execution")
+
+        steps = plan_steps(response.steps) or parse_plan_steps(response.new_plan)
+        return {
+            "messages": [AIMessage(content=response.new_plan)],
+            "done": response.done,
+            "output_reads": 0,
+            "steps": steps,
+            "steps_since_replan": 0,
+            "replan_reason": None
+        }
+
+    async def _summarize(self, state: State):
+        self._add_state_transition("summarizing", "Creating final task summary")
+        assert state["done"], "Task graph should be done"
+        self.logger.info("Starting summarization phase")
+        step_log = state.get("step_log") or []
+        render = lambda args: "📋 **Task Summary:**\n```\n" + args["summary"] + "\n```" if args.get("summary") else None
+        if len(step_log) <= TEMPLATE_SUMMARY_MAX_COMMANDS and all(entry["ok"] for entry in step_log):
+            # Short tasks are summarised from the step log, without an LLM call
+            summary = self._template_summary(step_log)
+            await self.send_discord_msg(render({"summary": summary}))
+        else:
+            # One small call on the running summary instead of the whole transcript
+            task = next((m.content for m in state["messages"] if isinstance(m, HumanMessage)), "")
+            last_output = step_log[-1]["output"] if step_log else ""
+            prompt = (
+                f"Objective: {task}\n\n{format_step_log(step_log)}\n\n"
+                f"Output of the last command:\n{last_output}\n{summarize_prompt}"
+            )
+            response, live = await self._stream_structured(
+                "summarize", lambda models: models.summarize_stream_llm, SummarizeFormatter, prompt, render
+            )
+            summary = response.summary
+            await self._finish_streamed(live, render({"summary": summary}))
+        self.logger.debug(f"Summarization response: {summary}")
+
+        # if response.done:
+        await self.send_discord_msg("🎉 **All done!** Task completed successfully.")
+        self._add_state_transition("idle", "Task completed successfully")
+
+        return {
+            "messages": [AIMessage(content=summary)],
+            "done": True
+        }
+
+    async def _stream_structured(self, node, pick_llm, schema, prompt, render):
+        """
+        Make the structured LLM call for `node`, on the model it's routed to
+        (`pick_llm(models)` picks the client from its AgentModels), showing its response in
+        Discord while it streams in: `render(args)` turns the arguments parsed
+        so far into the message text (or None while there's nothing to show),
+        and one message is edited as they grow. Returns the response and the
+        LiveMessage, which the caller finishes with _finish_streamed.
+        """
+        started = time.monotonic()
+        live = LiveMessage(await self._message_target(), self.logger, started=started)
+
+        async def on_partial(args):
+            text = render(args)
+            if text:
+                await live.update(text)
+
+        async def stream_call(models):
+            self._count_llm_call()
+            return await astream_structured(pick_llm(models), schema, prompt, on_partial)
+
+        response = await self._cached_call(node, schema, prompt, stream_call)
+        if live.first_visible is not None:
+            record_first_output(node, live.first_visible)
+            self.logger.info(f"First {node} output visible after {live.first_visible:.2f}s")
+            if self.task_first_output is None:
+                self.task_first_output = live.first_visible
+        return response, live
+
+    async def _cached_call(self, node, schema, prompt, func):
+        """
+        Make the LLM call for `node`, `func(models)` on the models the node is
+        routed to (see retry_with_exponential_backoff), through the response
+        cache when the node's responses are cached (see llm_cache.CACHED_NODES):
+        a `schema` response stored for the same prompt on the model the node
+        is routed to is returned without calling the provider. A response is
+        stored under the model that gave it, which is another provider's when
+        the call failed over.
+        """
+        if self.response_cache is None or node not in CACHED_NODES:
+            return await self.retry_with_exponential_backoff(func, prompt=prompt, route=node)
+        model = route_models(node, self.base_model_type)[0]
+        # SQLite blocks, so the cache is read and written off the event loop
+        response = await asyncio.to_thread(self.response_cache.get, node, model, prompt, schema)
+        if response is not None:
+            self.logger.info(f"Using cached {node} response from {model}")
+            self.task_cache_hits += 1
+            return response
+
+        answered_by = None
+        async def call(models):
+            nonlocal answered_by
+            result = await func(models)
+            answered_by = models.name
+            return result
+
+        response = await self.retry_with_exponential_backoff(call, prompt=prompt, route=node)
+        if response is not None and answered_by is not None:
+            await asyncio.to_thread(self.response_cache.put, node, answered_by, prompt, response)
+        return response
+
+    async def _finish_streamed(self, live, text):
+        """Replace a streamed message with the complete text, sending it in chunks if it's too long for one"""
+        self.logger.info(f"Brain sending message to discord: `{text}...`")
+        if not await live.finish(text):
+            await self._send_discord_msg(text)
+
+    def _template_summary(self, step_log):
+        """The summary of a short task, rendered from its step log"""
+        if not step_log:
+            return "No commands needed to be run."
+        parts = []
+        for entry in step_log:
+            parts.append(f"$ {entry['command']}")
+            if entry["output"]:
+                parts.append(entry["output"])
+        return "\n".join(parts)
+
+    def _format_command_result(self, result):
+        """
+        Render a CommandResult as the message the LLM sees after a command.
+        The output is compressed first (see output_compressor), then cut down
+        to its first and last lines if it's still long; the model can ask for
+        the rest from the shell's OutputStore (see `_read_command_output`).
+        """
+        store = self._output_store()
+        info = store.get_command(result.command_id) if store and result.command_id else None
+        label = f" (command {result.command_id})" if info else ""
+        compressed = compress_output(result.lines)
+        entries = compressed.entries
+
+        if len(entries) <= OUTPUT_PREVIEW_HEAD + OUTPUT_PREVIEW_TAIL and not result.truncated:
+            stdout = "\n".join(entry.text for entry in entries if entry.stream == "stdout")
+            stderr = "\n".join(entry.text for entry in entries if entry.stream == "stderr")
+            parts = [f"Shell output{label}: \n {stdout}"]
+            if stderr:
+                parts.append(f"Stderr:\n{stderr}")
+        else:
+            total = info.num_lines if info else len(result.lines)
+            head = entries[:OUTPUT_PREVIEW_HEAD]
+            if result.truncated and info:
+                # The result only kept the start of the output, so compress the end from the store
+                tail_start = max(total - OUTPUT_TAIL_WINDOW, head[-1].last_line)
+                tail = compress_output(store.read_lines(result.command_id, tail_start), first_line=tail_start + 1).entries
+                tail = tail[-OUTPUT_PREVIEW_TAIL:]
             else:
-                self._add_progress_update("Plan updated, continuing execution")
+                tail = entries[OUTPUT_PREVIEW_HEAD:][-OUTPUT_PREVIEW_TAIL:]
+            omitted_first = head[-1].last_line + 1
+            omitted_last = tail[0].first_line - 1 if tail else total
 
-            return {
-                "messages": messages + [HumanMessage(content="PLAN: " + replanning_prompt), AIMessage(content=response.new_plan)],
-                "done": response.done
-            }
-        
-        def summarize(state: State):
-            self._add_state_transition("summarizing", "Creating final task summary")
-            assert state["done"], "Task graph should be done"
-            self.logger.info("Starting summarization phase")
-            def summarize_call():
-                return self.summarize_llm.invoke("\n".join([state["messages"][i].content for i in range(len(state["messages"]))]) + summarize_prompt)
-            
-            response = self.retry_with_exponential_backoff(summarize_call)
-            self.logger.debug(f"Summarization response: {response.summary}")
+            parts = [f"Shell output{label}: {total} lines, showing the start and the end:"]
+            parts += [self._preview_line(entry.stream, entry.text) for entry in head]
+            if omitted_last >= omitted_first:
+                omitted = f"... lines {omitted_first}-{omitted_last} omitted"
+                if info:
+                    omitted += f"; request them from command {result.command_id} or search its output to see them"
+                parts.append(omitted + " ...")
+            parts += [self._preview_line(entry.stream, entry.text) for entry in tail]
+        if result.error:
+            parts.append(result.error)
+        if result.truncated:
+            note = f"[Output truncated: {result.stdout_bytes} bytes of stdout, {result.stderr_bytes} bytes of stderr in total"
+            if result.command_id is not None:
+                note += f"; the full output is kept as command {result.command_id}"
+            parts.append(note + "]")
+        if result.cancelled == "timeout":
+            parts.append(f"Command was interrupted after running for {COMMAND_TIMEOUT}s")
+        elif result.cancelled == "idle":
+            parts.append(f"Command was interrupted after printing nothing for {COMMAND_IDLE_TIMEOUT}s")
+        elif result.cancelled == "cancel":
+            parts.append("Command was cancelled by the user")
+        if result.finished:
+            parts.append(f"Exit code: {result.exit_code} (took {result.duration:.1f}s)")
+        message = "\n".join(parts)
 
-            summary_message = "📋 **Task Summary:**\n```\n" + response.summary + "\n```"
-            # Create thread for the first message
-            self.send_discord_msg(summary_message)
-            
-            # if response.done:
-            self.send_discord_msg("🎉 **All done!** Task completed successfully.")
-            self._add_state_transition("idle", "Task completed successfully")
+        self.last_compression_ratio = compressed.ratio
+        self.output_chars_raw += compressed.original_chars
+        self.output_chars_compressed += compressed.compressed_chars
+        self.logger.info(
+            f"Command output compressed from {compressed.original_chars} to {compressed.compressed_chars} chars "
+            f"({compressed.ratio:.1f}x), {len(message)} chars sent to the model"
+        )
+        return message
 
-            return {
-                "messages": state["messages"] + [summarize_prompt, AIMessage(content=response.summary)],
-                "done": True
-            }
+    def _preview_line(self, stream, line):
+        line = clean_line(line)
+        if len(line) > OUTPUT_PREVIEW_LINE_CHARS:
+            line = line[:OUTPUT_PREVIEW_LINE_CHARS] + f"... [{len(line) - OUTPUT_PREVIEW_LINE_CHARS} more chars]"
+        return f"[stderr] {line}" if stream == "stderr" else line
 
-        self.graph_builder.add_node("planning", planning)
-        self.graph_builder.add_node("execution", execution)
-        self.graph_builder.add_node("replanning", replanning)
-        self.graph_builder.add_node("summarize", summarize)
-        
-        self.graph_builder.add_edge(START, "planning")
+    def _read_command_output(self, request):
+        """Answer an OutputRequest from the model. Returns a short description and the text to send back."""
+        store = self._output_store()
+        info = store.get_command(request.command_id) if store else None
+        if info is None:
+            last = store.last_command() if store else None
+            known = f"commands are numbered 1 to {last.command_id}" if last else "no commands have run yet"
+            header = f"no stored output for command {request.command_id}"
+            return header, f"There is no stored output for command {request.command_id}; {known}."
 
-        self.graph_builder.add_edge("planning", "execution")
-        self.graph_builder.add_edge("execution", "replanning")
-        self.graph_builder.add_conditional_edges("replanning", route_tools, {"summarize": "summarize", "execution": "execution"})
-        self.graph_builder.add_edge("summarize", END)
+        if request.pattern:
+            matches, total = store.grep(request.command_id, request.pattern, max_matches=OUTPUT_REQUEST_MAX_LINES)
+            header = f"lines of command {request.command_id} matching `{request.pattern}` ({total} matches)"
+            lines = [f"{number + 1}: {self._preview_line(stream, line)}" for number, stream, line in matches]
+            if total > len(matches):
+                lines.append(f"... {total - len(matches)} more matches, use a narrower pattern or a line range")
+        else:
+            start = max(request.start_line or 1, 1)
+            end = min(request.end_line or info.num_lines, start + OUTPUT_REQUEST_MAX_LINES - 1, info.num_lines)
+            header = f"lines {start}-{end} of command {request.command_id} ({info.num_lines} lines in total)"
+            lines = [
+                f"{number}: {self._preview_line(stream, line)}"
+                for number, (stream, line) in enumerate(store.read_lines(request.command_id, start - 1, end), start)
+            ]
+        return header, f"Showing {header}, from `{info.command.strip()}`:\n" + ("\n".join(lines) or "(no lines)")
 
-        self.graph = self.graph_builder.compile()
+    def get_command_output(self, command_id, start=0, end=None):
+        """Lines `start` to `end` of a command's full output, read back from the shell's OutputStore"""
+        store = self._output_store()
+        if store is None:
+            return None
+        info = store.get_command(command_id)
+        if info is None:
+            return None
+        return info, store.read_lines(command_id, start, end)
 
-        # start a thread on brain_main
-        self.mthread = threading.Thread(target=self._brain_main)
-        self.mthread.start()
-        # self.agent = MistralAgent()
+    def _output_store(self):
+        return self.shell.output_store if self.shell else self.output_store
 
-    # should only be called by `self.shell` as a callback
-    def _drain_shell(self, line: str):
-        self.shell_out_buffer.put(line)
-        
-        self.logger.info(f"Brain received line from shell: `{line}`")
-        if self.current_state == "execution":
-            self._add_progress_update(f"Shell output: {line[:50]}{'...' if len(line) > 50 else ''}")
+    def detach_shell(self):
+        """
+        Let go of the task's shell once the task is done, for the owner to
+        return to the ShellPool. The shell's OutputStore stays with the brain,
+        so !output can still read the task's commands. Returns the shell, or
+        None if it was already detached.
+        """
+        shell, self.shell = self.shell, None
+        if shell is not None:
+            shell.set_output_callback(None)
+            self.output_store, shell.output_store = shell.output_store, None
+        return shell
+
+    async def cancel_command(self):
+        """Interrupt the commands the task is running. Returns False if none were running."""
+        cancelled = [await shell.cancel() for shell in list(self.branch_shells)]
+        if self.shell and await self.shell.cancel():
+            return True
+        return any(cancelled)
+
+    async def read_output(self, command_id=None, start=0, end=None):
+        """`get_command_output` for the bot's !output, defaulting to the latest command"""
+        if command_id is None:
+            store = self._output_store()
+            last = store.last_command() if store else None
+            if last is None:
+                return None
+            command_id = last.command_id
+        return self.get_command_output(command_id, start, end)
 
-    def __del__(self):
-        self.mthread.join()
-        self.shell.stop()
+    # should only be called by `self.shell` as a callback, with a batch of output lines
+    def _drain_shell(self, lines: list, skipped: int = 0):
+        count = len(lines) + skipped
+        self.command_output_lines += count
+        self.shell_lines_received += count
+        self.shell_lines_skipped += skipped
+        self.logger.debug(f"Brain received {count} lines from shell ({skipped} not passed on)")
+
+        # A sample of the output is enough to show the command is making progress
+        now = time.monotonic()
+        if self.current_state == "execution" and lines and now - self.last_shell_progress >= SHELL_PROGRESS_INTERVAL:
+            self.last_shell_progress = now
+            line = lines[-1]
+            self._add_progress_update(
+                f"Shell output ({self.command_output_lines} lines so far): {line[:50]}{'...' if len(line) > 50 else ''}"
+            )
 
     # Message submission - update to accept message object
     def submit_msg(self, msg: str, message_obj=None):
         # Replace print with logger
         self.logger.info(f"Message being submitted to brain: `{msg}`")
         self._add_state_transition("receiving", f"Received new task: {msg[:50]}{'...' if len(msg) > 50 else ''}")
-        self.incoming_msg_buffer.put(msg)
+        self.incoming_msg_buffer.put_nowait(msg)
         # Store the original message for thread creation
         if message_obj is not None:
             self.original_message = message_obj
             # Reset active_thread since this is a new conversation
             self.active_thread = None
 
-    def _brain_main(self):
+    async def _brain_main(self):
         while not self._shutdown_flag:
-            time.sleep(1)
-
-            # Check if we should send a progress update
-            self._check_progress_update()
-
-            if not self.incoming_msg_buffer.empty():
-                sys_prompt = SystemMessage(MISTRAL_SYSPROMPT)
-                msg = self.incoming_msg_buffer.get()
-                self._add_state_transition("processing", "Processing task")
+            msg = await self.incoming_msg_buffer.get()
+            sys_prompt = SystemMessage(MISTRAL_SYSPROMPT)
+            self._add_state_transition("processing", "Processing task")
 
-                # Just use the logging handler - it will route to bot_debug.log
-                config = {
-                    "recursion_limit": 100,
-                    "callbacks": [self.logging_handler]
+            # Just use the logging handler - it will route to bot_debug.log
+            config = {
+                "recursion_limit": 100,
+                "callbacks": [self.logging_handler],
+                "configurable": {
+                    "brain": self,  # The shared graph runs its nodes on this brain
+                    "thread_id": str(self.task_id),  # Checkpoints of this task's run
                 }
-                
-                try:
-                    def graph_call():
-                        return self.graph.invoke(
-                            {"messages": [sys_prompt, msg]},
+            }
+            attempts = 0
+            self.task_started = time.monotonic()
+            self.task_llm_calls = 0
+            self.task_replans_skipped = 0
+            self.task_parallel_saved = 0.0
+            self.task_first_output = None
+            self.task_retries = 0
+            self.task_cache_hits = 0
+            
+            path = "graph"
+            try:
+                # Trivial lookups are answered with one LLM call and one command instead of the graph
+                single_shot = self.shell is not None and is_simple_task(msg)
+                if single_shot and self.graph.checkpointer is not None:
+                    # A graph run interrupted by a restart carries on in the graph
+                    single_shot = not (await self.graph.aget_state(config)).next
+                answered, attempt = await self._single_shot(msg, sys_prompt, config) if single_shot else (False, None)
+                if answered:
+                    path = "single_shot"
+                    self._add_state_transition("idle", "Task answered in a single shot")
+                else:
+                    async def graph_call():
+                        nonlocal attempts
+                        attempts += 1
+                        # Carry on from the last completed node if this task's run was interrupted,
+                        # so no LLM call or command is repeated
+                        if self.graph.checkpointer is not None:
+                            snapshot = await self.graph.aget_state(config)
+                            if snapshot.next:
+                                if attempts == 1:
+                                    await self._note_resumed(config, snapshot)
+                                return await self.graph.ainvoke(None, config)
+                        # A failed single-shot command is passed on with the task, so the plan accounts for it
+                        return await self.graph.ainvoke(
+                            {"messages": [sys_prompt, msg if attempt is None else f"{msg}\n\n{attempt}"]},
                             config
                         )
-                    
-                    output = self.retry_with_exponential_backoff(graph_call)
+                
+                    output = await self.retry_with_exponential_backoff(graph_call)
                     self.logger.info("Graph execution completed")
                     self._add_state_transition("idle", "Task processing complete")
-                except Exception as e:
-                    self.logger.error(f"Error during graph execution: {str(e)}")
-                    self._add_state_transition("error", f"Error: {str(e)}")
-                    self.send_discord_msg(f"An error occurred: {str(e)}")
+            except Exception as e:
+                self.logger.error(f"Error during graph execution: {str(e)}")
+                self._add_state_transition("error", f"Error: {str(e)}")
+                await self.send_discord_msg(f"An error occurred: {str(e)}")
+            await self._report_task_stats(path)
+            # The run is over either way; the next message starts a new one
+            if self.graph.checkpointer is not None:
+                await self.graph.checkpointer.adelete_thread(str(self.task_id))
+            if self.on_task_done is not None:
+                self.on_task_done()
+
+    async def _single_shot(self, task, sys_prompt, config):
+        """
+        Answer a trivial request with one LLM call: translate it into a single
+        command (see agent.MistralAgent), run it and post its output. Returns
+        (answered, attempt). The command only runs if it's read-only (see
+        agent.is_read_only_command); if it isn't, or it fails, the task goes
+        through the full graph instead, and `attempt` is a note telling the
+        graph what was run, or None if nothing was. While the command runs,
+        the task is checkpointed as a graph run about to plan, told the
+        command was run, so a restart resumes it there instead of running the
+        command again.
+        """
+        self._add_state_transition("execution", "Answering with a single command")
+        async def single_shot_call(models):
+            self._count_llm_call()
+            return await MistralAgent(models.llm).run_async(task)
+
+        command = await self.retry_with_exponential_backoff(single_shot_call, prompt=task, route="single_shot")
+        if not command:
+            return False, None
+        if not is_read_only_command(command):
+            # Nothing has run yet, so the full agent starts from a clean slate
+            self.logger.info(f"Single-shot command is not read-only, using the full agent: {command}")
+            return False, None
+        self.logger.info(f"[SINGLE SHOT] {command}")
+        await self.send_discord_msg(f"⚡ **Running:**\n```bash\n{command}\n```")
+        if self.graph.checkpointer is not None:
+            note = (
+                "Note: before planning, this command was run for the task, but the agent restarted before "
+                f"seeing its result. Don't assume it had no effect.\n$ {command}"
+            )
+            await self.graph.aupdate_state(config, {"messages": [sys_prompt, f"{task}\n\n{note}"]}, as_node=START)
+        self.command_output_lines = 0
+        result = await self.shell.run(command, timeout=COMMAND_TIMEOUT, idle_timeout=COMMAND_IDLE_TIMEOUT)
+        if self.graph.checkpointer is not None:
+            # The command finished; a failure is handed to a fresh graph run below
+            await self.graph.checkpointer.adelete_thread(str(self.task_id))
+        output = compress_output(result.lines).text.strip() or "(no output)"
+        if len(output) > SINGLE_SHOT_OUTPUT_CHARS:
+            output = output[:SINGLE_SHOT_OUTPUT_CHARS] + "\n..."
+            if result.command_id is not None:
+                output += f"\n[cut short; see the rest with !output {result.command_id}]"
+        if not result.ok or result.cancelled:
+            outcome = "was cancelled" if result.cancelled else f"exited with code {result.exit_code}"
+            self.logger.info(f"Single-shot command {outcome}, using the full agent")
+            await self.send_discord_msg(
+                f"↪️ The command {outcome}:\n```\n{output}\n```\n"
+                "Handing the task to the full agent, which is told what was already run."
+            )
+            attempt = (
+                f"Note: before planning, this command was run for the task and {outcome}. "
+                f"Don't assume it had no effect.\n$ {command}\n{output}"
+            )
+            return False, attempt
+
+        await self.send_discord_msg(f"```\n{output}\n```")
+        return True, None
+
+    def _count_llm_call(self):
+        self.task_llm_calls += 1
+        self.total_llm_calls += 1
+
+    async def _report_task_stats(self, path):
+        """Report how many LLM round trips and how much time the task took, on the "single_shot" or "graph" path"""
+        elapsed = time.monotonic() - self.task_started
+        record_task_latency(path, elapsed)
+        if path == "single_shot":
+            self.last_task_report = f"{elapsed:.1f}s, {self.task_llm_calls} LLM calls, single shot"
+            self.logger.info(f"Task {self.task_id} finished: {self.last_task_report}")
+            await self.send_discord_msg(f"⏱️ Took {elapsed:.1f}s and {self.task_llm_calls} LLM call (single shot)")
+            return
+        self.last_task_report = (
+            f"{elapsed:.1f}s, {self.task_llm_calls} LLM calls, {self.task_replans_skipped} replans skipped, "
+            f"{self.task_parallel_saved:.1f}s saved by parallel steps"
+        )
+        if self.task_first_output is not None:
+            self.last_task_report += f", first output after {self.task_first_output:.1f}s"
+        if self.task_retries:
+            self.last_task_report += f", {self.task_retries} retries"
+        if self.task_cache_hits:
+            self.last_task_report += f", {self.task_cache_hits} cached responses"
+        self.logger.info(f"Task {self.task_id} finished: {self.last_task_report}")
+        self._add_progress_update(f"Task took {self.last_task_report}")
+        saved = f", {self.task_parallel_saved:.1f}s saved by running steps in parallel" if self.task_parallel_saved >= 0.1 else ""
+        await self.send_discord_msg(
+            f"⏱️ Took {elapsed:.1f}s and {self.task_llm_calls} LLM calls "
+            f"({self.task_replans_skipped} replans skipped{saved})"
+        )
+
+    async def _note_resumed(self, config, snapshot):
+        """Tell the user and the model that the task picks up where it left off before a restart"""
+        self.logger.info(f"Resuming task {self.task_id} before {snapshot.next}")
+        self._add_state_transition("processing", f"Resuming task before {', '.join(snapshot.next)}")
+        await self.send_discord_msg(f"♻️ **Resuming task** from where it left off (next step: `{', '.join(snapshot.next)}`)")
+        if "planning" in snapshot.next:
+            return  # Planning reads the task from the last message, and nothing has run in the old shell that it doesn't know of
+        note = HumanMessage(content=(
+            "Note: the agent was restarted while working on this task and is now running in a new shell. "
+            "The working directory, environment variables and background jobs of the old shell are gone; "
+            "files written to disk are still there."
+        ))
+        await self.graph.aupdate_state(config, {"messages": [note]})
+
+    async def _progress_loop(self):
+        while not self._shutdown_flag:
+            await asyncio.sleep(1)
+            # Check if we should send a progress update
+            await self._check_progress_update()
+
+    def _start_background(self, coro):
+        """Run a coroutine on the loop without waiting for it"""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
 
-            # check if there is a new message in the shell_out_buffer
 
     # Track state transitions
     def _add_state_transition(self, new_state, message):
@@ -387,19 +1278,15 @@ class Brain:
         """Add a timestamped progress update"""
         timestamp = datetime.now().strftime("%H:%M:%S")
         update = f"[{timestamp}] {message}"
-        self.progress_updates.append(update)
+        self.progress_updates.append(update)  # Bounded to the most recent PROGRESS_UPDATES_KEPT updates
         self.logger.info(f"Progress: {update}")
         
         # Reset the progress update timer
         self.last_progress_time = datetime.now()
-        
-        # Keep only the most recent 100 updates
-        if len(self.progress_updates) > CONTEXT_WINDOW:
-            self.progress_updates = self.progress_updates[-CONTEXT_WINDOW:]
         return update
         
     # Check if we should send a progress update to Discord
-    def _check_progress_update(self):
+    async def _check_progress_update(self):
         """Send periodic progress updates for long-running tasks"""
         if (self.last_progress_time and 
             self.current_state not in ["idle", "error"] and
@@ -411,7 +1298,7 @@ class Brain:
             if len(self.progress_updates) > 0:
                 update_msg += f"\n\nLast action: {self.progress_updates[-1]}"
                 
-            self.send_discord_msg(update_msg)
+            await self.send_discord_msg(update_msg)
             self.last_progress_time = datetime.now()
     
     # Get current progress info
@@ -419,7 +1306,7 @@ class Brain:
         """Returns a structured object with current progress information"""
         return {
             "current_state": self.current_state,
-            "updates": self.progress_updates[-10:],  # Last 10 updates
+            "updates": list(self.progress_updates)[-10:],  # Last 10 updates
             "time_in_state": (datetime.now() - self.last_progress_time).seconds if self.last_progress_time else 0
         }
     
@@ -430,31 +1317,33 @@ class Brain:
                 await asyncio.sleep(duration)
 
     # Discord message sending with thread support
-    def send_discord_msg(self, msg: str, create_thread=False):
+    async def send_discord_msg(self, msg: str, create_thread=False):
         assert self.discord_loop is not None and self.discord_loop.is_running(), \
                 "Trying to send msg before discord loop is initialized"
         
         self.logger.info(f"Brain sending message to discord: `{msg}...`")
-        asyncio.run_coroutine_threadsafe(self._send_discord_msg(msg, create_thread), self.discord_loop)
+        await self._send_discord_msg(msg, create_thread)
+
+    async def _message_target(self, create_thread=False):
+        """The thread or channel this brain's messages go to"""
+        if self.active_thread:
+            return self.active_thread
+        if create_thread and self.original_message:
+            # Create a new thread from the original message
+            task_name = self.original_message.content[:50] + "..." if len(self.original_message.content) > 50 else self.original_message.content
+            self.active_thread = await self.original_message.create_thread(
+                name=f"Task: {task_name}", 
+                auto_archive_duration=60  # Minutes until thread auto-archives
+            )
+            # Add a small delay to ensure thread is ready
+            await asyncio.sleep(0.5)
+            return self.active_thread
+        return self.channel
 
     async def _send_discord_msg(self, msg: str, create_thread=False):
         try:
             # Determine the target for sending messages
-            target = None
-            if self.active_thread:
-                target = self.active_thread
-            elif create_thread and self.original_message:
-                # Create a new thread from the original message
-                task_name = self.original_message.content[:50] + "..." if len(self.original_message.content) > 50 else self.original_message.content
-                self.active_thread = await self.original_message.create_thread(
-                    name=f"Task: {task_name}", 
-                    auto_archive_duration=60  # Minutes until thread auto-archives
-                )
-                # Add a small delay to ensure thread is ready
-                await asyncio.sleep(0.5)
-                target = self.active_thread
-            else:
-                target = self.channel
+            target = await self._message_target(create_thread)
                 
             # Smart chunking that preserves formatting
             if len(msg) > 1900:
@@ -566,8 +1455,29 @@ class Brain:
         # Add recent progress updates
         if self.progress_updates:
             info.append("\nRecent Progress:")
-            for update in self.progress_updates[-5:]:
+            for update in list(self.progress_updates)[-5:]:
                 info.append(f"• {update}")
+
+        info.append(f"\nShell Output: {self.shell_lines_received} lines received, {self.shell_lines_skipped} skipped by batching")
+        store = self._output_store()
+        if store is not None:
+            stats = store.get_stats()
+            info.append(f"Output Store: {stats['commands']} commands, {stats['lines']} lines, {stats['bytes']} bytes on disk")
+        if self.output_chars_compressed:
+            ratio = self.output_chars_raw / self.output_chars_compressed
+            info.append(f"Output Compression: {self.output_chars_raw} -> {self.output_chars_compressed} chars ({ratio:.1f}x)")
+        info.append(
+            f"LLM Calls: {self.total_llm_calls} in total, {self.total_replans_skipped} replans skipped, "
+            f"{self.total_parallel_saved:.1f}s saved by parallel steps, largest prompt ~{self.max_prompt_tokens} tokens"
+        )
+        if self.last_task_report:
+            info.append(f"Last Task: {self.last_task_report}")
+        if self.scheduler is not None:
+            stats = self.scheduler.get_stats()
+            info.append(
+                f"LLM Scheduler ({self.scheduler.name}): {stats['queue_depth']} waiting, {stats['granted']} granted, "
+                f"wait avg {stats['avg_wait']}s / p95 {stats['p95_wait']}s, {stats['tokens']} tokens used"
+            )
         
         info.append("\n")
                 
@@ -592,32 +1502,44 @@ class Brain:
             # Last shell output
             info.append("\n=== LAST OUTPUT ===")
             for msg in reversed(last_state.get('messages', [])):
-                if isinstance(msg, HumanMessage) and msg.content.startswith("Shell output:"):
-                    output = msg.content.replace("Shell output: \n", "").strip()
+                if isinstance(msg, HumanMessage) and msg.content.startswith("Shell output"):
+                    output = msg.content.split("\n", 1)[-1].strip()
                     info.append(f"{output}")
                     break
         
         return "\n".join(info)
 
-    def shutdown(self):
+    async def shutdown(self):
         """Cleanly shut down the brain and terminate all processes"""
         self.logger.info("Shutting down brain...")
         
-        # Set a flag to stop the main thread loop
+        # Set a flag to stop the main loop
         self._shutdown_flag = True
         
-        # Join the main thread if it's running
-        if hasattr(self, 'mthread') and self.mthread and self.mthread.is_alive():
-            self.logger.info("Waiting for brain thread to terminate...")
-            self.mthread.join(timeout=5)
+        # Interrupt the running command so the shell is free again, then stop the brain's tasks
+        for shell in list(self.branch_shells):
+            await shell.cancel()
+        if self.shell:
+            await self.shell.cancel(wait=5)
+        tasks = [t for t in [self.main_task, self.progress_task, *self.background_tasks] if t is not None and not t.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.logger.info("Waiting for brain tasks to terminate...")
+            await asyncio.wait(tasks, timeout=5)
         
-        # Stop the shell if it's running
-        if hasattr(self, 'shell') and self.shell:
-            self.logger.info("Stopping shell...")
-            self.shell.stop()
+        # Detach from the shell; the owner hands it back to the ShellPool
+        if self.shell:
+            self.shell.set_output_callback(None)
+        if self.output_store is not None:
+            self.output_store.close()
+            self.output_store = None
+        if self.scheduler is not None:
+            self.scheduler.forget_task(self.task_id)
+        for model in self.models_used:
+            get_agent_models(model).scheduler.forget_task(self.task_id)
         
         self.graph = None
-        self.graph_builder = None
         import gc 
         gc.collect()
         
@@ -626,23 +1548,84 @@ class Brain:
         
         return True
 
-    def retry_with_exponential_backoff(self, func, max_retries=5):
-        for i in range(max_retries):
+    def _route(self, route):
+        """The AgentModels to use for `route` right now (see model_router.route_models)"""
+        model = route_models(route, self.base_model_type)[0]
+        self.models_used.add(model)
+        return get_agent_models(model)
+
+    async def retry_with_exponential_backoff(self, func, max_retries=5, prompt=None, route=None):
+        """
+        Await `func()`, retrying when it fails with a rate limit or a transient
+        error (see retry_policy.classify_error); anything else is raised. Waits
+        as long as the provider's Retry-After asks, or a jittered backoff, so
+        tasks that failed together don't retry together. LLM calls made inside
+        are queued in the shared scheduler under this brain, reserving tokens
+        for `prompt` if given.
+
+        With `route` (a graph node, see model_router), `func(models)` is called
+        with the AgentModels of the model the route picks, and its latency is
+        recorded. Calls go through the provider's circuit breaker, waiting up
+        to BREAKER_WAIT_MAX seconds in total while it's open, and a failed
+        call is retried on the other provider's model straight away when the
+        route prefers it now.
+        """
+        tokens = estimate_tokens(prompt) if prompt is not None else 0
+        self.max_prompt_tokens = max(self.max_prompt_tokens, tokens)
+        node = route if route is not None else "graph"
+        i = 0
+        failovers = 0
+        # Waiting for a breaker doesn't use up a retry, as no call was made; the waits are bounded in total instead
+        breaker_deadline = time.monotonic() + BREAKER_WAIT_MAX
+        problem = f"Unable to complete operation after {max_retries} attempts"
+        while i < max_retries:
+            models = self._route(route) if route is not None else self.models
+            breaker = get_breaker(provider_of(models.name)) if route is not None else None
+            if breaker is not None and breaker.state() != "closed":
+                # Both providers are failing for this route; wait until the breaker lets a call through
+                self.logger.warning(f"Circuit breaker for {breaker.name} is {breaker.state()}, waiting for it to let a call through")
+                if not await breaker.wait(breaker_deadline):
+                    problem = f"{breaker.name} kept failing for {BREAKER_WAIT_MAX:.0f}s"
+                    break
+            started = time.monotonic()
             try:
-                return func()
+                with models.scheduler.request(task=self.task_id, priority=self.priority, tokens=tokens):
+                    result = await (func(models) if route is not None else func())
+                if route is not None:
+                    breaker.record_success()
+                    record_call(route, models.name, time.monotonic() - started)
+                return result
             except Exception as e:
-                if "rate_limit" in str(e).lower():
-                    wait_time = 2 ** i
-                    self.logger.warning(f"API Rate limit hit, waiting {wait_time}s before retry {i+1}/{max_retries}")
-                    
-                    # Notify user in Discord
-                    if i > 0:  # Only notify after first retry
-                        self.send_discord_msg(f"⚠️ ** API Rate limit reached** - Waiting {wait_time}s before retry {i+1}/{max_retries}")
-                    
-                    time.sleep(wait_time)
-                else:
+                kind = classify_error(e)
+                if kind == FATAL:
+                    if breaker is not None:
+                        breaker.record_success()  # The provider answered; it's the request that failed
                     raise
-        error_msg = f"🛑 **Maximum retries exceeded** - Unable to complete operation after {max_retries} attempts. Rerun your command in a few minutes!"
+                wait_time = retry_delay(e, i)
+                if kind == RATE_LIMITED:
+                    # Hold back every task using this model, not just this one
+                    models.scheduler.pause(retry_after(e) or wait_time)
+                record_retry(node, kind)
+                self.task_retries += 1
+                if route is not None:
+                    breaker.record_failure()
+                    record_call(route, models.name, rate_limited=kind == RATE_LIMITED)
+                    fallback = route_models(route, self.base_model_type)[0]
+                    # Moving to the other provider doesn't use up a retry
+                    if fallback != models.name and failovers < max_retries:
+                        self.logger.warning(f"{models.name} failed ({kind}), failing over to {fallback} for {route}")
+                        failovers += 1
+                        continue
+
+                problem = "API Rate limit reached" if kind == RATE_LIMITED else f"API error ({type(e).__name__})"
+                self.logger.warning(f"{problem}, waiting {wait_time:.1f}s before retry {i+1}/{max_retries}: {e}")
+                # Notify user in Discord
+                if i > 0:  # Only notify after first retry
+                    await self.send_discord_msg(f"⚠️ **{problem}** - Waiting {wait_time:.0f}s before retry {i+1}/{max_retries}")
+                await asyncio.sleep(wait_time)
+                i += 1
+        record_retry(node, "gave_up")
+        error_msg = f"🛑 **Maximum retries exceeded** - {problem}. Rerun your command in a few minutes!"
         self.logger.error(error_msg)
-        self.send_discord_msg(error_msg)
+        await self.send_discord_msg(error_msg)
         raise Exception("Max retries exceeded")
\ No newline at end of file
@@ -0,0 +1,416 @@
+import asyncio
+import collections
+import contextlib
+import itertools
+import logging
+import os
+import pickle
+import socket
+import sys
+import traceback
+
+WORKER_START_TIMEOUT = 60   # Seconds a new worker has to connect back
+WORKER_RESTART_DELAY = 1    # Seconds before replacing a crashed worker
+REQUEST_TIMEOUT = 30        # Seconds to wait for a worker to answer a request
+REMOTE_MESSAGES_KEPT = 20   # Messages per task the bot keeps for the worker to edit or delete
+
+logger = logging.getLogger("discord")
+
+
+async def read_message(reader):
+    """Read one length-prefixed pickled message"""
+    header = await reader.readexactly(4)
+    return pickle.loads(await reader.readexactly(int.from_bytes(header, "big")))
+
+
+def write_message(writer, message):
+    data = pickle.dumps(message)
+    writer.write(len(data).to_bytes(4, "big") + data)
+
+
+class RemoteChannel:
+    """
+    Stands in for a task's Discord thread inside a worker. Messages are
+    passed to the bot process, which sends them to the real thread.
+    """
+    def __init__(self, writer, task_id):
+        self.writer = writer
+        self.task_id = task_id
+        self.message_ids = itertools.count(1)
+
+    async def send(self, content):
+        message = RemoteMessage(self, next(self.message_ids))
+        await self._post("send", message.message_id, content)
+        return message
+
+    async def _post(self, kind, message_id, content=None):
+        write_message(self.writer, (kind, self.task_id, message_id, content))
+        await self.writer.drain()
+
+    def typing(self):
+        return contextlib.nullcontext()
+
+
+class RemoteMessage:
+    """
+    A message a worker's task sent through its RemoteChannel, so it can edit
+    it as it streams (see streaming.LiveMessage). Edits and deletes are
+    passed to the bot process like sends.
+    """
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.message_id = message_id
+
+    async def edit(self, content):
+        await self.channel._post("edit", self.message_id, content)
+
+    async def delete(self):
+        await self.channel._post("delete", self.message_id)
+
+
+class RemoteBrain:
+    """
+    The bot process's handle on a task running in a brain worker. Offers the
+    same task controls as a Brain (`shutdown`, `cancel_command`,
+    `read_output`), forwarded to the worker. Messages the task sends, edits
+    or deletes are applied to its thread in order.
+    """
+    def __init__(self, pool, worker, task_id, thread):
+        self.pool = pool
+        self.worker = worker
+        self.task_id = task_id
+        self.thread = thread
+        self.shell = None   # The task's shell lives in the worker
+        self.outbox = asyncio.Queue()
+        self.sender = asyncio.create_task(self._send_loop())
+        self.finished = False
+        self.on_task_done = None    # Like Brain.on_task_done
+
+    async def _send_loop(self):
+        # The Discord messages sent for the task's latest RemoteMessages, which it may still edit
+        messages = collections.OrderedDict()
+        while True:
+            kind, message_id, content = await self.outbox.get()
+            try:
+                if kind == "send":
+                    messages[message_id] = await self.thread.send(content)
+                    if len(messages) > REMOTE_MESSAGES_KEPT:
+                        messages.popitem(last=False)
+                elif message_id in messages:
+                    if kind == "edit":
+                        await messages[message_id].edit(content=content)
+                    else:
+                        await messages.pop(message_id).delete()
+            except Exception as e:
+                logger.error(f"Failed to {kind} message from worker task {self.task_id}: {e}")
+
+    async def shutdown(self):
+        if not self.finished:
+            self.finished = True
+            await self.pool.request(self.worker, "stop_task", self.task_id)
+            self.pool.tasks.pop(self.task_id, None)
+            self.worker.tasks.discard(self.task_id)
+        # Let queued messages go out before the sender stops
+        while not self.outbox.empty():
+            await asyncio.sleep(0.1)
+        self.sender.cancel()
+        return True
+
+    def detach_shell(self):
+        return None     # The worker gives the task's shell back when the task is done
+
+    async def cancel_command(self):
+        if self.finished:
+            return False
+        return bool(await self.pool.request(self.worker, "cancel", self.task_id))
+
+    async def read_output(self, command_id=None, start=0, end=None):
+        if self.finished:
+            return None
+        return await self.pool.request(self.worker, "output", self.task_id, command_id, start, end)
+
+    def crashed(self):
+        """The worker running this task died"""
+        self.finished = True
+        self.outbox.put_nowait(("send", None, "💥 **The worker running this task crashed.** The task was stopped; start it again with `!agent`."))
+        if self.on_task_done is not None:
+            self.on_task_done()
+
+
+class BrainWorker:
+    """One worker process and the connection to it"""
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.reader = None
+        self.writer = None
+        self.tasks = set()          # Ids of the tasks running on this worker
+        self.reader_task = None
+        self.alive = False
+
+
+class BrainWorkerPool:
+    """
+    Runs agent tasks in separate worker processes, so that LLM response
+    parsing, logging and output processing use their own cores and GIL
+    instead of competing with the discord.py gateway, and a crashing task
+    doesn't take the bot down. Each worker hosts many Brains on its own event
+    loop, with its own ShellPool. The bot talks to workers over a socket pair
+    with length-prefixed pickled messages: requests go down, and Discord
+    messages and replies come back.
+
+    The provider's rate limits are split evenly between the workers (see
+    llm_scheduler.LIMIT_SCALE), since each has its own LLMScheduler.
+    """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.workers = [BrainWorker(i) for i in range(num_workers)]
+        self.tasks = {}             # task id -> RemoteBrain
+        self.task_ids = itertools.count(1)
+        self.request_ids = itertools.count(1)
+        self.pending = {}           # request id -> (worker, future)
+        self.running = False
+
+        # Statistics for !debug
+        self.total_tasks = 0
+        self.total_crashes = 0
+
+    async def start(self):
+        if self.running:
+            return
+        self.running = True
+        await asyncio.gather(*[self._spawn(worker) for worker in self.workers])
+
+    async def _spawn(self, worker):
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            worker.process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), str(child_sock.fileno()), str(self.num_workers),
+                pass_fds=(child_sock.fileno(),),
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+        finally:
+            child_sock.close()
+        worker.reader, worker.writer = await asyncio.open_connection(sock=parent_sock)
+        ready = await asyncio.wait_for(read_message(worker.reader), WORKER_START_TIMEOUT)
+        assert ready == ("ready",), f"Unexpected first message from brain worker: {ready}"
+        worker.alive = True
+        worker.tasks = set()
+        worker.reader_task = asyncio.create_task(self._read_loop(worker))
+        logger.info(f"Brain worker {worker.worker_id} started (pid {worker.process.pid})")
+
+    async def _read_loop(self, worker):
+        try:
+            while True:
+                message = await read_message(worker.reader)
+                kind = message[0]
+                if kind in ("send", "edit", "delete"):
+                    _, task_id, message_id, content = message
+                    remote = self.tasks.get(task_id)
+                    if remote is not None:
+                        remote.outbox.put_nowait((kind, message_id, content))
+                elif kind == "done":
+                    remote = self.tasks.get(message[1])
+                    if remote is not None and remote.on_task_done is not None:
+                        remote.on_task_done()
+                elif kind == "reply":
+                    _, request_id, value = message
+                    _, future = self.pending.pop(request_id, (None, None))
+                    if future is not None and not future.done():
+                        future.set_result(value)
+        except (asyncio.IncompleteReadError, ConnectionError, pickle.UnpicklingError) as e:
+            if self.running:
+                logger.error(f"Lost brain worker {worker.worker_id}: {e!r}")
+        await self._worker_lost(worker)
+
+    async def _worker_lost(self, worker):
+        worker.alive = False
+        with contextlib.suppress(Exception):
+            worker.process.kill()
+        for request_id, (owner, future) in list(self.pending.items()):
+            if owner is worker:
+                del self.pending[request_id]
+                if not future.done():
+                    future.set_result(None)
+        if not self.running:
+            return
+
+        self.total_crashes += 1
+        for task_id in worker.tasks:
+            remote = self.tasks.pop(task_id, None)
+            if remote is not None:
+                remote.crashed()
+        worker.tasks = set()
+        await asyncio.sleep(WORKER_RESTART_DELAY)
+        try:
+            await self._spawn(worker)
+        except Exception as e:
+            logger.error(f"Failed to restart brain worker {worker.worker_id}: {e!r}")
+
+    async def request(self, worker, kind, *args):
+        """Send a request to a worker and wait for its reply (None if the worker died)"""
+        if not worker.alive:
+            return None
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (worker, future)
+        write_message(worker.writer, (kind, request_id, *args))
+        await worker.writer.drain()
+        try:
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.pending.pop(request_id, None)
+            return None
+
+    async def start_task(self, thread, task, model, priority):
+        """Start a task on the least busy worker and return its RemoteBrain"""
+        live = [w for w in self.workers if w.alive]
+        if not live:
+            raise RuntimeError("No brain workers are running")
+        worker = min(live, key=lambda w: len(w.tasks))
+        task_id = next(self.task_ids)
+        remote = RemoteBrain(self, worker, task_id, thread)
+        self.tasks[task_id] = remote
+        worker.tasks.add(task_id)
+        started = await self.request(worker, "start_task", task_id, task, model, priority, thread.id)
+        if started is not True:
+            self.tasks.pop(task_id, None)
+            worker.tasks.discard(task_id)
+            remote.sender.cancel()
+            # The worker answers with the reason when it's out of shells
+            raise RuntimeError(started if isinstance(started, str) else f"Brain worker {worker.worker_id} failed to start the task")
+        self.total_tasks += 1
+        return remote
+
+    async def get_stats(self):
+        stats = {
+            "workers": sum(w.alive for w in self.workers),
+            "tasks": len(self.tasks),
+            "started": self.total_tasks,
+            "crashes": self.total_crashes,
+        }
+        for worker in self.workers:
+            worker_stats = await self.request(worker, "stats") if worker.alive else None
+            stats[f"worker {worker.worker_id}"] = worker_stats or "down"
+        return stats
+
+    async def close(self):
+        self.running = False
+        for worker in self.workers:
+            if worker.alive:
+                write_message(worker.writer, ("exit", 0))
+                with contextlib.suppress(Exception):
+                    await worker.writer.drain()
+        for worker in self.workers:
+            if worker.process is not None:
+                try:
+                    await asyncio.wait_for(worker.process.wait(), 10)
+                except asyncio.TimeoutError:
+                    worker.process.kill()
+
+
+async def serve(sock, num_workers):
+    """Main loop of a worker process: host Brains for the tasks the bot sends"""
+    import llm_scheduler
+    llm_scheduler.LIMIT_SCALE = 1 / num_workers
+
+    import agent
+    import streaming
+    import model_router
+    import retry_policy
+    import llm_cache
+
+    from brain import Brain, set_checkpointer
+    from checkpoints import open_checkpointer
+    from shell_pool import ShellPool, ShellPoolExhausted
+
+    reader, writer = await asyncio.open_connection(sock=sock)
+    set_checkpointer(await open_checkpointer())
+    shell_pool = ShellPool()
+    await shell_pool.start()
+    brains = {}
+
+    def reply(request_id, value):
+        write_message(writer, ("reply", request_id, value))
+
+    async def stop_task(task_id):
+        brain = brains.pop(task_id, None)
+        if brain is not None:
+            await brain.shutdown()
+            if brain.shell is not None:
+                await shell_pool.release(brain.shell)
+
+    def task_done(task_id, brain):
+        # Like in the bot process, a finished task gives its shell back straight away
+        write_message(writer, ("done", task_id))
+        shell = brain.detach_shell()
+        if shell is not None:
+            asyncio.create_task(shell_pool.release(shell))
+
+    async def handle(message):
+        kind, request_id, *args = message
+        try:
+            if kind == "start_task":
+                task_id, task, model, priority, checkpoint_id = args
+                try:
+                    # Give up before the bot stops waiting for the reply, so a late start can't orphan the task
+                    shell = await shell_pool.lease(timeout=REQUEST_TIMEOUT / 2)
+                except ShellPoolExhausted as e:
+                    shell = None
+                    reply(request_id, str(e))
+                if shell is not None:
+                    # Checkpoints are keyed by the task's thread, like tasks run in the bot process
+                    brain = Brain(shell=shell, priority=priority, task_id=checkpoint_id, shell_pool=shell_pool)
+                    brain.channel = RemoteChannel(writer, task_id)
+                    brain.on_task_done = lambda brain=brain: task_done(task_id, brain)
+                    brain.start(default_model=model)
+                    brains[task_id] = brain
+                    brain.submit_msg(task)
+                    reply(request_id, True)
+            elif kind == "stop_task":
+                await stop_task(args[0])
+                reply(request_id, True)
+            elif kind == "cancel":
+                brain = brains.get(args[0])
+                reply(request_id, brain is not None and await brain.cancel_command())
+            elif kind == "output":
+                brain = brains.get(args[0])
+                reply(request_id, await brain.read_output(*args[1:]) if brain is not None else None)
+            elif kind == "stats":
+                reply(request_id, {
+                    "pid": os.getpid(),
+                    "tasks": len(brains),
+                    "shells": shell_pool.get_stats(),
+                    "llm": llm_scheduler.get_all_stats(),
+                    "paths": agent.get_path_stats(),
+                    "first_output": streaming.get_first_output_stats(),
+                    "routes": model_router.get_route_stats(),
+                    "retries": retry_policy.get_retry_stats(),
+                    "cache": llm_cache.get_response_cache().get_stats(),
+                })
+        except Exception:
+            traceback.print_exc()
+            reply(request_id, None)
+        await writer.drain()
+
+    write_message(writer, ("ready",))
+    await writer.drain()
+    handlers = set()
+    try:
+        while True:
+            message = await read_message(reader)
+            if message[0] == "exit":
+                break
+            handler = asyncio.create_task(handle(message))
+            handlers.add(handler)
+            handler.add_done_callback(handlers.discard)
+    except asyncio.IncompleteReadError:
+        pass    # The bot went away
+    finally:
+        for task_id in list(brains):
+            await stop_task(task_id)
+        await shell_pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(socket.socket(fileno=int(sys.argv[1])), int(sys.argv[2])))
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import time
+
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+# Kept next to the logs, which is the directory that outlives the container
+CHECKPOINT_DB = "/app/logs/checkpoints.sqlite"
+
+
+async def open_checkpointer(path=CHECKPOINT_DB):
+    """SQLite checkpointer the agent graph saves its state to after every node"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = await aiosqlite.connect(path)
+    saver = AsyncSqliteSaver(conn)
+    await saver.setup()
+    return saver
+
+
+class TaskRecords:
+    """
+    The !agent tasks that haven't finished yet, with what's needed to start
+    them again after a restart. Their progress is in the graph checkpoints,
+    keyed by the same Discord thread id.
+    """
+    def __init__(self, path=CHECKPOINT_DB):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS agent_tasks ("
+            "thread_id INTEGER PRIMARY KEY, task TEXT, model TEXT, priority INTEGER, user_id INTEGER, created REAL)"
+        )
+        self.conn.commit()
+
+    def add(self, thread_id, task, model, priority, user_id):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO agent_tasks VALUES (?, ?, ?, ?, ?, ?)",
+            (thread_id, task, model, priority, user_id, time.time()),
+        )
+        self.conn.commit()
+
+    def finish(self, thread_id):
+        self.conn.execute("DELETE FROM agent_tasks WHERE thread_id = ?", (thread_id,))
+        self.conn.commit()
+
+    def unfinished(self):
+        """(thread_id, task, model, priority, user_id) of every unfinished task, oldest first"""
+        return self.conn.execute(
+            "SELECT thread_id, task, model, priority, user_id FROM agent_tasks ORDER BY created"
+        ).fetchall()
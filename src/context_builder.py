@@ -0,0 +1,87 @@
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from llm_scheduler import estimate_tokens
+from prompts import planning_prompt, execution_prompt, replanning_prompt, summarize_prompt
+
+CONTEXT_TOKEN_BUDGET = 12_000   # Estimated prompt tokens per LLM call, instructions included
+RECENT_MESSAGES = 6             # Newest history messages, which are kept at up to RECENT_MESSAGE_MAX_TOKENS
+RECENT_MESSAGE_MAX_TOKENS = 3000
+OLD_MESSAGE_MAX_TOKENS = 400    # Older messages are cut down to this many tokens
+SHORTENED_NOTE_CHARS = 80       # Room left for the note saying a message was cut short
+
+# Instructions the nodes send with every call. Older versions of the graph
+# stored them in the history each time; they're dropped from it here.
+STATIC_PROMPTS = tuple(
+    prompt.strip() for prompt in (planning_prompt, execution_prompt, replanning_prompt, summarize_prompt)
+)
+
+
+def message_tokens(message):
+    return estimate_tokens([message])
+
+
+def is_static_prompt(message):
+    content = message.content.strip()
+    if content.startswith("PLAN: "):
+        content = content[len("PLAN: "):].strip()
+    return content.startswith(STATIC_PROMPTS)
+
+
+def shorten(message, max_tokens):
+    """A copy of a message cut down to about `max_tokens` tokens"""
+    max_chars = max(max_tokens * 4 - SHORTENED_NOTE_CHARS, 0)
+    content = message.content
+    if len(content) <= max_chars:
+        return message
+    left_out = estimate_tokens(content[max_chars:])
+    return type(message)(content=content[:max_chars] + f"\n[... {left_out} more tokens of this message left out ...]")
+
+
+def build_context(messages, instruction, plan=None, summary=None, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    The messages to send to the LLM for one call, within about `budget`
+    tokens. The system prompt, the task (the first message after it) and the
+    instruction for this call, followed by `plan` if given, are always
+    included. The rest of the history is added newest first for as long as it
+    fits. Each message is cut down first, to RECENT_MESSAGE_MAX_TOKENS for the
+    RECENT_MESSAGES newest and to OLD_MESSAGE_MAX_TOKENS for older ones, so one
+    huge command output can't crowd out everything else. Earlier messages
+    that don't fit are left out, replaced by `summary` (the task's running
+    summary) if given.
+    """
+    pinned = []
+    rest = list(messages)
+    if rest and isinstance(rest[0], SystemMessage):
+        pinned.append(rest.pop(0))
+    if rest:
+        pinned.append(rest.pop(0))  # The task
+    history = [message for message in rest if not is_static_prompt(message)]
+
+    final = HumanMessage(content=instruction + ("\n" + plan if plan else ""))
+    remaining = budget - sum(message_tokens(message) for message in pinned) - message_tokens(final)
+    remaining -= SHORTENED_NOTE_CHARS // 4  # Room for the note about left out messages
+    if summary:
+        summary = shorten(HumanMessage(content=summary), RECENT_MESSAGE_MAX_TOKENS).content
+        remaining -= estimate_tokens(summary)
+
+    kept = []
+    for age, message in enumerate(reversed(history)):
+        message = shorten(message, RECENT_MESSAGE_MAX_TOKENS if age < RECENT_MESSAGES else OLD_MESSAGE_MAX_TOKENS)
+        tokens = message_tokens(message)
+        if tokens > remaining:
+            if kept and remaining < OLD_MESSAGE_MAX_TOKENS:
+                break
+            # Keep as much of it as fits
+            message = shorten(message, max(remaining, 0))
+            tokens = message_tokens(message)
+        kept.append(message)
+        remaining -= tokens
+
+    context = pinned
+    left_out = len(history) - len(kept)
+    if left_out:
+        note = f"[{left_out} earlier messages were left out to keep the context short]"
+        if summary:
+            note += "\n" + summary
+        context = context + [HumanMessage(content=note)]
+    return context + kept[::-1] + [final]
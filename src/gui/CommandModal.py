@@ -1,7 +1,5 @@
 import discord
 from discord import ui
-import asyncio
-import queue
 
 class CommandModal(ui.Modal, title="Execute Command"):
     """Modal dialog for entering a command to execute"""
@@ -31,24 +29,9 @@ class CommandModal(ui.Modal, title="Execute Command"):
         #         command_history.pop()  # Remove oldest
         
         # Execute the command
-        output_queue = queue.Queue()
-        original_callback = self.shell.callback
-        
         try:
-            self.shell.set_output_callback(lambda line: output_queue.put(line))
-            self.shell.execute_command(command)
-            
-            # Wait for command to finish
-            await asyncio.sleep(1)
-            
-            # Collect output
-            output_lines = []
-            while not output_queue.empty():
-                output_lines.append(output_queue.get())
-                
-            output_text = "\n".join(output_lines)
-            if "SHELL_READY" in output_text:
-                output_text = output_text.replace("SHELL_READY", "")
+            result = await self.shell.run(command)
+            output_text = result.text
             
             # Send output to thread
             if output_text.strip():
@@ -61,8 +44,13 @@ class CommandModal(ui.Modal, title="Execute Command"):
                     await self.thread.send(f"📤 **Command output:**\n```\n{output_text}\n```")
             else:
                 await self.thread.send("✅ Command executed with no output.")
+
+            if result.cancelled:
+                await self.thread.send(f"⏱️ Command was interrupted after {result.duration:.0f}s.")
+            elif result.exit_code != 0:
+                await self.thread.send(f"⚠️ Command exited with code `{result.exit_code}` after {result.duration:.1f}s")
+            if result.truncated:
+                await self.thread.send(f"✂️ Output truncated ({result.stdout_bytes + result.stderr_bytes} bytes in total)")
                 
         except Exception as e:
-            await self.thread.send(f"❌ **Error executing command:**\n```\n{str(e)}\n```")
-        finally:
-            self.shell.set_output_callback(original_callback)
\ No newline at end of file
+            await self.thread.send(f"❌ **Error executing command:**\n```\n{str(e)}\n```")
\ No newline at end of file
@@ -1,7 +1,6 @@
 import discord
 from discord.ui import View
 import asyncio
-import queue
 
 from .CommandModal import CommandModal
 from .FileBrowserView import FileBrowserView
@@ -29,13 +28,7 @@ class ContainerControlPanel(View):
             "> Gathering system information..."
         )
         
-        # Get basic container info
-        output_queue = queue.Queue()
-        original_callback = self.shell.callback
-        
         try:
-            self.shell.set_output_callback(lambda line: output_queue.put(line))
-
             # Update with complete welcome message
             await welcome_msg.edit(content=(
                 "## 🐳 **Container Control Panel**\n\n"
@@ -58,8 +51,6 @@ class ContainerControlPanel(View):
                 "- Start an interactive terminal\n\n"
                 "*This panel will remain active until the thread is archived.*"
             ))
-        finally:
-            self.shell.set_output_callback(original_callback)
         
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         """Only allow the original user to interact with this view"""
@@ -125,21 +116,12 @@ class ContainerControlPanel(View):
             }
             
             # Get current directory for better user context
-            output_queue = queue.Queue()
-            original_callback = self.shell.callback
+            result = await self.shell.run("pwd")
             
-            try:
-                self.shell.set_output_callback(lambda line: output_queue.put(line))
-                self.shell.execute_command("pwd")
-                await asyncio.sleep(0.5)
-                
-                current_dir = "/app"  # Default
-                while not output_queue.empty():
-                    line = output_queue.get()
-                    if "/" in line and "SHELL_READY" not in line:
-                        current_dir = line.strip()
-            finally:
-                self.shell.set_output_callback(original_callback)
+            current_dir = "/app"  # Default
+            for line in result.output:
+                if "/" in line:
+                    current_dir = line.strip()
             
             # Update progress
             await progress_msg.edit(content="⏳ **Starting terminal session:**\n> Session ready, initializing interface...")
@@ -173,31 +155,18 @@ class ContainerControlPanel(View):
         )
         
         # Get file listing first
-        output_queue = queue.Queue()
-        original_callback = self.shell.callback
-        
         try:
-            self.shell.set_output_callback(lambda line: output_queue.put(line))
-            
             # Update progress
             await progress_msg.edit(content="⏳ **Opening file manager:**\n> Reading directory contents...")
-            self.shell.execute_command("ls -la /app")
-            
-            # Wait for command to finish
-            await asyncio.sleep(1)
+            result = await self.shell.run("ls -la /app")
             
             # Update progress
             await progress_msg.edit(content="⏳ **Opening file manager:**\n> Processing file information...")
-            
-            # Collect output
-            output_lines = []
-            while not output_queue.empty():
-                output_lines.append(output_queue.get())
                 
             # Parse the file listing
             files = []
-            for line in output_lines:
-                if line.startswith("total") or "SHELL_READY" in line:
+            for line in result.output:
+                if line.startswith("total"):
                     continue
                 parts = line.split()
                 if len(parts) >= 9:
@@ -220,8 +189,6 @@ class ContainerControlPanel(View):
         except Exception as e:
             await progress_msg.edit(content=f"❌ **Error opening file manager:**\n```\n{str(e)}\n```")
             await interaction.followup.send("Error opening file browser.", ephemeral=True)
-        finally:
-            self.shell.set_output_callback(original_callback)
     
     # ===== CONTAINER INFO =====
     @discord.ui.button(label="Container Status", style=discord.ButtonStyle.secondary, emoji="📊", row=1)
@@ -239,36 +206,18 @@ class ContainerControlPanel(View):
             await progress_msg.edit(content="⏳ **Fetching container status:**\n> Collecting system metrics...")
             
             # Create basic system metrics preview
-            output_queue = queue.Queue()
-            original_callback = self.shell.callback
+            # Get memory info
+            memory_result = await self.shell.run("free -h | head -2")
             
-            try:
-                self.shell.set_output_callback(lambda line: output_queue.put(line))
-                
-                # Get memory info
-                self.shell.execute_command("free -h | head -2")
-                await asyncio.sleep(0.5)
-                
-                # Get running processes count
-                self.shell.execute_command("ps aux | wc -l")
-                await asyncio.sleep(0.5)
-                
-                # Update progress
-                await progress_msg.edit(content="⏳ **Fetching container status:**\n> Preparing status panel...")
-                
-                # Collect output
-                output_lines = []
-                while not output_queue.empty():
-                    line = output_queue.get()
-                    if "SHELL_READY" not in line:
-                        output_lines.append(line)
-                        
-                # Create status preview
-                memory_info = "\n".join([line for line in output_lines if "Mem" in line or "total" in line])
-                process_count = next((line for line in output_lines if line.isdigit()), "0")
-                
-            finally:
-                self.shell.set_output_callback(original_callback)
+            # Get running processes count
+            process_result = await self.shell.run("ps aux | wc -l")
+            
+            # Update progress
+            await progress_msg.edit(content="⏳ **Fetching container status:**\n> Preparing status panel...")
+                    
+            # Create status preview
+            memory_info = "\n".join([line for line in memory_result.output if "Mem" in line or "total" in line])
+            process_count = next((line for line in process_result.output if line.strip().isdigit()), "0")
                 
             # Update final progress
             await progress_msg.edit(content=f"✅ **Status panel ready!**\n> Found {process_count.strip()} active processes")
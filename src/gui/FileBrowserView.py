@@ -1,7 +1,5 @@
 import discord
 from discord.ui import View
-import asyncio
-import queue
 import os
 
 from .FileSelect import FileSelect
@@ -62,6 +60,7 @@ class FileBrowserView(View):
             "type": "file_upload", 
             "channel_id": interaction.channel_id,
             "thread_id": self.thread.id,
+            "shell": self.shell,
             "target_dir": self.current_dir  # Save the target directory
         }
             
@@ -71,15 +70,10 @@ class FileBrowserView(View):
         await self.refresh_file_listing(interaction)
     
     async def refresh_file_listing(self, interaction):
-        output_queue = queue.Queue()
-        original_callback = self.shell.callback
-        
         # Create initial progress message (one-time)
         progress_msg = await self.thread.send(f"⏳ **Loading files...**")
         
         try:
-            self.shell.set_output_callback(lambda line: output_queue.put(line))
-            
             # OPTIMIZATION 1: Combined shell script for directory validation and file listing
             combined_script = f"""
             if [ -d '{self.current_dir}' ]; then
@@ -90,16 +84,9 @@ class FileBrowserView(View):
             fi
             """
             
-            # Execute single combined command
-            self.shell.execute_command(combined_script)
-            
-            # OPTIMIZATION 2: Shorter wait time
-            await asyncio.sleep(0.3)
-            
-            # Process output
-            output_lines = []
-            while not output_queue.empty():
-                output_lines.append(output_queue.get())
+            # Execute single combined command and wait for it to finish
+            result = await self.shell.run(combined_script)
+            output_lines = result.output
             
             # Check directory exists
             if any('DIR_NOT_FOUND' in line for line in output_lines):
@@ -149,6 +136,4 @@ class FileBrowserView(View):
             
         except Exception as e:
             await progress_msg.edit(content=f"❌ **Error:** {str(e)[:100]}")
-            await interaction.followup.send("Error refreshing file listing.", ephemeral=True)
-        finally:
-            self.shell.set_output_callback(original_callback)
\ No newline at end of file
+            await interaction.followup.send("Error refreshing file listing.", ephemeral=True)
\ No newline at end of file
@@ -1,6 +1,4 @@
 import discord
-import asyncio
-import queue
 import os
 
 class FileSelect(discord.ui.Select):
@@ -47,14 +45,9 @@ class FileSelect(discord.ui.Select):
             # Send initial progress message (single message we'll update)
             progress_msg = await self.thread.send(f"⏳ **Processing:** `{file_name}`")
             
-            output_queue = queue.Queue()
-            original_callback = self.view.shell.callback
-            
             try:
-                self.view.shell.set_output_callback(lambda line: output_queue.put(line))
-                
                 # Single command to verify file exists and check size
-                self.view.shell.execute_command(
+                result = await self.view.shell.run(
                     f"if [ -f '{file_path}' ]; then "
                     f"  echo 'FILE_EXISTS'; "
                     f"  stat -c %s '{file_path}' 2>/dev/null || echo 'SIZE_UNKNOWN'; "
@@ -63,13 +56,7 @@ class FileSelect(discord.ui.Select):
                     f"fi"
                 )
                 
-                # Short sleep to get command output
-                await asyncio.sleep(0.3)
-                
-                # Process output
-                output_lines = []
-                while not output_queue.empty():
-                    output_lines.append(output_queue.get())
+                output_lines = result.output
                 
                 # Check if file exists
                 if 'FILE_NOT_FOUND' in '\n'.join(output_lines):
@@ -104,6 +91,4 @@ class FileSelect(discord.ui.Select):
                     await interaction.followup.send("Error reading file.", ephemeral=True)
             except Exception as e:
                 await progress_msg.edit(content=f"❌ **Error:** {str(e)[:100]}")
-                await interaction.followup.send("Error processing file.", ephemeral=True)
-            finally:
-                self.view.shell.set_output_callback(original_callback)
\ No newline at end of file
+                await interaction.followup.send("Error processing file.", ephemeral=True)
\ No newline at end of file
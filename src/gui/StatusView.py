@@ -1,7 +1,5 @@
 import discord
 from discord.ui import View 
-import asyncio
-import queue
 
 
 class StatusView(View):
@@ -44,43 +42,27 @@ class StatusView(View):
         
     async def run_status_command(self, interaction: discord.Interaction, command, title):
         await interaction.response.defer(ephemeral=True)
-        output_queue = queue.Queue()
-        original_callback = self.shell.callback
+        result = await self.shell.run(command)
         
-        try:
-            self.shell.set_output_callback(lambda line: output_queue.put(line))
-            self.shell.execute_command(command)
+        # Add to command history
+        # if command not in command_history:
+        #     command_history.append(command)
+        #     if len(command_history) > MAX_HISTORY:
+        #         command_history.pop(0)
             
-            # Add to command history
-            # if command not in command_history:
-            #     command_history.append(command)
-            #     if len(command_history) > MAX_HISTORY:
-            #         command_history.pop(0)
-            
-            # Wait for command to finish
-            await asyncio.sleep(1)
-            
-            # Collect output
-            output_lines = []
-            while not output_queue.empty():
-                output_lines.append(output_queue.get())
-                
-            output_text = "\n".join(output_lines)
-            if "SHELL_READY" in output_text:
-                output_text = output_text.replace("SHELL_READY", "")
-            
-            # Improved output formatting
-            if len(output_text) > 1900:
-                chunks = [output_text[i:i+1900] for i in range(0, len(output_text), 1900)]
-                for i, chunk in enumerate(chunks):
-                    if i == 0:
-                        await self.thread.send(f"### 📊 **{title}**\n```\n{chunk}\n```")
-                    else:
-                        await self.thread.send(f"```\n{chunk}\n```")
-            else:
-                await self.thread.send(f"### 📊 **{title}**\n```\n{output_text}\n```")
-                
-        finally:
-            self.shell.set_output_callback(original_callback)
+        output_text = result.text
+        if not result.ok:
+            output_text += f"\n[exit code {result.exit_code}]"
+        
+        # Improved output formatting
+        if len(output_text) > 1900:
+            chunks = [output_text[i:i+1900] for i in range(0, len(output_text), 1900)]
+            for i, chunk in enumerate(chunks):
+                if i == 0:
+                    await self.thread.send(f"### 📊 **{title}**\n```\n{chunk}\n```")
+                else:
+                    await self.thread.send(f"```\n{chunk}\n```")
+        else:
+            await self.thread.send(f"### 📊 **{title}**\n```\n{output_text}\n```")
         
         await interaction.followup.send("Command executed. See results in thread.", ephemeral=True)
\ No newline at end of file
@@ -1,10 +1,9 @@
 import discord
 import asyncio
-import queue
 import os
-from shell import InteractiveShell
 
 from .ContainerControlPanel import ContainerControlPanel
+from shell_pool import ShellPoolExhausted
 
 
 # Dictionary to track active sessions and GUI threads
@@ -12,16 +11,42 @@ active_sessions = {}
 gui_threads = {}        # Map user IDs to their active GUI threads
 gui_shells = {}         # Map user IDs to their dedicated shell instances
 MAX_HISTORY = 20        # Maximum commands to remember
+TERMINAL_TIMEOUT = 120  # Seconds a terminal command may run before it's interrupted
 
 # Enhance the ContainerControlPanel with better visual organization
 # Update other view classes to accept and use thread parameter
 # Modify the setup function to support concurrent sessions
 
 def setup(bot):
-    # Track GUI thread cleanup status to avoid duplicate handlers
-    bot._gui_cleanup_registered = False
     bot.handle_gui_messages = handle_gui_messages
-    
+
+    # Registered at startup, so shells and tasks are cleaned up even before anyone runs !gui
+    async def on_thread_update(before, after):
+        # Check if this is one of our GUI threads and it just got archived
+        if not before.archived and after.archived:
+            # Check all registered GUI threads
+            for user_id, registered_thread in list(gui_threads.items()):
+                if after.id == registered_thread.id:
+                    # Clean up this thread's resources
+                    if await release_gui_shell(bot, user_id):
+                        print(f"[GUI] Cleaned up shell for thread {after.id}")
+                    # Remove from thread tracking
+                    if user_id in gui_threads:
+                        del gui_threads[user_id]
+                        print(f"[GUI] Removed thread {after.id} from tracking")
+
+                    # Clean up any active sessions
+                    for session_user_id, session in list(active_sessions.items()):
+                        if session.get("thread_id") == after.id:
+                            del active_sessions[session_user_id]
+                            print(f"[GUI] Cleaned up session for user {session_user_id}")
+
+        # Also clean up agent tasks from the bot module when their thread is archived
+        if hasattr(bot, "stop_task_brain") and not before.archived and after.archived:
+            await bot.stop_task_brain(after.id)
+
+    bot.add_listener(on_thread_update)
+
     @bot.command(name="gui", help="Open a container control panel")
     async def gui_command(ctx):
         
@@ -41,16 +66,24 @@ def setup(bot):
         #         if ctx.author.id in gui_threads:
         #             del gui_threads[ctx.author.id]
         
+        # A new panel replaces the user's previous one, so give its shell back first
+        await release_gui_shell(bot, ctx.author.id)
+
+        # Lease a dedicated shell for this GUI session
+        try:
+            dedicated_shell = await bot.shell_pool.lease()
+        except ShellPoolExhausted:
+            await ctx.send("🚦 **All shells are in use right now.** Please try again in a few minutes.")
+            return
+
         # Create a thread for the GUI session
         thread = await ctx.message.create_thread(
             name=f"GUI Session - {ctx.author.display_name}",
             auto_archive_duration=60  # Minutes until auto-archive
         )
-        
-        # Create a dedicated shell instance for this GUI session
-        dedicated_shell = InteractiveShell()
-        dedicated_shell.set_output_callback(lambda line: print(f"[GUI Shell {thread.id}] {line}"))
-        dedicated_shell.start()
+        dedicated_shell.set_output_callback(
+            lambda lines, skipped: print(f"[GUI Shell {thread.id}] {len(lines) + skipped} lines of output")
+        )
         
         # Store references to the thread and shell
         gui_threads[ctx.author.id] = thread
@@ -61,43 +94,17 @@ def setup(bot):
         await panel._send_welcome_message() 
         await thread.send("## 🎛️ **Container Control Panel**", view=panel)
         
-        # Register the cleanup handler only once
-        if not bot._gui_cleanup_registered:
-            @bot.event
-            async def on_thread_update(before, after):
-                # Check if this is one of our GUI threads and it just got archived
-                if not before.archived and after.archived:
-                    # Check all registered GUI threads
-                    for user_id, registered_thread in list(gui_threads.items()):
-                        if after.id == registered_thread.id:
-                            # Clean up this thread's resources
-                            if user_id in gui_shells:
-                                shell_to_close = gui_shells.pop(user_id)
-                                shell_to_close.stop()
-                                print(f"[GUI] Cleaned up shell for thread {after.id}")
-                            # Remove from thread tracking
-                            if user_id in gui_threads:
-                                del gui_threads[user_id]
-                                print(f"[GUI] Removed thread {after.id} from tracking")
-                            
-                            # Clean up any active sessions
-                            for session_user_id, session in list(active_sessions.items()):
-                                if session.get("thread_id") == after.id:
-                                    del active_sessions[session_user_id]
-                                    print(f"[GUI] Cleaned up session for user {session_user_id}")
-                
-                # Also check active_brains from the bot module
-                if hasattr(bot, "active_brains") and after.id in bot.active_brains and not before.archived and after.archived:
-                    # Clean up the brain when the thread is archived
-                    brain_to_close = bot.active_brains.pop(after.id)
-                    del brain_to_close  # This will trigger __del__ which cleans up resources
-            
-            # Mark that we've registered the cleanup handler
-            bot._gui_cleanup_registered = True
-        
         # Notify in original channel
         await ctx.send(f"Control panel opened in thread: {thread.mention}")
 
+async def release_gui_shell(bot, user_id):
+    """Give a user's GUI shell back to the pool. Returns whether they had one."""
+    shell = gui_shells.pop(user_id, None)
+    if shell is None:
+        return False
+    await bot.shell_pool.release(shell)
+    return True
+
 async def handle_gui_messages(bot, message):
     """Process messages related to GUI functionality like terminal sessions and file uploads"""
 
@@ -118,8 +125,7 @@ async def handle_gui_messages(bot, message):
             # Clean up shell resources
             if thread_owner in gui_shells:
                 try:
-                    shell_to_close = gui_shells.pop(thread_owner)
-                    shell_to_close.stop()
+                    await release_gui_shell(bot, thread_owner)
                     await message.channel.send("💤 **GUI session terminated**")
                     
                     # Also clean up any active sessions for this user
@@ -176,25 +182,17 @@ async def handle_gui_messages(bot, message):
             # Get shell and execute command
             shell = session["shell"]
             command = message.content
-            shell_output_buffer = queue.Queue()
-            original_callback = shell.callback
             
             try:
                 
                 # Execute command with typing indicator
                 async with message.channel.typing():
-                    shell.set_output_callback(lambda line: shell_output_buffer.put(line))
-                    shell.execute_command(command, wait_for_prompt=False)
+                    result = await shell.run(command, timeout=TERMINAL_TIMEOUT)
                     
-                    await asyncio.sleep(1.5)
-                    
-                    output_lines = []
-                    while not shell_output_buffer.empty():
-                        output_lines.append(shell_output_buffer.get())
-                    
-                    output_text = "\n".join(output_lines)
-                    output_text = output_text.replace("SHELL_READY", "")
-                    has_error = "[ERROR]" in output_text
+                    output_text = result.text
+                    if result.cancelled:
+                        output_text += f"\n[interrupted after {TERMINAL_TIMEOUT}s]"
+                    has_error = result.error is not None or (result.finished and result.exit_code != 0)
                     
                     if output_text.strip():
                         if len(output_text) > 1900:
@@ -219,8 +217,6 @@ async def handle_gui_messages(bot, message):
                 await message.reply(f"❌ **Error executing command:**\n```\n{str(e)}\n```")
                 await message.add_reaction("❌")
             finally:
-                # Always restore original callback
-                shell.set_output_callback(original_callback)
                 try:
                     await message.remove_reaction("⏳", bot.user)
                 except:
@@ -250,12 +246,10 @@ async def handle_gui_messages(bot, message):
                     await processing_msg.edit(content=f"⏳ **Processing upload:** `{attachment.filename}`\n> Downloading file... ({attachment.size/1024:.1f} KB)")
                     file_data = await attachment.read()
                     
-                    # Get the dedicated shell for this session if available, otherwise use the bot's shell
-                    shell = None
-                    if message.author.id in gui_shells:
-                        shell = gui_shells[message.author.id]
-                    else:
-                        shell = bot.brain.shell
+                    # Get the dedicated shell for this session
+                    shell = session.get("shell") or gui_shells.get(message.author.id)
+                    if shell is None:
+                        raise RuntimeError("No active shell for this session")
                     
                     # Create a temporary file
                     await processing_msg.edit(content=f"⏳ **Processing upload:** `{attachment.filename}`\n> Preparing file for container...")
@@ -268,44 +262,22 @@ async def handle_gui_messages(bot, message):
                         f.write(file_data)
                         
                     # Now use shell to move it to the container
-                    output_queue = queue.Queue()
-                    original_callback = shell.callback
-                    
                     try:
-                        shell.set_output_callback(lambda line: output_queue.put(line))
-                        
                         # Make sure target directory exists
                         await processing_msg.edit(content=f"⏳ **Processing upload:** `{attachment.filename}`\n> Checking target directory...")
-                        shell.execute_command(f"mkdir -p '{target_dir}'")
-                        await asyncio.sleep(0.5)
-                        
-                        # Clear queue
-                        while not output_queue.empty():
-                            output_queue.get()
+                        await shell.run(f"mkdir -p '{target_dir}'")
                         
                         # Copy from temp to container
                         await processing_msg.edit(content=f"⏳ **Processing upload:** `{attachment.filename}`\n> Copying to container...")
                         target_path = os.path.join(target_dir, attachment.filename)
                         copy_cmd = f"cp '{temp_path}' '{target_path}'"
-                        shell.execute_command(copy_cmd)
-                        
-                        # Wait for command to finish
-                        await asyncio.sleep(1)
-                        
-                        # Clear queue
-                        while not output_queue.empty():
-                            output_queue.get()
+                        await shell.run(copy_cmd)
                             
                         # Verify file was copied successfully
                         await processing_msg.edit(content=f"⏳ **Processing upload:** `{attachment.filename}`\n> Verifying file...")
-                        shell.execute_command(f"[ -f '{target_path}' ] && echo 'SUCCESS' || echo 'FAILED'")
-                        await asyncio.sleep(0.5)
-                        
-                        verify_output = []
-                        while not output_queue.empty():
-                            verify_output.append(output_queue.get())
+                        verify = await shell.run(f"[ -f '{target_path}' ] && echo 'SUCCESS' || echo 'FAILED'")
                         
-                        if any('SUCCESS' in line for line in verify_output):
+                        if any('SUCCESS' in line for line in verify.output):
                             # Success! File was uploaded successfully
                             await processing_msg.edit(content=f"✅ **Upload complete:** `{attachment.filename}`\n> File saved to `{target_path}`")
                             await message.add_reaction("✅")
@@ -325,7 +297,6 @@ async def handle_gui_messages(bot, message):
                         await message.add_reaction("❌")
                         
                     finally:
-                        shell.set_output_callback(original_callback)
                         # Clean up the session
                         del active_sessions[message.author.id]
                         
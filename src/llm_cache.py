@@ -0,0 +1,155 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# Kept next to the logs and checkpoints, which is the directory that outlives the container
+CACHE_DB = "/app/logs/llm_cache.sqlite"
+# Nodes whose responses are cached. Plans only depend on the request, which
+# users repeat all the time ("install X", "check the GPU"); execution and
+# summary prompts carry command output, so they rarely repeat. Add them here
+# to cache their responses too.
+CACHED_NODES = ("planning",)
+CACHE_TTL = 7 * 24 * 3600           # Seconds a response is reused for
+CACHE_MAX_ENTRIES = 5000            # Least recently used responses beyond these limits are evicted
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+EVICT_EVERY = 50                    # Stores between eviction passes
+
+def prompt_text(prompt):
+    """The text of a prompt given as a string or a list of messages"""
+    if isinstance(prompt, str):
+        return prompt
+    return "\n\n".join(f"{type(message).__name__}: {getattr(message, 'content', message)}" for message in prompt)
+
+
+def normalize_prompt(text):
+    """
+    The prompt with differences in whitespace removed: runs of spaces, the
+    ends of lines and blank lines. Case and punctuation are kept, since paths
+    and commands depend on them (`cat Foo.py` isn't `cat foo.py`).
+    """
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _hash(*parts):
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Structured LLM responses stored in SQLite, keyed on the node, the model
+    and a hash of the normalised prompt, so prompts that only differ in
+    whitespace share an entry. Entries expire after CACHE_TTL, and the least
+    recently used ones are evicted to stay within CACHE_MAX_ENTRIES and
+    CACHE_MAX_BYTES. Shared by every Brain in the process; worker processes
+    share the file.
+    """
+    def __init__(self, path=CACHE_DB):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, exact_key TEXT, node TEXT, model TEXT, response TEXT, "
+            "size INTEGER, created REAL, last_used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+        self.stores = 0
+
+        # Metrics for !debug, per node
+        self.hits = {}              # node -> [exact hits, normalised hits]
+        self.misses = {}
+        self.evictions = 0
+        self.lookup_time = 0.0
+
+    def _keys(self, node, model, prompt):
+        text = prompt_text(prompt)
+        return _hash(node, model, normalize_prompt(text)), _hash(node, model, text)
+
+    def get(self, node, model, prompt, schema):
+        """The cached `schema` response for this prompt, or None"""
+        started = time.monotonic()
+        key, exact_key = self._keys(node, model, prompt)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT exact_key, response FROM responses WHERE key = ? AND created > ?",
+                (key, time.time() - CACHE_TTL),
+            ).fetchone()
+            if row is None:
+                self.misses[node] = self.misses.get(node, 0) + 1
+            else:
+                self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+                self.hits.setdefault(node, [0, 0])[0 if row[0] == exact_key else 1] += 1
+            self.lookup_time += time.monotonic() - started
+        return schema.model_validate_json(row[1]) if row is not None else None
+
+    def put(self, node, model, prompt, response):
+        if response is None or model is None:
+            return  # The call gave nothing to reuse
+        key, exact_key = self._keys(node, model, prompt)
+        data = response.model_dump_json()
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, exact_key, node, model, data, len(data), now, now),
+            )
+            self.conn.commit()
+            self.stores += 1
+            if self.stores % EVICT_EVERY == 0:
+                self._evict()
+
+    def _evict(self):
+        # Called with self.lock held
+        evicted = self.conn.execute("DELETE FROM responses WHERE created <= ?", (time.time() - CACHE_TTL,)).rowcount
+        count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count > CACHE_MAX_ENTRIES or size > CACHE_MAX_BYTES:
+            # Drop the least recently used until both limits are met
+            kept = 0
+            kept_size = 0
+            cutoff = None
+            for last_used, entry_size in self.conn.execute("SELECT last_used, size FROM responses ORDER BY last_used DESC"):
+                if kept + 1 > CACHE_MAX_ENTRIES or kept_size + entry_size > CACHE_MAX_BYTES:
+                    cutoff = last_used
+                    break
+                kept += 1
+                kept_size += entry_size
+            if cutoff is not None:
+                evicted += self.conn.execute("DELETE FROM responses WHERE last_used <= ?", (cutoff,)).rowcount
+        self.conn.commit()
+        self.evictions += evicted
+
+    def get_stats(self):
+        with self.lock:
+            count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            stats = {"entries": count, "bytes": size, "evictions": self.evictions}
+            lookups = 0
+            for node in sorted(set(self.hits) | set(self.misses)):
+                exact, normalized = self.hits.get(node, [0, 0])
+                misses = self.misses.get(node, 0)
+                lookups += exact + normalized + misses
+                stats[node] = {
+                    "exact_hits": exact,
+                    "normalized_hits": normalized,
+                    "misses": misses,
+                    "hit_rate": round((exact + normalized) / (exact + normalized + misses), 2),
+                }
+            stats["avg_lookup_ms"] = round(self.lookup_time / lookups * 1000, 2) if lookups else 0.0
+            return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """The process-wide ResponseCache, opened on first use"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
@@ -0,0 +1,287 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.rate_limiters import BaseRateLimiter
+
+PRIORITY_INTERACTIVE = 0    # Someone is waiting on the answer in Discord
+PRIORITY_BACKGROUND = 1     # Work nobody is actively watching
+
+# Limits per model, shared by every Brain using it. A request may use up to
+# `max_burst` requests' worth of accumulated budget at once.
+MODEL_LIMITS = {
+    "mistral-large-latest": {"requests_per_second": 1.0, "tokens_per_minute": 500_000},
+    "mistral-small-latest": {"requests_per_second": 1.0, "tokens_per_minute": 500_000},
+    "gpt-4o": {"requests_per_second": 5.0, "tokens_per_minute": 30_000},
+    "gpt-4o-mini": {"requests_per_second": 5.0, "tokens_per_minute": 200_000},
+}
+DEFAULT_LIMITS = {"requests_per_second": 1.0, "tokens_per_minute": 100_000}
+MAX_BURST = 5
+# Share of the limits this process may use; brain worker processes split them between themselves
+LIMIT_SCALE = 1.0
+WAIT_SAMPLES = 200          # Recent wait times kept for the metrics
+
+
+@dataclass
+class LLMRequest:
+    """Who a call is made for, set around LLM calls with `LLMScheduler.request()`"""
+    task: object = None
+    priority: int = PRIORITY_INTERACTIVE
+    tokens: int = 0         # Estimated tokens, reserved before the call
+    used_tokens: int = 0    # Tokens the provider reported once the call finished
+
+
+current_request = contextvars.ContextVar("current_llm_request", default=None)
+
+
+def estimate_tokens(prompt):
+    """Rough token count of a prompt (a string or a list of messages), at ~4 characters a token"""
+    if isinstance(prompt, str):
+        return len(prompt) // 4
+    return sum(len(getattr(message, "content", message)) for message in prompt) // 4
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate            # Units added per second
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount):
+        """Seconds until `amount` can be taken (after a refill)"""
+        missing = min(amount, self.capacity) - self.level
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount):
+        # Can go negative when actual usage exceeded the estimate; later callers pay for it
+        self.level -= amount
+
+
+class SchedulerUsageHandler(BaseCallbackHandler):
+    """Reports the tokens each LLM call actually used back to its scheduler"""
+    run_inline = True   # Cheap, and must see the calling task's current_request
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def on_llm_end(self, response, **kwargs):
+        usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+        total = usage.get("total_tokens")
+        if total:
+            self.scheduler.record_usage(total)
+
+
+class LLMScheduler(BaseRateLimiter):
+    """
+    Rate limiter shared by every Brain calling the same model, so that N tasks
+    together stay within the provider's limits instead of each getting the
+    full rate. Requests are limited by two token buckets, one for requests
+    per second and one for tokens per minute. Tokens are reserved from an
+    estimate when a call starts and corrected with the usage the provider
+    reports (see SchedulerUsageHandler).
+
+    Waiting calls are served in priority order and, within a priority, round
+    robin across tasks: a task that has already had many calls granted queues
+    behind one that has had few. Plugged into a chat model as its
+    `rate_limiter`, the model calls `acquire()` before every request; wrap the
+    call in `request()` to say which task it's for.
+    """
+    def __init__(self, name, requests_per_second, tokens_per_minute, max_burst=MAX_BURST):
+        self.name = name
+        self.requests = TokenBucket(requests_per_second, max_burst)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.cond = threading.Condition()
+        self.queue = []             # Heap of ((priority, calls granted to the task, arrival), request, wake)
+        self.arrivals = itertools.count()
+        self.granted_per_task = {}
+        self.paused_until = 0.0
+        self.usage_handler = SchedulerUsageHandler(self)
+
+        # Metrics for !debug
+        self.total_granted = 0
+        self.granted_by_priority = {}
+        self.total_tokens = 0
+        self.max_queue_depth = 0
+        self.recent_waits = deque(maxlen=WAIT_SAMPLES)
+        self.total_wait = 0.0
+        self.total_pauses = 0
+
+    @contextmanager
+    def request(self, task=None, priority=PRIORITY_INTERACTIVE, tokens=0):
+        """Attribute the LLM calls made inside this block to `task`"""
+        token = current_request.set(LLMRequest(task, priority, tokens))
+        try:
+            yield current_request.get()
+        finally:
+            current_request.reset(token)
+
+    def _enqueue(self, request, wake=None):
+        # Called with self.cond held
+        key = (request.priority, self.granted_per_task.get(request.task, 0), next(self.arrivals))
+        entry = (key, request, wake)
+        heapq.heappush(self.queue, entry)
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        return entry
+
+    def _poll(self, entry, enqueued):
+        """
+        Grant `entry` if it's at the front of the queue and the budget allows.
+        Returns 0 once granted, otherwise the seconds to wait before trying
+        again, or None to wait until woken. Called with self.cond held.
+        """
+        if self.queue[0] is not entry:
+            return None
+        request = entry[1]
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        wait = max(self.paused_until - now, self.requests.time_until(1), self.tokens.time_until(request.tokens))
+        if wait > 0:
+            return wait
+        heapq.heappop(self.queue)
+        self._grant(request, now - enqueued)
+        self._notify()
+        return 0
+
+    def _remove(self, entry):
+        # Called with self.cond held
+        if entry in self.queue:
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            self._notify()
+
+    def _notify(self):
+        """Wake every waiter to check whether it's its turn. Called with self.cond held."""
+        self.cond.notify_all()
+        for _, _, wake in self.queue:
+            if wake is not None:
+                wake()
+
+    def acquire(self, *, blocking=True):
+        """Wait for this call's turn and for the budget to make it"""
+        request = current_request.get() or LLMRequest()
+        enqueued = time.monotonic()
+        with self.cond:
+            entry = self._enqueue(request)
+            while True:
+                wait = self._poll(entry, enqueued)
+                if wait == 0:
+                    return True
+                if not blocking:
+                    self._remove(entry)
+                    return False
+                self.cond.wait(timeout=wait)
+
+    async def aacquire(self, *, blocking=True):
+        """`acquire()` for async callers, waiting on the event loop rather than in a thread"""
+        request = current_request.get() or LLMRequest()
+        enqueued = time.monotonic()
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        wake = lambda: loop.call_soon_threadsafe(woken.set)
+        with self.cond:
+            entry = self._enqueue(request, wake)
+        try:
+            while True:
+                with self.cond:
+                    woken.clear()
+                    wait = self._poll(entry, enqueued)
+                    if wait == 0:
+                        return True
+                    if not blocking:
+                        self._remove(entry)
+                        return False
+                try:
+                    await asyncio.wait_for(woken.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            with self.cond:
+                self._remove(entry)
+            raise
+
+    def _grant(self, request, waited):
+        self.requests.take(1)
+        self.tokens.take(request.tokens)
+        self.granted_per_task[request.task] = self.granted_per_task.get(request.task, 0) + 1
+        self.granted_by_priority[request.priority] = self.granted_by_priority.get(request.priority, 0) + 1
+        self.total_granted += 1
+        self.total_wait += waited
+        self.recent_waits.append(waited)
+
+    def record_usage(self, total_tokens):
+        """Charge the tokens a call actually used, less what was reserved for it"""
+        request = current_request.get()
+        reserved = request.tokens if request else 0
+        if request:
+            request.used_tokens += total_tokens
+        with self.cond:
+            self.total_tokens += total_tokens
+            self.tokens.take(total_tokens - reserved)
+            if request:
+                request.tokens = 0  # Only the first call of a request uses the reservation
+            self._notify()
+
+    def pause(self, seconds):
+        """Hold every caller back, e.g. after the provider answered 429"""
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.total_pauses += 1
+            self._notify()
+
+    def paused_for(self):
+        """Seconds left of the current pause, 0 if not paused"""
+        with self.cond:
+            return max(self.paused_until - time.monotonic(), 0.0)
+
+    def forget_task(self, task):
+        """Drop a finished task's fairness counter"""
+        with self.cond:
+            self.granted_per_task.pop(task, None)
+
+    def get_stats(self):
+        with self.cond:
+            waits = sorted(self.recent_waits)
+            return {
+                "queue_depth": len(self.queue),
+                "max_queue_depth": self.max_queue_depth,
+                "granted": self.total_granted,
+                "interactive": self.granted_by_priority.get(PRIORITY_INTERACTIVE, 0),
+                "background": self.granted_by_priority.get(PRIORITY_BACKGROUND, 0),
+                "avg_wait": round(self.total_wait / self.total_granted, 2) if self.total_granted else 0.0,
+                "p95_wait": round(waits[int(len(waits) * 0.95)], 2) if waits else 0.0,
+                "tokens": self.total_tokens,
+                "token_budget": int(self.tokens.level),
+                "pauses": self.total_pauses,
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(model):
+    """The process-wide scheduler for a model, created on first use"""
+    with _schedulers_lock:
+        if model not in _schedulers:
+            limits = MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+            _schedulers[model] = LLMScheduler(model, **{name: limit * LIMIT_SCALE for name, limit in limits.items()})
+        return _schedulers[model]
+
+
+def get_all_stats():
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {scheduler.name: scheduler.get_stats() for scheduler in schedulers}
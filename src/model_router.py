@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque
+
+from llm_scheduler import get_scheduler
+from retry_policy import get_breaker
+
+# Which size of model each graph node (and the single-shot agent) runs on.
+# Planning decides what the whole task does, so it gets the large model;
+# turning a plan step into a command and summarising the step log don't need it.
+ROUTE_TIERS = {
+    "planning": "large",
+    "replanning": "large",
+    "execution": "small",
+    "summarize": "small",
+    "single_shot": "small",
+}
+# The model of each size per provider; a route fails over to the other provider
+TIER_MODELS = {
+    "large": {"mistral": "mistral-large-latest", "openai": "gpt-4o"},
+    "small": {"mistral": "mistral-small-latest", "openai": "gpt-4o-mini"},
+}
+MODEL_PROVIDERS = {model: provider for models in TIER_MODELS.values() for provider, model in models.items()}
+
+OUTCOME_SAMPLES = 20        # Recent calls per route and model the 429 rate is taken over
+ROUTING_WINDOW = 120.0      # Seconds a call counts towards routing, so a passed over model gets tried again
+RATE_LIMITED_SHARE = 0.3    # A model with more of its recent calls rate limited than this is passed over
+MIN_LATENCY_SAMPLES = 5     # Recent calls on a route before its latency is compared with the other provider's
+SLOWER_RATIO = 2.0          # A model this many times slower than the other provider's on a route is passed over
+LATENCY_SAMPLES = 200       # Recent latencies kept per route and model for the metrics
+
+
+def provider_of(model):
+    return MODEL_PROVIDERS.get(model, "openai" if model.startswith("gpt") else "mistral")
+
+
+class RouteStats:
+    """Latencies and 429s of one model on one route"""
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.recent = deque(maxlen=OUTCOME_SAMPLES)  # (time, seconds or None if it was rate limited) per call
+        self.calls = 0
+        self.rate_limited = 0
+
+    def _recent(self):
+        since = time.monotonic() - ROUTING_WINDOW
+        return [seconds for at, seconds in self.recent if at >= since]
+
+    def rate_limited_share(self):
+        recent = self._recent()
+        return sum(seconds is None for seconds in recent) / len(recent) if recent else 0.0
+
+    def recent_latency(self):
+        """Average latency of the recent calls, or None until there are enough to go by"""
+        recent = [seconds for seconds in self._recent() if seconds is not None]
+        return sum(recent) / len(recent) if len(recent) >= MIN_LATENCY_SAMPLES else None
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _route_stats(route, model):
+    # Called with _stats_lock held
+    return _stats.setdefault((route, model), RouteStats())
+
+
+def route_models(route, preferred=None):
+    """
+    The models to try for `route`, best first. The model of `preferred`'s
+    provider comes first, unless it's throttled (its scheduler is paused
+    after a 429, its provider's circuit breaker is open, or many of its
+    recent calls were rate limited) or it has
+    been much slower than the other provider's model on this route lately.
+    """
+    tier = TIER_MODELS[ROUTE_TIERS[route]]
+    preferred_provider = provider_of(preferred) if preferred else "mistral"
+    models = sorted(tier.values(), key=lambda model: provider_of(model) != preferred_provider)
+    with _stats_lock:
+        latencies = {model: _route_stats(route, model).recent_latency() for model in models}
+        throttled = {
+            model: get_scheduler(model).paused_for() > 0
+            or get_breaker(provider_of(model)).state() == "open"
+            or _route_stats(route, model).rate_limited_share() > RATE_LIMITED_SHARE
+            for model in models
+        }
+
+    def penalty(model):
+        if throttled[model]:
+            return 2
+        others = [latencies[other] for other in models if other != model and latencies[other] is not None and not throttled[other]]
+        if latencies[model] is not None and others and latencies[model] > SLOWER_RATIO * min(others):
+            return 1
+        return 0
+
+    return sorted(models, key=penalty)
+
+
+def record_call(route, model, seconds=None, rate_limited=False):
+    """Record a call on `route`: how long it took, or that the provider rate limited it"""
+    with _stats_lock:
+        stats = _route_stats(route, model)
+        stats.calls += 1
+        if rate_limited:
+            stats.rate_limited += 1
+            stats.recent.append((time.monotonic(), None))
+        elif seconds is not None:
+            stats.latencies.append(seconds)
+            stats.recent.append((time.monotonic(), seconds))
+
+
+def get_route_stats():
+    with _stats_lock:
+        stats = {}
+        for (route, model), route_stats in sorted(_stats.items()):
+            if not route_stats.calls:
+                continue
+            times = sorted(route_stats.latencies)
+            stats[f"{route}/{model}"] = {
+                "calls": route_stats.calls,
+                "rate_limited": route_stats.rate_limited,
+                "avg": round(sum(times) / len(times), 2) if times else 0.0,
+                "p95": round(times[int(len(times) * 0.95)], 2) if times else 0.0,
+            }
+        return stats
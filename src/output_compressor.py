@@ -0,0 +1,274 @@
+import re
+from dataclasses import dataclass
+
+# CSI sequences (colours, cursor movement), OSC sequences (window titles,
+# hyperlinks) and the remaining two-character escapes
+ANSI_RE = re.compile(r"\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)?|\x1b[@-Z\\-_]")
+# Parts of a line that vary between otherwise identical lines: hex addresses,
+# hashes and numbers. Lines equal after masking these count as near-duplicates.
+VARYING_RE = re.compile(r"0x[0-9a-fA-F]+|\b[0-9a-f]{7,}\b|\d+")
+# Lines that start with the same word at the same indentation share a
+# template ("Collecting numpy", "Collecting scipy"), as do progress bars.
+# The word must be followed by text rather than a number, so tables like
+# `ls -l` (permissions, then a link count) keep every row.
+TEMPLATE_RE = re.compile(r"(\s*)(?:([A-Za-z]+(?::#*)?)\s+[^\s#]|([^\w\s])\3{9,})")
+# Lines that keep their own place in the output rather than being folded into a run of templated lines
+NOTABLE_RE = re.compile(r"\b(?:error|warning|fail(?:ed|ure)?|fatal|exception|denied|traceback)\b", re.IGNORECASE)
+CONTROL_RE = re.compile(r"[\x00-\x08\x0b-\x1f\x7f�]")
+LETTER_RE = re.compile(r"[^\W\d_]")
+
+BINARY_THRESHOLD = 0.3      # Share of control/undecodable characters that makes a line binary
+BINARY_OUTPUT_THRESHOLD = 0.1   # ... and that makes a command's whole output binary
+MAX_REPEAT_PERIOD = 4       # Longest block of lines checked for repetition
+MIN_SIMILAR_REPEATS = 5     # Near-duplicate blocks in a row before they're collapsed
+MIN_SIMILAR_LETTERS = 3     # Lines need this many letters to count as near-duplicates, so data isn't collapsed
+MIN_TEMPLATE_RUN = 12       # Lines in a run sharing at most MAX_REPEAT_PERIOD templates before it's collapsed
+TEMPLATE_RUN_KEEP = 3       # Lines kept at each end of a collapsed templated run
+TRACEBACK_KEEP_FRAMES = 4   # Innermost traceback frames kept when summarising one
+TRACEBACK_HEADER = "Traceback (most recent call last):"
+
+
+@dataclass
+class OutputEntry:
+    """A line of compressed output, standing for lines `first_line` to `last_line` of the original"""
+    stream: str
+    text: str
+    first_line: int
+    last_line: int
+
+
+@dataclass
+class CompressedOutput:
+    entries: list[OutputEntry]
+    original_chars: int
+    compressed_chars: int
+    binary_lines: int = 0
+
+    @property
+    def ratio(self):
+        """How many times smaller the output got"""
+        return self.original_chars / max(self.compressed_chars, 1)
+
+    @property
+    def text(self):
+        return "\n".join(entry.text for entry in self.entries)
+
+
+def clean_line(line):
+    """
+    Strip ANSI escape codes and resolve carriage returns the way a terminal
+    would show them, so a progress bar redrawn with `\\r` keeps only its
+    final state.
+    """
+    if "\x1b" in line:
+        line = ANSI_RE.sub("", line)
+    if "\r" in line:
+        line = line.rstrip("\r").rsplit("\r", 1)[-1]
+    return line
+
+
+def is_binary(line):
+    if not line:
+        return False
+    return len(CONTROL_RE.findall(line)) / len(line) > BINARY_THRESHOLD
+
+
+def compress_output(lines, first_line=1):
+    """
+    Compress command output, given as (stream, line) pairs, for an LLM. On top
+    of `clean_line` this replaces binary data with a note, summarises long
+    Python tracebacks and collapses runs of repeated or near-duplicate lines
+    (or blocks of up to MAX_REPEAT_PERIOD lines, like compiler warnings with
+    their code excerpts), then long runs of lines that only share a template,
+    like a pip install's `Collecting ...` and `Downloading ...` lines.
+    Entries keep the original line numbers they cover, counting from
+    `first_line`.
+    """
+    cleaned = [(stream, clean_line(line)) for stream, line in lines]
+    original_chars = sum(len(line) + 1 for _, line in lines)
+
+    # Binary files dumped to the terminal (a `cat` of a .pyc) mix binary with
+    # readable strings line by line, so judge the output as a whole first
+    joined = "\n".join(text for _, text in cleaned)
+    control_chars = len(CONTROL_RE.findall(joined))
+    if cleaned and control_chars > BINARY_OUTPUT_THRESHOLD * len(joined):
+        note = OutputEntry(
+            cleaned[0][0],
+            f"[binary output: {len(lines)} lines, {original_chars} chars not shown; inspect it with a tool like `xxd` or `strings`]",
+            first_line,
+            first_line + len(lines) - 1,
+        )
+        return CompressedOutput([note], original_chars, len(note.text) + 1, binary_lines=len(lines))
+
+    entries = []
+    binary_lines = 0
+    for number, (stream, text) in enumerate(cleaned, first_line):
+        if control_chars and is_binary(text):
+            binary_lines += 1
+            # Consecutive binary lines become a single note
+            last = entries[-1] if entries else None
+            if last is not None and last.text.startswith("[binary data") and last.last_line == number - 1:
+                last.last_line = number
+                last.text = f"[binary data: {last.last_line - last.first_line + 1} lines not shown]"
+                continue
+            text = "[binary data: 1 lines not shown]"
+        entries.append(OutputEntry(stream, text, number, number))
+
+    entries = _summarise_tracebacks(entries)
+    entries = _collapse_repeats(entries)
+    entries = _collapse_templated(entries)
+    return CompressedOutput(
+        entries=entries,
+        original_chars=original_chars,
+        compressed_chars=sum(len(entry.text) + 1 for entry in entries),
+        binary_lines=binary_lines,
+    )
+
+
+def _summarise_tracebacks(entries):
+    """Keep the outermost and the innermost frames of long Python tracebacks"""
+    if not any(entry.text == TRACEBACK_HEADER for entry in entries):
+        return entries
+
+    result = []
+    i = 0
+    while i < len(entries):
+        entry = entries[i]
+        result.append(entry)
+        i += 1
+        if entry.text != TRACEBACK_HEADER:
+            continue
+
+        # Frames are a `  File ...` line followed by indented source lines;
+        # the traceback ends at the first unindented line (the exception)
+        frames = []
+        while i < len(entries) and entries[i].text.startswith(" "):
+            if entries[i].text.startswith("  File ") or not frames:
+                frames.append([])
+            frames[-1].append(entries[i])
+            i += 1
+
+        if len(frames) <= TRACEBACK_KEEP_FRAMES + 2:
+            kept = [line for frame in frames for line in frame]
+        else:
+            omitted = frames[1:-TRACEBACK_KEEP_FRAMES]
+            marker = OutputEntry(
+                omitted[0][0].stream,
+                f"  [... {len(omitted)} frames omitted (lines {omitted[0][0].first_line}-{omitted[-1][-1].last_line}) ...]",
+                omitted[0][0].first_line,
+                omitted[-1][-1].last_line,
+            )
+            kept = frames[0] + [marker] + [line for frame in frames[-TRACEBACK_KEEP_FRAMES:] for line in frame]
+        result.extend(kept)
+    return result
+
+
+def _collapse_repeats(entries):
+    """
+    Collapse runs of lines, or of blocks of lines, that repeat. Exact repeats
+    of a single line become one line with a count; near-duplicates keep the
+    first and last block around a note of how many were left out.
+    """
+    signatures = []
+    for entry in entries:
+        masked = VARYING_RE.sub("#", entry.text)
+        # Lines that are mostly numbers are data; only collapse them if they're exact repeats
+        if len(LETTER_RE.findall(masked)) < MIN_SIMILAR_LETTERS:
+            masked = entry.text
+        signatures.append((entry.stream, masked))
+    result = []
+    i = 0
+    n = len(entries)
+    while i < n:
+        best_period, best_repeats = 1, 1
+        for period in range(1, MAX_REPEAT_PERIOD + 1):
+            if i + 2 * period > n:
+                break
+            if signatures[i + period] != signatures[i]:
+                continue  # Cheap check before comparing whole blocks
+            if period > 1 and best_period == 1 and best_repeats >= period:
+                continue  # The block is one line repeated, which period 1 already covers
+            # The run goes on for as long as every line matches the one a period earlier
+            j = i + period
+            while j < n and signatures[j] == signatures[j - period]:
+                j += 1
+            repeats = (j - i) // period
+            if repeats > 1 and repeats * period > best_repeats * best_period:
+                best_period, best_repeats = period, repeats
+
+        covered = best_period * best_repeats
+        run = entries[i:i + covered]
+        if best_period == 1 and best_repeats > 1 and all(entry.text == run[0].text for entry in run):
+            result.append(OutputEntry(
+                run[0].stream,
+                f"{run[0].text} [repeated {best_repeats} times]",
+                run[0].first_line,
+                run[-1].last_line,
+            ))
+        elif best_repeats >= MIN_SIMILAR_REPEATS:
+            omitted = run[best_period:-best_period]
+            unit = "similar lines" if best_period == 1 else f"similar blocks of {best_period} lines"
+            result.extend(run[:best_period])
+            result.append(OutputEntry(
+                omitted[0].stream,
+                f"[... {best_repeats - 2} {unit} omitted (lines {omitted[0].first_line}-{omitted[-1].last_line}) ...]",
+                omitted[0].first_line,
+                omitted[-1].last_line,
+            ))
+            result.extend(run[-best_period:])
+        else:
+            result.append(entries[i])
+            covered = 1
+        i += covered
+    return result
+
+
+def _template(entry):
+    """
+    The template of a line: its stream, indentation and first word (with any
+    `:<number>` after it, like apt's `Get:12`), or that it's a progress bar.
+    None for other lines and for lines worth keeping, like errors.
+    """
+    if NOTABLE_RE.search(entry.text):
+        return None
+    match = TEMPLATE_RE.match(VARYING_RE.sub("#", entry.text))
+    if match is None:
+        return None
+    return entry.stream, match.group(1), match.group(2) or "[progress bar]"
+
+
+def _collapse_templated(entries):
+    """
+    Collapse long runs of lines that differ in more than numbers but follow
+    the same few templates (see `_template`), like the package names in
+    `Collecting <package>` or `Requirement already satisfied: <package>`
+    lines. A run of at least MIN_TEMPLATE_RUN lines, drawn from at most
+    MAX_REPEAT_PERIOD templates, keeps TEMPLATE_RUN_KEEP lines at each end
+    around a note of how many were left out.
+    """
+    templates = [_template(entry) for entry in entries]
+    result = []
+    i = 0
+    n = len(entries)
+    while i < n:
+        seen = set()
+        j = i
+        while j < n and templates[j] is not None and (templates[j] in seen or len(seen) < MAX_REPEAT_PERIOD):
+            seen.add(templates[j])
+            j += 1
+        if j - i < MIN_TEMPLATE_RUN:
+            result.append(entries[i])
+            i += 1
+            continue
+        run = entries[i:j]
+        omitted = run[TEMPLATE_RUN_KEEP:-TEMPLATE_RUN_KEEP]
+        result.extend(run[:TEMPLATE_RUN_KEEP])
+        result.append(OutputEntry(
+            omitted[0].stream,
+            f"[... {len(omitted)} more lines like these omitted (lines {omitted[0].first_line}-{omitted[-1].last_line}) ...]",
+            omitted[0].first_line,
+            omitted[-1].last_line,
+        ))
+        result.extend(run[-TEMPLATE_RUN_KEEP:])
+        i = j
+    return result
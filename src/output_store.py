@@ -0,0 +1,238 @@
+import bisect
+import mmap
+import os
+import re
+import tempfile
+import threading
+import uuid
+from array import array
+from collections import deque
+from dataclasses import dataclass
+
+OUTPUT_STORE_DIR = os.path.join(tempfile.gettempdir(), "megatron_output")
+OUTPUT_RING_LINES = 1000    # Most recent lines kept in memory for quick tails
+
+STREAM_CODES = {"stdout": 0, "stderr": 1}
+STREAM_NAMES = ("stdout", "stderr")
+
+
+@dataclass
+class StoredCommand:
+    """Where one command's output lives in an OutputStore"""
+    command_id: int
+    command: str
+    first_line: int             # Index of the command's first line in the store
+    num_lines: int = 0
+    num_bytes: int = 0
+    exit_code: int | None = None
+    finished: bool = False
+
+
+class OutputStore:
+    """
+    Append-only, per-session record of every line of command output. Lines
+    are written to a file on disk and located through an in-memory index of
+    line offsets, so any range of any command's output can be read back in
+    O(1) through an mmap of the file without keeping the text in RAM. The
+    last `ring_lines` lines are also kept in memory for cheap tails.
+
+    Commands are numbered from 1 in the order they were run. Writes can come
+    from InteractiveShell's reader threads and reads from the event loop, so
+    all access goes through a lock.
+    """
+    def __init__(self, directory=OUTPUT_STORE_DIR, ring_lines=OUTPUT_RING_LINES):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"session_{uuid.uuid4().hex}.log")
+        self.file = open(self.path, "w+b")
+        self.lock = threading.Lock()
+
+        self.offsets = array("Q")   # Byte offset of every line in the file
+        self.streams = array("B")   # STREAM_CODES of every line
+        self.size = 0               # Bytes written so far
+        self.commands = []          # StoredCommand per command, indexed by command_id - 1
+        self.recent = deque(maxlen=ring_lines)  # (command_id, stream, line)
+
+        self.map = None
+        self.mapped_size = 0
+        self.error = None           # Set if writing failed; the store stops growing
+        self.closed = False
+
+    def begin_command(self, command):
+        """Start recording a new command's output and return its id"""
+        with self.lock:
+            command_id = len(self.commands) + 1
+            self.commands.append(StoredCommand(command_id, command, first_line=len(self.offsets)))
+            return command_id
+
+    def append(self, stream, lines, raw_lines=None):
+        """
+        Record lines of output of the latest command. `raw_lines` can pass the
+        lines as they were read from the pipe to save encoding them again.
+        """
+        if not lines:
+            return
+        if raw_lines is None:
+            raw_lines = [line.encode(errors="replace") for line in lines]
+        data = b"\n".join(raw_lines) + b"\n"
+
+        with self.lock:
+            if self.closed or self.error or not self.commands:
+                return
+            try:
+                self.file.write(data)
+            except OSError as e:
+                self.error = str(e)
+                return
+
+            pos = self.size
+            offsets = self.offsets
+            for raw in raw_lines:
+                offsets.append(pos)
+                pos += len(raw) + 1
+            self.size = pos
+            self.streams.extend([STREAM_CODES.get(stream, 0)] * len(raw_lines))
+
+            current = self.commands[-1]
+            current.num_lines += len(raw_lines)
+            current.num_bytes += len(data)
+            command_id = current.command_id
+            self.recent.extend((command_id, stream, line) for line in lines[-self.recent.maxlen:])
+
+    def end_command(self, exit_code):
+        """Mark the latest command as done"""
+        with self.lock:
+            if self.commands:
+                self.commands[-1].exit_code = exit_code
+                self.commands[-1].finished = True
+
+    def get_command(self, command_id):
+        """StoredCommand for an id, or None if there's no such command"""
+        with self.lock:
+            if 1 <= command_id <= len(self.commands):
+                return self.commands[command_id - 1]
+            return None
+
+    def last_command(self):
+        with self.lock:
+            return self.commands[-1] if self.commands else None
+
+    def _line_range(self, info, start, end):
+        """Clamp a line range of a command to absolute line indexes into the store"""
+        if end is None or end > info.num_lines:
+            end = info.num_lines
+        start = max(0, min(start, end))
+        return info.first_line + start, info.first_line + end
+
+    def _view(self):
+        """mmap of everything written so far, remapped when the file has grown"""
+        if self.mapped_size != self.size:
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ) if self.size else None
+            self.mapped_size = self.size
+        return self.map
+
+    def _offset(self, line_index):
+        return self.offsets[line_index] if line_index < len(self.offsets) else self.size
+
+    def read_bytes(self, command_id, start=0, end=None):
+        """Bytes `start` to `end` of a command's output, newlines included"""
+        info = self.get_command(command_id)
+        if info is None:
+            return b""
+        with self.lock:
+            if self.closed or info.num_lines == 0:
+                return b""
+            base = self._offset(info.first_line)
+            limit = base + info.num_bytes
+            start = base + max(0, start)
+            end = limit if end is None else min(limit, base + end)
+            view = self._view()
+            return view[start:end] if view is not None and start < end else b""
+
+    def read_lines(self, command_id, start=0, end=None):
+        """Lines `start` to `end` (exclusive, 0-based) of a command's output as (stream, line) pairs"""
+        info = self.get_command(command_id)
+        if info is None:
+            return []
+        with self.lock:
+            if self.closed:
+                return []
+            first, last = self._line_range(info, start, end)
+            if first >= last:
+                return []
+            view = self._view()
+            text = view[self._offset(first):self._offset(last)].decode(errors="replace")
+            lines = text.split("\n")[:-1]
+            return [(STREAM_NAMES[code], line) for code, line in zip(self.streams[first:last], lines)]
+
+    def grep(self, command_id, pattern, max_matches=100):
+        """
+        Lines of a command's output matching the regular expression `pattern`
+        (matched as a literal string if it isn't valid), searched in the mmap
+        without decoding the rest of the output. Returns up to `max_matches`
+        (line number, stream, line) tuples with 0-based line numbers, and the
+        total number of matching lines.
+        """
+        info = self.get_command(command_id)
+        if info is None:
+            return [], 0
+        try:
+            regex = re.compile(pattern.encode(errors="replace"), re.MULTILINE)
+        except re.error:
+            regex = re.compile(re.escape(pattern.encode(errors="replace")), re.MULTILINE)
+
+        with self.lock:
+            if self.closed or info.num_lines == 0:
+                return [], 0
+            view = self._view()
+            first, last = info.first_line, info.first_line + info.num_lines
+            start, end = self._offset(first), self._offset(last)
+
+            matches = []
+            total = 0
+            pos = start
+            while pos < end:
+                match = regex.search(view, pos, end)
+                if match is None:
+                    break
+                # Map the match back to its line through the offset index
+                index = bisect.bisect_right(self.offsets, match.start(), first, last) - 1
+                line_end = self._offset(index + 1)
+                total += 1
+                if len(matches) < max_matches:
+                    line = view[self.offsets[index]:line_end - 1].decode(errors="replace")
+                    matches.append((index - first, STREAM_NAMES[self.streams[index]], line))
+                pos = line_end  # Each line counts once
+            return matches, total
+
+    def tail(self, count=20):
+        """The last `count` lines recorded, from memory, as (command_id, stream, line)"""
+        with self.lock:
+            return list(self.recent)[-count:]
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "commands": len(self.commands),
+                "lines": len(self.offsets),
+                "bytes": self.size,
+                "index_bytes": self.offsets.itemsize * len(self.offsets) + len(self.streams),
+                "error": self.error,
+            }
+
+    def close(self):
+        """Stop recording and delete the session's file"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
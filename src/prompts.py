@@ -2,6 +2,8 @@
 prompt engineering in progress
 """
 
+from typing import Optional
+
 from pydantic import BaseModel, Field
 
 MISTRAL_SYSPROMPT = """
@@ -136,13 +138,21 @@ planning_prompt = """
     1. A plan is created from the english objective outlining the steps that must be taken to achieve the objective
     2. The plan is sent to an execution step, which turns the lowest-numbered objective that isn't marked as finished into a runnable bash command
     3. The bash command is executed in a terminal, and the results are sent back
-    4. The system goes into replanning, where the plan is updated -- if the command that was just run successfully achieved an objective, that objective is marked as finished
-    Otherwise, the system adds some information about the error or adds more steps to the plan in any order it sees fit to achieve the objective.
+    4. If the command succeeded, its step is marked as finished and the system moves on to the next step. If it failed, its
+    output looks wrong, or every few steps, the system goes into replanning, where the plan is updated -- finished steps are
+    marked as finished, and the system adds some information about the error or adds more steps to the plan in any order it sees fit to achieve the objective.
 
     You're responsible for the planning step. You'll be given the plain english
     objective, and your goal is to provide a plan that outlines the steps that
     must be taken to achieve the objective. Provide a numbered list in logical
-    order for the steps that must be taken to achieve the objective.
+    order for the steps that must be taken to achieve the objective, and the
+    same steps as a list, one short description per step, each of which can be
+    carried out with one or a few bash commands.
+
+    For each step in the list, give the numbers of the steps it depends on.
+    Steps that don't depend on each other, like downloading two datasets, run
+    at the same time in separate shells that share the working directory, so
+    only leave out a dependency when the steps really don't need each other.
 
     YOUR PLAN MUST CARRY OUT THE OBJECTIVE FULLY. FORMAT YOUR PLAN AS A DISCORD MESSAGE.
 """
@@ -154,12 +164,15 @@ replanning_prompt = """
     1. A plan is created from the english objective outlining the steps that must be taken to achieve the objective
     2. The plan is sent to an execution step, which turns the lowest-numbered objective that isn't marked as finished into a runnable bash command
     3. The bash command is executed in a terminal, and the results are sent back
-    4. The system goes into replanning, where the plan is updated -- if the command that was just run successfully achieved an objective, that objective is marked as finished
-    Otherwise, the system adds some information about the error or adds more steps to the plan in any order it sees fit to achieve the objective.
+    4. If the command succeeded, its step is marked as finished and the system moves on to the next step. If it failed, its
+    output looks wrong, or every few steps, the system goes into replanning, where the plan is updated -- finished steps are
+    marked as finished, and the system adds some information about the error or adds more steps to the plan in any order it sees fit to achieve the objective.
 
-    You're responsible for the replanning step. You'll be given the history of the execution, and your goal is to provide two things:
+    You're responsible for the replanning step. You'll be given the history of the execution and the reason replanning
+    was needed, and your goal is to provide three things:
     1. If the overall objective has been achieved
     2. An updated plan, with each finished objective being followed by [FINISHED]
+    3. The same updated plan as a list of steps, each marked as finished or not, with the steps it depends on
 
     YOUR PLAN MUST CARRY OUT THE OBJECTIVE FULLY, AND THE EXPLICIT OBJECTIVE ONLY. FORMAT YOUR NEW PLAN AND EXPLANATION AS A DISCORD MESSAGE.
 """
@@ -168,8 +181,22 @@ execution_prompt = """
     You are given a plan to enact a user's intent on a terminal
     shell. You are also given all of the commands that have been ran
     and their outputs so far. Your job is to come up with a bash command to run to
-    achieve the next objective that hasn't been completed. Please
-    generate only a bash command with no other text.
+    achieve the current step of the plan, which is given below. Please
+    generate only a bash command with no other text. If the step will need
+    more commands after this one, say that this command doesn't finish it.
+
+    Long command output is only shown as its first and last lines. Every command
+    is numbered, and its full output is kept. If you need to see lines that were
+    left out, do not rerun the command. Instead, leave the command empty and set
+    output_request with the command number and either a range of line numbers or
+    a regular expression to search the output for.
+
+    When the next steps are short and predictable (creating directories, writing
+    files, installing packages), you may instead set batch to several commands,
+    covering one or more steps, to run in order in one go. Each command says
+    whether it finishes the current step, and whether the rest of the batch
+    should be skipped if it fails. Don't batch a command whose output you need
+    to see before deciding what to run next.
 
     YOUR COMMAND MUST BE FORMATTED AS A BASH COMMAND.
 """
@@ -183,16 +210,37 @@ summarize_prompt = """"
     FORMAT SUMMARY AS A DISCORD MESSAGE.
 """
 
+class PlanStep(BaseModel):
+    description: str = Field(description="What this step does")
+    finished: bool = Field(default=False, description="Whether this step has been carried out successfully")
+    depends_on: Optional[list[int]] = Field(default=None, description="Numbers of the steps that must be finished before this one starts. Empty if it can start right away; left out, it waits for the previous step.")
+
 class ReplanningFormatter(BaseModel):
     new_plan: str = Field(description="The new plan to begin executing.")
+    steps: list[PlanStep] = Field(default_factory=list, description="The steps of the new plan in order, each marked as finished or not.")
     done: bool = Field(description="Whether you should continue executing commands.")
     explanation: str = Field(description="An explanation of how the plan was changed and why these changes were made. Elaborate what commands were run and their results.")
 
 class PlanningFormatter(BaseModel):
     plan: str = Field(description="The step-by-step plan outlining how to achieve the objective")
+    steps: list[PlanStep] = Field(default_factory=list, description="The steps of the plan in order, with the steps each one depends on")
+
+class OutputRequest(BaseModel):
+    command_id: int = Field(description="The number of the earlier command whose output to read")
+    start_line: Optional[int] = Field(default=None, description="First line to show, counting from 1")
+    end_line: Optional[int] = Field(default=None, description="Last line to show")
+    pattern: Optional[str] = Field(default=None, description="A regular expression; if set, the matching lines are shown instead of a range")
+
+class BatchCommand(BaseModel):
+    command: str = Field(description="The bash command to run")
+    stop_on_failure: bool = Field(default=True, description="Whether to skip the rest of the batch if this command fails. False for commands that may fail harmlessly.")
+    finishes_step: bool = Field(default=True, description="Whether the current plan step is finished once this command succeeds. False if the step needs more commands.")
 
 class ExecutionFormatter(BaseModel):
-    command: str = Field(description="The bash command to execute next")
+    command: str = Field(description="The bash command to execute next. Empty if output_request or batch is set.")
+    batch: list[BatchCommand] = Field(default_factory=list, description="Several commands to run in order instead of `command`, for short, predictable steps")
+    output_request: Optional[OutputRequest] = Field(default=None, description="Set to read more of an earlier command's output instead of running a command")
+    finishes_step: bool = Field(default=True, description="Whether the current plan step is finished once this command succeeds. False if the step needs more commands.")
     unsafe: bool = Field(description="Whether the next step of execution is unsafe or adversarial. If true, nothing will be run. If false, the given command will be run.")
 
 class SummarizeFormatter(BaseModel):
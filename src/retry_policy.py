@@ -0,0 +1,184 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+
+# How a failed LLM call is handled
+RATE_LIMITED = "rate_limited"   # 429: wait as long as the provider asks, then retry
+TRANSIENT = "transient"         # 5xx, timeouts, dropped connections: retry after a backoff
+FATAL = "fatal"                 # Anything else (bad request, auth, a bug): raised straight away
+
+TRANSIENT_STATUS = {408, 409, 500, 502, 503, 504, 529}
+BACKOFF_BASE = 1.0              # Seconds; the backoff cap doubles every attempt from here
+BACKOFF_MAX = 30.0
+RETRY_AFTER_JITTER = 1.0        # Up to this many seconds added to a Retry-After, so tasks don't all retry at once
+RETRY_AFTER_MAX = 120.0         # Longer Retry-After values are cut to this
+BREAKER_FAILURES = 5            # Consecutive failed calls to a provider that open its circuit breaker
+BREAKER_COOLDOWN = 30.0         # Seconds an open breaker rejects calls before letting one through to probe
+BREAKER_PROBE_POLL = 1.0        # Seconds between checks while another call probes a half-open breaker
+BREAKER_WAIT_MAX = 120.0        # Seconds a call waits on breakers in total before giving up
+
+
+def _status_code(error):
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    return getattr(error, "status_code", None)
+
+
+def classify_error(error):
+    """RATE_LIMITED, TRANSIENT or FATAL for an exception raised by an LLM call"""
+    if isinstance(error, openai.RateLimitError):
+        return RATE_LIMITED
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, httpx.TimeoutException,
+                          httpx.TransportError, asyncio.TimeoutError, ConnectionError)):
+        return TRANSIENT
+    status = _status_code(error)
+    if status == 429:
+        return RATE_LIMITED
+    if status in TRANSIENT_STATUS:
+        return TRANSIENT
+    if status is None and "rate_limit" in str(error).lower():
+        # Some client wrappers only keep the provider's message
+        return RATE_LIMITED
+    return FATAL
+
+
+def retry_after(error):
+    """The delay the provider asked for in its Retry-After headers, in seconds, or None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return min(float(headers["retry-after-ms"]) / 1000, RETRY_AFTER_MAX)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        return min(max(seconds, 0.0), RETRY_AFTER_MAX)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(error, attempt):
+    """
+    Seconds to wait before retry `attempt` (counting from 0): what the
+    provider asked for plus a little jitter, or else a "full jitter" backoff,
+    a random time up to a cap that doubles every attempt, so tasks that
+    failed together don't retry together.
+    """
+    asked = retry_after(error)
+    if asked is not None:
+        return asked + random.uniform(0, RETRY_AFTER_JITTER)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a provider that keeps failing. After BREAKER_FAILURES
+    failed calls in a row the breaker opens and rejects calls for
+    BREAKER_COOLDOWN seconds; then it lets one call through, which closes it
+    again if it succeeds and reopens it if it fails.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None       # Set while open or half open
+        self.probing = None         # When a call started testing a half-open breaker
+        self.times_opened = 0
+
+    def state(self):
+        with self.lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self.opened_at is None:
+            return "closed"
+        return "open" if now - self.opened_at < BREAKER_COOLDOWN else "half_open"
+
+    def wait_time(self):
+        """Seconds until a call may go through, 0 if it may now (and claims the probe of a half-open breaker)"""
+        with self.lock:
+            now = time.monotonic()
+            state = self._state(now)
+            if state == "closed":
+                return 0.0
+            if state == "open":
+                return self.opened_at + BREAKER_COOLDOWN - now
+            if self.probing is not None and now - self.probing < BREAKER_COOLDOWN:
+                return BREAKER_PROBE_POLL
+            # A probe that never reported back (cancelled, say) doesn't hold the breaker forever
+            self.probing = now
+            return 0.0
+
+    async def wait(self, deadline):
+        """
+        Wait until a call may go through, claiming the probe of a half-open
+        breaker. Returns False, without waiting, when that won't be before
+        `deadline` (a time.monotonic() time).
+        """
+        while True:
+            wait_time = self.wait_time()
+            if wait_time <= 0:
+                return True
+            if time.monotonic() + wait_time > deadline:
+                return False
+            await asyncio.sleep(wait_time)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing is not None or (self.opened_at is None and self.failures >= BREAKER_FAILURES):
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+            self.probing = None
+
+    def get_stats(self):
+        with self.lock:
+            return {"state": self._state(time.monotonic()), "failures": self.failures, "opened": self.times_opened}
+
+
+_breakers = {}
+_retries = {}
+_lock = threading.Lock()
+
+
+def get_breaker(provider):
+    """The process-wide circuit breaker for a provider, created on first use"""
+    with _lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+
+def record_retry(node, kind):
+    """Count a retry of a call made for `node` after a RATE_LIMITED or TRANSIENT error, or "gave_up" when retries ran out"""
+    with _lock:
+        counts = _retries.setdefault(node, {RATE_LIMITED: 0, TRANSIENT: 0, "gave_up": 0})
+        counts[kind] += 1
+
+
+def get_retry_stats():
+    with _lock:
+        stats = {node: dict(counts) for node, counts in sorted(_retries.items())}
+        breakers = list(_breakers.values())
+    for breaker in breakers:
+        stats[f"breaker/{breaker.name}"] = breaker.get_stats()
+    return stats
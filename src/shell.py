@@ -4,6 +4,186 @@ import subprocess
 import os
 import signal
 import time
+import re
+import uuid
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+
+from output_store import OUTPUT_RING_LINES
+
+# Every command is followed by a printf of this marker plus a per-invocation id
+# and `$?`. The marker is split across two printf arguments so that tracing
+# (`set -x`) of the printf itself can never look like a completed command.
+SENTINEL_PREFIX = "__MEGATRON_"
+SENTINEL_SUFFIX = "DONE_"
+SENTINEL_RE = re.compile(r"__MEGATRON_DONE_([0-9a-f]{32}):(-?\d+)")
+SENTINEL_BYTES = b"__MEGATRON_DONE_"
+
+READ_CHUNK = 64 * 1024  # Bytes requested per pipe read in AsyncShell
+# Sent to every new shell. Job control gives each command its own process group
+# so it can be interrupted on its own; without an INT trap a non-interactive
+# bash exits when its foreground job dies of SIGINT.
+SHELL_SETUP = "set -m; trap : INT\n"
+
+DEFAULT_TIMEOUT = 30    # Seconds a command may run before it's interrupted
+CANCEL_GRACE = 2        # Seconds a job gets to exit after SIGINT, and again after SIGKILL
+
+CALLBACK_INTERVAL = 0.25    # Minimum seconds between output callbacks while a command runs
+CALLBACK_MAX_LINES = 1000   # Lines passed to the callback per batch; the rest are only counted
+
+MAX_RESULT_BYTES = 1024 * 1024  # Output kept per CommandResult; the rest is only counted
+
+
+def wrap_command(command, marker):
+    """
+    Append the completion sentinel (carrying the exit status) to a command. It
+    is written to both stdout and stderr so that a reader knows when it has
+    seen all of the command's output on each stream.
+    """
+    if not command.endswith('\n'):
+        command += '\n'
+    sentinel = f"printf '%s%s%s:%s\\n' '{SENTINEL_PREFIX}' '{SENTINEL_SUFFIX}' '{marker}' \"$__megatron_rc\""
+    return command + f"__megatron_rc=$?; {sentinel}; {sentinel} >&2\n"
+
+
+def job_process_groups(shell_pid):
+    """
+    Process groups of the jobs a shell is running. The shells run with job
+    control on (`set -m`), so every job gets its own process group and can be
+    signalled without touching the shell itself.
+    """
+    try:
+        with open(f"/proc/{shell_pid}/task/{shell_pid}/children") as f:
+            children = [int(pid) for pid in f.read().split()]
+    except OSError:
+        return set()
+
+    shell_pgid = os.getpgid(shell_pid)
+    groups = set()
+    for pid in children:
+        try:
+            pgid = os.getpgid(pid)
+        except OSError:
+            continue  # Already exited
+        if pgid != shell_pgid:
+            groups.add(pgid)
+    return groups
+
+
+def signal_jobs(shell_pid, sig, exclude=()):
+    """Send `sig` to every job of the shell except the process groups in `exclude`"""
+    groups = job_process_groups(shell_pid) - set(exclude)
+    for pgid in groups:
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            pass
+    return groups
+
+
+class OutputBatcher:
+    """
+    Collects output lines for an output callback and hands them over in
+    batches, at most one every `interval` seconds. A batch keeps up to
+    `max_lines` lines and only counts the rest, so a command printing a
+    million lines costs the callback a few calls a second instead of one per
+    line. `overflow` is the total number of lines the callback never saw.
+    """
+    def __init__(self, interval=CALLBACK_INTERVAL, max_lines=CALLBACK_MAX_LINES):
+        self.interval = interval
+        self.max_lines = max_lines
+        self.lines = []
+        self.skipped = 0
+        self.overflow = 0
+        self.last_flush = 0.0
+
+    def extend(self, lines):
+        room = self.max_lines - len(self.lines)
+        if len(lines) > room:
+            self.skipped += len(lines) - max(room, 0)
+            lines = lines[:max(room, 0)]
+        self.lines.extend(lines)
+
+    def pending(self):
+        return bool(self.lines) or self.skipped > 0
+
+    def next_flush(self):
+        """When the pending batch is due, or None if there is nothing to send"""
+        return self.last_flush + self.interval if self.pending() else None
+
+    def flush(self, callback, force=False):
+        """Pass the pending batch to `callback(lines, skipped)` if it's due (or `force`)"""
+        now = time.monotonic()
+        if not self.pending() or (not force and now < self.last_flush + self.interval):
+            return
+        lines, skipped = self.lines, self.skipped
+        self.lines, self.skipped = [], 0
+        self.overflow += skipped
+        self.last_flush = now
+        if callback:
+            callback(lines, skipped)
+
+
+@dataclass
+class CommandResult:
+    """Outcome of a single command run in a shell"""
+    command: str
+    exit_code: int | None = None    # None if the command didn't finish in time
+    lines: list[tuple[str, str]] = field(default_factory=list)  # (stream, line) in arrival order
+    duration: float = 0.0           # wall time in seconds
+    stdout_bytes: int = 0           # counted even when the output was truncated
+    stderr_bytes: int = 0
+    truncated: bool = False         # True if output beyond MAX_RESULT_BYTES was dropped
+    error: str | None = None        # Shell-level failure, e.g. the shell isn't running
+    cancelled: str | None = None    # "timeout", "idle" or "cancel" if the command was interrupted
+    command_id: int | None = None   # Id of the full output in the shell's OutputStore, if it has one
+    kept_bytes: int = field(default=0, repr=False)
+
+    def add_line(self, stream, line, nbytes=None):
+        """Record a line of output from either stdout or stderr"""
+        if nbytes is None:
+            nbytes = len(line.encode(errors='replace')) + 1
+        if stream == "stderr":
+            self.stderr_bytes += nbytes
+        else:
+            self.stdout_bytes += nbytes
+
+        if self.kept_bytes + nbytes > MAX_RESULT_BYTES:
+            self.truncated = True
+            return
+        self.kept_bytes += nbytes
+        self.lines.append((stream, line))
+
+    @property
+    def finished(self):
+        return self.exit_code is not None
+
+    @property
+    def ok(self):
+        return self.exit_code == 0 and self.error is None
+
+    @property
+    def stdout(self):
+        return "\n".join(line for stream, line in self.lines if stream == "stdout")
+
+    @property
+    def stderr(self):
+        return "\n".join(line for stream, line in self.lines if stream == "stderr")
+
+    @property
+    def output(self):
+        """All output lines as a terminal would show them, plus any shell error"""
+        output = [line for _, line in self.lines]
+        if self.error:
+            output.append(self.error)
+        return output
+
+    @property
+    def text(self):
+        return "\n".join(self.output)
+
+
 class InteractiveShell:
     """
     Class that provides an interactive shell interface with real-time output.
@@ -12,14 +192,26 @@ class InteractiveShell:
     def __init__(self, shell_command='/bin/bash'):
         self.shell_command = shell_command
         self.process = None
-        self.output_buffer = queue.Queue()  # Thread-safe buffer for output lines
+        self.output_buffer = queue.Queue(maxsize=OUTPUT_RING_LINES)  # Most recent output lines; older ones are dropped
         self.output_monitor_thread = None
+        self.error_monitor_thread = None
         self.running = False
         self.lock = threading.Lock()
-        self.prompt_ready = threading.Event()
-        self.callback = None  # Optional callback for output lines
+        self.command_done = threading.Event()
+        self.sentinel_lock = threading.Lock()
+        self.callback = None  # Optional callback for batches of output lines
+        self.batcher = OutputBatcher()
+        self.batch_lock = threading.Lock()  # Both monitor threads add to the batcher
+        self.output_store = None  # Optional OutputStore that keeps every line of output
+        self.cur_store = None  # Store the running command's output is recorded in
         self.shell_ready = False
         self.cur_job = ""
+        self.cur_marker = None  # id of the sentinel we're currently waiting for
+        self.cur_result = None  # CommandResult collecting the running command's output
+        self.pending_streams = set()  # streams whose sentinel hasn't arrived yet
+        self.background_groups = set()  # jobs that were already running when the command started
+        self.last_output_time = 0.0
+        self.last_exit_code = None
         self.num_failures = 0
 
     def start(self):
@@ -28,138 +220,275 @@ class InteractiveShell:
         if self.running:
             return
         
-        # Start the shell process
+        self.running = True
+        self._spawn()
+
+        # Round-trip a no-op so we know the shell is accepting commands
+        self.execute_command(":")
+
+    def _spawn(self):
+        """Start the shell process and monitoring threads for stdout and stderr"""
         self.process = subprocess.Popen(
-            self.shell_command,
+            f"exec {self.shell_command}",  # exec so the jobs are direct children of process.pid
             shell=True,
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+            stderr=subprocess.PIPE,
             stdin=subprocess.PIPE,
             universal_newlines=True,
             bufsize=1,  # Line buffered
             preexec_fn=os.setsid  # Use process group for proper termination
         )
-        
-        self.running = True
-        
-        # Start the monitoring thread
+        self.process.stdin.write(SHELL_SETUP)
+
         self.output_monitor_thread = threading.Thread(
             target=self._output_monitor,
+            args=("stdout", self.process.stdout),
             daemon=False
         )
         self.output_monitor_thread.start()
-
+        self.error_monitor_thread = threading.Thread(
+            target=self._output_monitor,
+            args=("stderr", self.process.stderr),
+            daemon=True
+        )
+        self.error_monitor_thread.start()
         self.shell_ready = True
-        
-        # Send an initial command to get the prompt
-        self.execute_command("echo 'SHELL_READY'")
-    
-    def _output_monitor(self):
-        """Thread function that reads and buffers output lines"""
+
+    def _emit(self, line, stream="stdout"):
+        """Hand a line of command output to the buffer, the current result and the callback"""
+        self.last_output_time = time.monotonic()
+        self._buffer(line)
+        result = self.cur_result
+        if result is not None:
+            result.add_line(stream, line)
+        store = self.cur_store
+        if store is not None:
+            store.append(stream, [line])
+        with self.batch_lock:
+            self.batcher.extend([line])
+            self.batcher.flush(self.callback)
+
+    def _buffer(self, line):
+        """Add a line to `output_buffer`, dropping the oldest line when it's full"""
+        while True:
+            try:
+                self.output_buffer.put_nowait(line)
+                return
+            except queue.Full:
+                try:
+                    self.output_buffer.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _flush_output(self):
+        """Pass any batched output to the callback now"""
+        with self.batch_lock:
+            self.batcher.flush(self.callback, force=True)
+
+    def _notify(self, message):
+        """Pass a message about the shell itself to the callback, after any pending output"""
+        self._flush_output()
+        if self.callback:
+            self.callback([message], 0)
+
+    def _handle_sentinel(self, line, stream):
+        """
+        Check a line for a completion sentinel. Any output printed before the
+        sentinel on the same line (commands without a trailing newline) is
+        emitted as normal output. Returns True if a sentinel was found.
+        """
+        match = SENTINEL_RE.search(line)
+        if not match:
+            return False
+
+        if match.start() > 0:
+            self._emit(line[:match.start()], stream)
+
+        with self.sentinel_lock:
+            if match.group(1) == self.cur_marker:
+                self.pending_streams.discard(stream)
+                if not self.pending_streams:
+                    self.last_exit_code = int(match.group(2))
+                    self.cur_marker = None
+                    if self.cur_store is not None:
+                        self.cur_store.end_command(self.last_exit_code)
+                    self.shell_ready = True
+                    self._flush_output()
+                    self.command_done.set()
+        # Otherwise it's the late sentinel of a command we stopped waiting for
+        return True
+
+    def _output_monitor(self, stream, pipe):
+        """Thread function that reads and buffers output lines from one stream"""
         while self.running and self.process.poll() is None:
             try:
-                line = self.process.stdout.readline()
+                line = pipe.readline()
                 if not line:
                     # End of stream
                     break
                 
                 # Strip the newline
                 line = line.rstrip('\n')
-                
-                print(f'output monitor got line {line}')
-                # Add the line to our buffer
-                self.output_buffer.put(line)
-                
-                # If we have a callback, call it
-                if self.callback:
-                    self.callback(line)
-                
-                # Check if this line indicates the shell is ready for input
-                # TODO: change this to get the actual prompt line from machine
-                if line.endswith('SHELL_READY') or 'sussybaka' in line:
-                    self.prompt_ready.set()
-                    self.shell_ready = True
+
+                # Completion sentinels are never passed on as output
+                if self._handle_sentinel(line, stream):
+                    continue
+
+                self._emit(line, stream)
 
             except (IOError, OSError) as e:
                 # Handle pipe errors (e.g., when process terminates)
                 error_msg = f"[ERROR] Shell output monitoring error: {str(e)}"
-                self.output_buffer.put(error_msg)
-                if self.callback:
-                    self.callback(error_msg)
+                self._buffer(error_msg)
+                self._notify(error_msg)
                 break
     
     def set_output_callback(self, callback_function):
         """
-        Set a callback function to be called for each line of output.
-        The callback takes a single parameter: the line of output.
+        Set a callback function to be called with batches of output. It takes
+        two parameters: a list of output lines and the number of further lines
+        that were left out of the batch (see OutputBatcher).
         """
         self.callback = callback_function
     
-    def execute_command(self, command, wait_for_prompt=True, timeout=10):
+    def execute_command(self, command, wait_for_completion=True, timeout=10, idle_timeout=None):
+        """
+        Send a command to the shell and return a CommandResult. When
+        `wait_for_completion` is set, block until the command's sentinels come
+        back on stdout and stderr. A command that runs longer than `timeout`
+        seconds, or prints nothing for `idle_timeout` seconds, has its jobs
+        interrupted (see `_wait_for_command`) while the shell keeps running.
+        """
+        result = CommandResult(command)
         with self.lock:
 
             if not self.running:
                 error_msg = "[ERROR] Shell is not running"
-                self.output_buffer.put(error_msg)
-                if self.callback:
-                    self.callback(error_msg)
-                return False
+                self._buffer(error_msg)
+                self._notify(error_msg)
+                result.error = error_msg
+                return result
 
             ret = self.process.poll() 
             if ret is not None:
                 error_msg = f"[ERROR] Shell process has terminated, exited w/ err code {ret} after too many failed restart attempts"
                 if self.num_failures > 6:
-                    self.output_buffer.put(error_msg)
-                    if self.callback:
-                        self.callback(error_msg)
-                    return False
+                    self._buffer(error_msg)
+                    self._notify(error_msg)
+                    result.error = error_msg
+                    return result
                 print(error_msg)
                 
-                self.callback("shell process has terminated, attempting to restart (will take a second)")
+                self._notify("shell process has terminated, attempting to restart (will take a second)")
 
                 print('attempting to restart shell')
-                self.process = subprocess.Popen(
-                    self.shell_command,
-                    shell=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    stdin=subprocess.PIPE,
-                    universal_newlines=True,
-                    bufsize=1,  # Line buffered
-                    preexec_fn=os.setsid  # Use process group for proper termination
-                )
-                time.sleep(2)
+                self._spawn()
                 self.num_failures += 1
 
 
-            # Clear the prompt event before sending the command
-            self.prompt_ready.clear()
+            # Clear the completion event before sending the command
+            self.command_done.clear()
+            marker = uuid.uuid4().hex
+            with self.sentinel_lock:
+                self.cur_marker = marker
+                self.pending_streams = {"stdout", "stderr"}
+            self.cur_result = result
+            self.cur_store = self.output_store
+            if self.cur_store is not None:
+                result.command_id = self.cur_store.begin_command(command)
+            self.last_exit_code = None
+            self.background_groups = job_process_groups(self.process.pid)
+            start = time.monotonic()
+            self.last_output_time = start
             
             try:
-                # Add a newline if the command doesn't end with one
-                if not command.endswith('\n'):
-                    command += '\n'
-                
-                # Send the command
-                self.process.stdin.write(command)
+                # Send the command followed by its sentinel
+                self.process.stdin.write(wrap_command(command, marker))
                 self.process.stdin.flush()
 
                 self.cur_job = command
                 self.shell_ready = False
                 
-                # Wait for the prompt if requested
-                if wait_for_prompt:
-                    return self.prompt_ready.wait(timeout=timeout)
-                return True
+                # Wait for the sentinel if requested
+                if wait_for_completion and self._wait_for_command(result, start, timeout, idle_timeout):
+                    result.exit_code = self.last_exit_code
+                result.duration = time.monotonic() - start
+                return result
                 
             except (IOError, OSError) as e:
                 print('excepting')
                 error_msg = f"[ERROR] Failed to send command: {str(e)}"
-                self.output_buffer.put(error_msg)
-                if self.callback:
-                    self.callback(error_msg)
-                return False
+                self._buffer(error_msg)
+                self._notify(error_msg)
+                result.error = error_msg
+                return result
+            finally:
+                if wait_for_completion:
+                    self.cur_result = None
+                    if self.cur_store is not None and not result.finished:
+                        self.cur_store.end_command(None)
     
+    def _wait_for_command(self, result, start, timeout, idle_timeout):
+        """
+        Wait for the running command's sentinel. Past `timeout`, or after
+        `idle_timeout` seconds without output, its jobs get SIGINT and then
+        SIGKILL. If even that doesn't finish it (e.g. a loop running inside
+        bash itself) the shell is killed and restarted on the next command.
+        Returns whether the command finished.
+        """
+        while True:
+            deadlines = []
+            if timeout is not None:
+                deadlines.append(start + timeout)
+            if idle_timeout is not None:
+                deadlines.append(self.last_output_time + idle_timeout)
+            with self.batch_lock:
+                next_flush = self.batcher.next_flush()
+            wakeups = deadlines + ([next_flush] if next_flush is not None else [])
+            wait = max(min(wakeups) - time.monotonic(), 0) if wakeups else None
+
+            if self.command_done.wait(timeout=wait):
+                return True
+            # Lines the monitor threads batched up but didn't get to send
+            with self.batch_lock:
+                self.batcher.flush(self.callback)
+            if timeout is not None and time.monotonic() >= start + timeout:
+                result.cancelled = "timeout"
+                break
+            if idle_timeout is not None and time.monotonic() >= self.last_output_time + idle_timeout:
+                result.cancelled = "idle"
+                break
+
+        if self._interrupt_jobs():
+            return True
+
+        result.error = "[ERROR] Command could not be interrupted, the shell was killed and will restart"
+        try:
+            os.killpg(os.getpgid(self.process.pid), signal.SIGKILL)
+        except OSError:
+            pass
+        return False
+
+    def _interrupt_jobs(self):
+        """SIGINT, then SIGKILL, the running command's jobs. Returns whether it finished."""
+        for sig in (signal.SIGINT, signal.SIGKILL):
+            signal_jobs(self.process.pid, sig, exclude=self.background_groups)
+            if self.command_done.wait(timeout=CANCEL_GRACE):
+                return True
+        return False
+
+    def cancel(self):
+        """
+        Interrupt the command currently running, from another thread, without
+        stopping the shell. Returns False if no command was running.
+        """
+        result = self.cur_result
+        if self.cur_marker is None or result is None:
+            return False
+        result.cancelled = "cancel"
+        self._interrupt_jobs()
+        return True
+
     def get_output(self, block=False, timeout=None):
         try:
             return self.output_buffer.get(block=block, timeout=timeout)
@@ -197,6 +526,8 @@ class InteractiveShell:
             if self.process:
                 if self.process.stdout:
                     self.process.stdout.close()
+                if self.process.stderr:
+                    self.process.stderr.close()
                 if self.process.stdin:
                     self.process.stdin.close()
             
@@ -205,13 +536,367 @@ class InteractiveShell:
                 self.output_monitor_thread.join(timeout=1)
 
 
+class AsyncShell:
+    """
+    asyncio counterpart of InteractiveShell for use on the discord.py event loop.
+    Output is read directly from the subprocess pipe while a command runs, so a
+    shell costs no OS threads and awaiting a command never blocks the loop.
+    """
+    def __init__(self, shell_command='/bin/bash'):
+        self.shell_command = shell_command
+        self.process = None
+        self.running = False
+        self.lock = asyncio.Lock()
+        self.callback = None  # Optional callback for batches of output lines
+        self.batcher = OutputBatcher()
+        self.output_store = None  # Optional OutputStore that keeps every line of output
+        self.last_command_id = None  # Id of the last command in `output_store`
+        self.partial = {"stdout": b"", "stderr": b""}
+        self.dead = False
+        self.cancel_requested = asyncio.Event()
+        self.cur_job = ""
+        self.last_cancelled = None
+        self.last_exit_code = None
+        self.num_failures = 0
+
+    async def start(self):
+        """Start the shell process"""
+        if self.running:
+            return
+
+        self.running = True
+        await self._spawn()
+
+        # Round-trip a no-op so we know the shell is accepting commands
+        await self.run(":")
+
+    def is_alive(self):
+        """Whether the shell process is still usable"""
+        # `dead` covers shells we killed or lost the pipes of but whose exit
+        # asyncio hasn't reported yet (it can wait for the pipes to close)
+        return self.running and not self.dead and self.process.returncode is None
+
+    def cwd(self):
+        """The shell's working directory, or None if it can't be told"""
+        try:
+            return os.readlink(f"/proc/{self.process.pid}/cwd")
+        except (OSError, AttributeError):
+            return None
+
+    async def _spawn(self):
+        self.dead = False
+        self.partial = {"stdout": b"", "stderr": b""}  # Unterminated trailing line per stream
+        self.process = await asyncio.create_subprocess_exec(
+            self.shell_command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=1024 * 1024,  # Allow long lines without overrunning the reader
+            start_new_session=True  # Use process group for proper termination
+        )
+        self.process.stdin.write(SHELL_SETUP.encode())
+
+    def set_output_callback(self, callback_function):
+        """
+        Set a callback function to be called with batches of output. It takes
+        two parameters: a list of output lines and the number of further lines
+        that were left out of the batch (see OutputBatcher).
+        """
+        self.callback = callback_function
+
+    async def stream(self, command, timeout=DEFAULT_TIMEOUT, idle_timeout=None):
+        """
+        Run a command and yield its output lines (stdout and stderr, in arrival
+        order) as they come in. A command that runs longer than `timeout`
+        seconds, or prints nothing for `idle_timeout` seconds, has its jobs
+        interrupted with SIGINT and then SIGKILL while the shell keeps running.
+        Once the iterator is exhausted `last_exit_code` holds the command's
+        exit status, or None if it never finished. Leaving the loop early
+        kills the command's jobs.
+        """
+        async with contextlib.aclosing(self._stream(command, timeout, idle_timeout)) as lines:
+            async for stream, line, _ in lines:
+                yield line
+
+    async def _stream(self, command, timeout, idle_timeout=None):
+        """
+        Run a command and yield (stream, line, nbytes) tuples, where stream is
+        "stdout", "stderr", or "error" for failures of the shell itself.
+        """
+        async with self.lock:
+            self.last_exit_code = None
+            self.last_cancelled = None
+            self.last_command_id = None
+            self.cancel_requested.clear()
+
+            if not self.running:
+                yield "error", "[ERROR] Shell is not running", 0
+                return
+
+            if not self.is_alive():
+                if self.num_failures > 6:
+                    yield "error", f"[ERROR] Shell process has terminated, exited w/ err code {self.process.returncode} after too many failed restart attempts", 0
+                    return
+                print('attempting to restart shell')
+                await self._spawn()
+                self.num_failures += 1
+
+            marker = uuid.uuid4().hex
+            background_groups = job_process_groups(self.process.pid)
+            try:
+                self.process.stdin.write(wrap_command(command, marker).encode())
+                await self.process.stdin.drain()
+            except (IOError, OSError) as e:
+                yield "error", f"[ERROR] Failed to send command: {str(e)}", 0
+                return
+            self.cur_job = command
+            store = self.output_store
+            if store is not None:
+                self.last_command_id = store.begin_command(command)
+
+            readers = {"stdout": self.process.stdout, "stderr": self.process.stderr}
+            pending = {asyncio.ensure_future(reader.read(READ_CHUNK)): name for name, reader in readers.items()}
+            cancel_task = asyncio.ensure_future(self.cancel_requested.wait())
+            exit_code = None
+            completed = set()   # Streams that delivered the sentinel
+            inflight = {}       # Stream -> the read being yielded line by line, with the partial line before it
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout if timeout is not None else None
+            idle_deadline = loop.time() + idle_timeout if idle_timeout is not None else None
+            # Signals still to send if the command has to be interrupted
+            escalation = [signal.SIGINT, signal.SIGKILL]
+            try:
+                # Read until both streams have delivered the sentinel
+                while pending:
+                    now = loop.time()
+                    deadlines = [d for d in (deadline, idle_deadline) if d is not None]
+                    next_flush = self.batcher.next_flush()
+                    wakeups = deadlines + ([next_flush] if next_flush is not None else [])
+                    wait = max(min(wakeups) - now, 0) if wakeups else None
+                    done, _ = await asyncio.wait(list(pending) + [cancel_task], timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                    self.batcher.flush(self.callback)
+
+                    if cancel_task in done or (not done and any(loop.time() >= d for d in deadlines)):
+                        if self.last_cancelled is None:
+                            if cancel_task in done:
+                                self.last_cancelled = "cancel"
+                            elif deadline is not None and loop.time() >= deadline:
+                                self.last_cancelled = "timeout"
+                            else:
+                                self.last_cancelled = "idle"
+                        if cancel_task in done:
+                            done.discard(cancel_task)
+                            cancel_task = asyncio.ensure_future(asyncio.Event().wait())
+
+                        if not escalation:
+                            # Nothing to signal could stop it (e.g. a loop running in bash itself)
+                            yield "error", "[ERROR] Command could not be interrupted, the shell was killed and will restart", 0
+                            try:
+                                os.killpg(os.getpgid(self.process.pid), signal.SIGKILL)
+                            except OSError:
+                                pass
+                            self.dead = True
+                            return
+                        signal_jobs(self.process.pid, escalation.pop(0), exclude=background_groups)
+                        deadline = loop.time() + CANCEL_GRACE
+                        idle_deadline = None
+
+                    for task in done:
+                        stream = pending.pop(task)
+                        try:
+                            data = task.result()
+                        except (ValueError, OSError) as e:
+                            yield "error", f"[ERROR] Shell output monitoring error: {str(e)}", 0
+                            return
+                        if not data:
+                            self.dead = True
+                            yield "error", "[ERROR] Shell process has terminated", 0
+                            return
+
+                        if idle_deadline is not None:
+                            idle_deadline = loop.time() + idle_timeout
+
+                        # Split into complete lines, carrying any partial line over to the next read
+                        data = self.partial[stream] + data
+                        inflight[stream] = data
+                        raw_lines = data.split(b'\n')
+                        self.partial[stream] = raw_lines.pop()
+
+                        stream_done = False
+                        if SENTINEL_BYTES not in data:
+                            # Fast path for bulk output: no line can be a sentinel
+                            lines = b'\n'.join(raw_lines).decode(errors='replace').split('\n') if raw_lines else []
+                            self._record(store, stream, lines, raw_lines)
+                            for raw, line in zip(raw_lines, lines):
+                                yield stream, line, len(raw) + 1
+                            raw_lines = []
+
+                        for i, raw in enumerate(raw_lines):
+                            line = raw.decode(errors='replace')
+                            match = SENTINEL_RE.search(line) if SENTINEL_BYTES in raw else None
+                            if match is None:
+                                self._record(store, stream, [line], [raw])
+                                yield stream, line, len(raw) + 1
+                                continue
+                            if match.start() > 0:
+                                self._record(store, stream, [line[:match.start()]])
+                                yield stream, line[:match.start()], match.start()
+                            if match.group(1) == marker:
+                                # This stream is complete; leave whatever follows for the next command
+                                exit_code = int(match.group(2))
+                                stream_done = True
+                                completed.add(stream)
+                                self.partial[stream] = b'\n'.join(raw_lines[i + 1:] + [self.partial[stream]])
+                                break
+                            # Late sentinels of commands we stopped waiting for are dropped
+
+                        del inflight[stream]
+                        if not stream_done:
+                            pending[asyncio.ensure_future(readers[stream].read(READ_CHUNK))] = stream
+
+                self.last_exit_code = exit_code
+            finally:
+                cancel_task.cancel()
+                unread = dict(inflight)
+                for task, stream in pending.items():
+                    if task.done() and not task.cancelled() and task.exception() is None:
+                        unread[stream] = self.partial[stream] + task.result()
+                    task.cancel()
+                remaining = [stream for stream in readers if stream not in completed]
+                if remaining and not self.dead and self.process.returncode is None:
+                    # We stopped reading before the command finished (the caller left `stream()` early,
+                    # or the task awaiting `run()` was cancelled)
+                    await self._abandon(
+                        marker, {stream: unread.get(stream, self.partial[stream]) for stream in remaining}, background_groups
+                    )
+                self.batcher.flush(self.callback, force=True)
+                if store is not None:
+                    store.end_command(self.last_exit_code)
+
+    async def _abandon(self, marker, unread, background_groups):
+        """
+        Stop a command whose output is no longer read, and read the rest of
+        it up to its sentinel on each of the streams in `unread` (given the
+        bytes read but not yet used up), so none of it is taken for the
+        next command's. If that takes longer than CANCEL_GRACE the shell is
+        killed, and restarts on the next command.
+        """
+        signal_jobs(self.process.pid, signal.SIGKILL, exclude=background_groups)
+        readers = {"stdout": self.process.stdout, "stderr": self.process.stderr}
+        needle = SENTINEL_BYTES + marker.encode()
+
+        async def discard(stream, data):
+            while True:
+                start = data.find(needle)
+                end = data.find(b"\n", start) if start >= 0 else -1
+                if end >= 0:
+                    self.partial[stream] = data[end + 1:]
+                    return
+                if start < 0:
+                    data = data[-len(needle):]  # Only keep what could be the start of the sentinel
+                chunk = await readers[stream].read(READ_CHUNK)
+                if not chunk:
+                    raise ConnectionError("Shell output closed")
+                data += chunk
+
+        drained = False
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[discard(stream, data) for stream, data in unread.items()]), CANCEL_GRACE
+            )
+            drained = True
+        except (asyncio.TimeoutError, ConnectionError, ValueError, OSError):
+            pass
+        finally:
+            if not drained:
+                try:
+                    os.killpg(os.getpgid(self.process.pid), signal.SIGKILL)
+                except OSError:
+                    pass
+                self.dead = True
+
+    def _record(self, store, stream, lines, raw_lines=None):
+        """Pass lines of output on to the callback batcher and the output store"""
+        self.batcher.extend(lines)
+        if store is not None:
+            store.append(stream, lines, raw_lines)
+
+    async def cancel(self, wait=None):
+        """
+        Interrupt the command currently running without stopping the shell.
+        Returns False if no command was running. With `wait`, also waits up to
+        that many seconds for the command to have stopped.
+        """
+        if not self.lock.locked():
+            return False
+        self.cancel_requested.set()
+        if wait:
+            try:
+                await asyncio.wait_for(self.lock.acquire(), wait)
+                self.lock.release()
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    async def run(self, command, timeout=DEFAULT_TIMEOUT, idle_timeout=None):
+        """Run a command to completion (or until it's interrupted) and collect its output"""
+        result = CommandResult(command)
+        start = time.monotonic()
+        async for stream, line, nbytes in self._stream(command, timeout, idle_timeout):
+            if stream == "error":
+                result.error = line
+            else:
+                result.add_line(stream, line, nbytes)
+        result.duration = time.monotonic() - start
+        result.exit_code = self.last_exit_code
+        result.cancelled = self.last_cancelled
+        result.command_id = self.last_command_id
+        return result
+
+    async def run_batch(self, commands, timeout=DEFAULT_TIMEOUT, idle_timeout=None):
+        """
+        Run (command, stop_on_failure) pairs in order and return the results
+        of those that ran. The batch stops after a failed command that has
+        stop_on_failure set, and after any command that was interrupted or
+        that the shell couldn't run. Each command has its own timeouts.
+        """
+        results = []
+        for command, stop_on_failure in commands:
+            result = await self.run(command, timeout, idle_timeout)
+            results.append(result)
+            if result.error or result.cancelled or (stop_on_failure and not result.ok):
+                break
+        return results
+
+    async def stop(self):
+        """Stop the shell process"""
+        if not self.running:
+            return
+        self.running = False
+
+        if self.process and self.process.returncode is None:
+            try:
+                os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
+                await asyncio.wait_for(self.process.wait(), 2)
+            except (asyncio.TimeoutError, OSError):
+                # If it doesn't terminate gracefully, force kill
+                try:
+                    os.killpg(os.getpgid(self.process.pid), signal.SIGKILL)
+                except OSError:
+                    pass
+
+
 def interactive_shell_session():
     """Run an interactive shell session"""
     shell = InteractiveShell()
     
-    # Define callback to print output immediately
-    def print_output(line):
-        print(f"> {line}")
+    # Define callback to print output as it arrives
+    def print_output(lines, skipped):
+        for line in lines:
+            print(f"> {line}")
+        if skipped:
+            print(f"> ... {skipped} more lines")
     
     # Set the callback
     shell.set_output_callback(print_output)
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+
+from shell import AsyncShell
+from output_store import OutputStore
+
+POOL_MIN_IDLE = 2           # Shells kept warm and ready to lease
+POOL_MAX_SIZE = 32          # Upper bound on leased + idle shells
+POOL_IDLE_TIMEOUT = 600     # Seconds before a surplus idle shell is stopped
+POOL_EVICT_INTERVAL = 60    # Seconds between idle eviction sweeps
+POOL_LEASE_TIMEOUT = 120    # Seconds `lease()` waits for a shell to be released when the pool is full
+
+
+class ShellPoolExhausted(Exception):
+    pass
+
+
+class ShellPool:
+    """
+    Keeps a set of started AsyncShells warm so that agent tasks and GUI sessions
+    don't pay for spawning bash. Shells are handed out with `lease()` and must
+    be given back with `release()`, which restores the working directory and
+    environment the shell started with before it is reused. Every lease gets
+    its own OutputStore (`shell.output_store`) recording the session's output,
+    which is deleted on release.
+    """
+    def __init__(self, min_idle=POOL_MIN_IDLE, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.min_idle = min_idle
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        self.idle = []          # (shell, time it was returned) pairs, most recent last
+        self.leased = set()
+        self.spawning = 0       # Shells currently being started
+        self.cond = asyncio.Condition()
+        self.evict_task = None
+        self.refills = set()    # Background `_add_idle_shell()` tasks started by `lease()`
+        self.running = False
+
+        # Statistics for !debug
+        self.total_spawned = 0
+        self.total_leases = 0
+        self.total_evicted = 0
+
+    async def start(self):
+        """Warm up the pool and begin evicting idle shells"""
+        if self.running:
+            return
+        self.running = True
+        await asyncio.gather(*[self._add_idle_shell() for _ in range(self.min_idle)])
+        self.evict_task = asyncio.create_task(self._evict_loop())
+
+    def size(self):
+        return len(self.idle) + len(self.leased) + self.spawning
+
+    async def _spawn(self):
+        """Start a new shell and record the state `release()` restores it to"""
+        shell = AsyncShell()
+        await shell.start()
+        shell.snapshot_path = f"/tmp/megatron_shell_env_{shell.process.pid}"
+        result = await shell.run(f"declare -px > '{shell.snapshot_path}'; pwd")
+        shell.home = result.output[-1] if result.output else "/"
+        self.total_spawned += 1
+        return shell
+
+    async def _add_idle_shell(self):
+        async with self.cond:
+            if self.size() >= self.max_size:
+                return
+            self.spawning += 1
+        try:
+            shell = await self._spawn()
+        finally:
+            async with self.cond:
+                self.spawning -= 1
+        async with self.cond:
+            self.idle.append((shell, time.monotonic()))
+            self.cond.notify()
+
+    async def lease(self, timeout=POOL_LEASE_TIMEOUT):
+        """
+        Hand out a ready shell, starting one if none are idle. Waits up to
+        `timeout` seconds for a shell to be released when the pool is at
+        `max_size`, then raises ShellPoolExhausted.
+        """
+        deadline = time.monotonic() + timeout
+        async with self.cond:
+            while True:
+                # Drop shells that died while sitting idle
+                self.idle = [(s, t) for s, t in self.idle if s.is_alive()]
+                if self.idle:
+                    shell, _ = self.idle.pop()
+                    self.leased.add(shell)
+                    break
+                if self.size() < self.max_size:
+                    self.spawning += 1
+                    shell = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ShellPoolExhausted(f"All {self.max_size} shells are in use")
+                try:
+                    await asyncio.wait_for(self.cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+        if shell is None:
+            try:
+                shell = await self._spawn()
+            finally:
+                async with self.cond:
+                    self.spawning -= 1
+            async with self.cond:
+                self.leased.add(shell)
+
+        self.total_leases += 1
+        shell.output_store = OutputStore()
+
+        # Top the pool back up in the background so the next lease is warm
+        if self.running and len(self.idle) < self.min_idle:
+            task = asyncio.create_task(self._add_idle_shell())
+            self.refills.add(task)
+            task.add_done_callback(self.refills.discard)
+        return shell
+
+    async def release(self, shell):
+        """Return a leased shell to the pool, resetting its cwd and environment"""
+        shell.set_output_callback(None)
+        store, shell.output_store = shell.output_store, None
+        if store is not None:
+            store.close()
+        healthy = self.running and shell.is_alive()
+        if healthy:
+            result = await shell.run(
+                "kill $(jobs -p) 2>/dev/null; set +eux; "
+                "for v in $(compgen -e); do unset \"$v\" 2>/dev/null; done; "
+                f"source '{shell.snapshot_path}' 2>/dev/null; cd '{shell.home}'"
+            )
+            healthy = result.finished
+
+        async with self.cond:
+            self.leased.discard(shell)
+            if healthy:
+                self.idle.append((shell, time.monotonic()))
+            self.cond.notify()
+
+        if not healthy:
+            await self._discard(shell)
+
+    async def _discard(self, shell):
+        await shell.stop()
+        try:
+            os.remove(shell.snapshot_path)
+        except (OSError, AttributeError):
+            pass
+
+    async def _evict_loop(self):
+        while self.running:
+            await asyncio.sleep(POOL_EVICT_INTERVAL)
+            await self.evict_idle()
+
+    async def evict_idle(self):
+        """Stop idle shells beyond `min_idle` that haven't been used recently"""
+        now = time.monotonic()
+        evicted = []
+        async with self.cond:
+            keep = []
+            surplus = len(self.idle) - self.min_idle
+            # Oldest first, so the most recently used shells stay warm
+            for shell, returned_at in self.idle:
+                if len(evicted) < surplus and now - returned_at > self.idle_timeout:
+                    evicted.append(shell)
+                else:
+                    keep.append((shell, returned_at))
+            self.idle = keep
+        for shell in evicted:
+            await self._discard(shell)
+        self.total_evicted += len(evicted)
+
+    async def close(self):
+        """Stop every idle shell. Leased shells are stopped when released."""
+        self.running = False
+        if self.evict_task:
+            self.evict_task.cancel()
+        refills = list(self.refills)
+        for task in refills:
+            task.cancel()
+        await asyncio.gather(*refills, return_exceptions=True)
+        async with self.cond:
+            idle, self.idle = self.idle, []
+        for shell, _ in idle:
+            await self._discard(shell)
+
+    def get_stats(self):
+        stores = [s.output_store.get_stats() for s in self.leased if s.output_store is not None]
+        return {
+            "idle": len(self.idle),
+            "leased": len(self.leased),
+            "spawning": self.spawning,
+            "max_size": self.max_size,
+            "spawned": self.total_spawned,
+            "leases": self.total_leases,
+            "evicted": self.total_evicted,
+            "output_lines": sum(stats["lines"] for stats in stores),
+            "output_bytes": sum(stats["bytes"] for stats in stores),
+        }
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import deque
+
+from langchain_core.utils.json import parse_partial_json
+
+STREAM_EDIT_INTERVAL = 1.0      # Seconds between edits of a live message; Discord rate limits edits per channel
+LIVE_MESSAGE_MAX_CHARS = 1900   # Longer text is cut short while streaming and sent in chunks once complete
+LATENCY_SAMPLES = 200           # Recent time-to-first-output samples kept per node for the metrics
+
+
+class LiveMessage:
+    """
+    One Discord message that shows an LLM response while it streams in. The
+    first update sends it, later ones edit it, at most once every
+    STREAM_EDIT_INTERVAL seconds. Records how long it took from `started`
+    until the user first saw something.
+    """
+    def __init__(self, target, logger, started=None):
+        self.target = target
+        self.logger = logger
+        self.started = started if started is not None else time.monotonic()
+        self.message = None
+        self.text = ""
+        self.last_edit = 0.0
+        self.first_visible = None   # Seconds from `started` to the first message, once sent
+
+    async def update(self, text, force=False):
+        if not text.strip() or text == self.text:
+            return
+        now = time.monotonic()
+        if not force and self.message is not None and now - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        preview = text if len(text) <= LIVE_MESSAGE_MAX_CHARS else text[:LIVE_MESSAGE_MAX_CHARS - 2] + " …"
+        try:
+            if self.message is None:
+                self.message = await self.target.send(preview)
+                self.first_visible = now - self.started
+            else:
+                await self.message.edit(content=preview)
+        except Exception as e:
+            # Showing partial output is best effort; the complete text is still sent at the end
+            self.logger.warning(f"Could not update streamed message: {e}")
+            return
+        self.text = text
+        self.last_edit = now
+
+    async def finish(self, text):
+        """
+        Show the complete text. Returns False if it doesn't fit in one message,
+        after removing the live message, so the caller can send it in chunks.
+        """
+        if len(text) <= LIVE_MESSAGE_MAX_CHARS:
+            await self.update(text, force=True)
+            if self.text == text:
+                return True
+        if self.message is not None:
+            try:
+                await self.message.delete()
+            except Exception as e:
+                self.logger.warning(f"Could not remove streamed message: {e}")
+            self.message = None
+        return False
+
+
+async def astream_structured(llm, schema, messages, on_partial):
+    """
+    Make a structured-output call, streaming it. `llm` is a chat model bound
+    to `schema` as its only tool (see brain.AgentModels); `on_partial(args)`
+    is awaited with the arguments parsed so far whenever a chunk arrives.
+    Returns the validated `schema` instance, like
+    `llm.with_structured_output(schema).ainvoke(messages)` would.
+    """
+    gathered = None
+    parsed = None
+    async for chunk in llm.astream(messages):
+        gathered = chunk if gathered is None else gathered + chunk
+        if not gathered.tool_call_chunks:
+            continue
+        raw = gathered.tool_call_chunks[0].get("args") or ""
+        if raw == parsed:
+            continue
+        parsed = raw
+        args = parse_partial_json(raw) if raw else None
+        if isinstance(args, dict):
+            await on_partial(args)
+    if gathered is None or not gathered.tool_calls:
+        raise ValueError(f"The model did not return a {schema.__name__}")
+    return schema.model_validate(gathered.tool_calls[0]["args"])
+
+
+_first_output = {}
+_first_output_lock = threading.Lock()
+
+
+def record_first_output(node, seconds):
+    """Record how long a streamed call for `node` took to show its first output"""
+    with _first_output_lock:
+        _first_output.setdefault(node, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+
+
+def get_first_output_stats():
+    with _first_output_lock:
+        stats = {}
+        for node, samples in _first_output.items():
+            times = sorted(samples)
+            stats[node] = {
+                "calls": len(times),
+                "avg": round(sum(times) / len(times), 2),
+                "p95": round(times[int(len(times) * 0.95)], 2),
+            }
+        return stats
@@ -0,0 +1,156 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+from llm_scheduler import PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+TASK_MAX_RUNNING = 8        # Agent tasks running at once, across all users
+TASK_MAX_PER_USER = 2       # Agent tasks one user may have running at once
+TASK_MAX_WAITING = 50       # Tasks allowed to wait; beyond this new ones are turned away
+WAIT_SAMPLES = 200          # Recent queue wait times kept for the metrics
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+logger = logging.getLogger("discord")
+
+
+class TaskQueueFull(Exception):
+    pass
+
+
+class TaskTicket:
+    """A task's place in the TaskQueue, from submission until it's released"""
+    def __init__(self, user_id, priority, arrival):
+        self.user_id = user_id
+        self.priority = priority
+        self.arrival = arrival
+        self.submitted_at = time.monotonic()
+        self.admitted = asyncio.Event()
+        self.released = False
+        self.position = None        # 1-based place in the queue while waiting
+        self.on_position = None     # Optional coroutine function called with the new position
+
+
+class TaskQueue:
+    """
+    Admission control for !agent. At most `max_running` tasks run at once,
+    and at most `max_per_user` for any one user; the rest wait. Waiting tasks
+    are admitted by priority lane (interactive before background), then
+    fair share (users with fewer running tasks first), then in order of
+    submission. Tasks hold their slot until `release()`.
+    """
+    def __init__(self, max_running=TASK_MAX_RUNNING, max_per_user=TASK_MAX_PER_USER, max_waiting=TASK_MAX_WAITING):
+        self.max_running = max_running
+        self.max_per_user = max_per_user
+        self.max_waiting = max_waiting
+        self.waiting = []
+        self.running = {}           # user id -> number of running tasks
+        self.arrivals = itertools.count()
+        self.notifications = set()  # Pending `on_position` calls
+
+        # Statistics for !debug
+        self.total_admitted = 0
+        self.total_rejected = 0
+        self.total_cancelled = 0
+        self.recent_waits = deque(maxlen=WAIT_SAMPLES)
+
+    def num_running(self):
+        return sum(self.running.values())
+
+    def submit(self, user_id, priority=PRIORITY_INTERACTIVE):
+        """Queue a task, admitting it right away if there's room. Raises TaskQueueFull."""
+        if len(self.waiting) >= self.max_waiting:
+            self.total_rejected += 1
+            raise TaskQueueFull(f"{len(self.waiting)} tasks are already waiting")
+        ticket = TaskTicket(user_id, priority, next(self.arrivals))
+        self.waiting.append(ticket)
+        self._admit_waiting()
+        return ticket
+
+    async def wait(self, ticket):
+        """
+        Wait until the task may start. Returns False if it was cancelled
+        while waiting; if the waiter itself is cancelled, the task leaves the
+        queue.
+        """
+        try:
+            await ticket.admitted.wait()
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+        return not ticket.released
+
+    def cancel(self, ticket):
+        """Take a task out of the queue, or release it if it was already running"""
+        if ticket in self.waiting:
+            self.waiting.remove(ticket)
+            ticket.released = True
+            ticket.admitted.set()   # Wakes the waiter, which sees it was released
+            self.total_cancelled += 1
+            self._admit_waiting()
+        else:
+            self.release(ticket)
+
+    def release(self, ticket):
+        """Free a running task's slot for the next waiting one. Safe to call more than once."""
+        if ticket.released or not ticket.admitted.is_set():
+            return
+        ticket.released = True
+        self.running[ticket.user_id] -= 1
+        if not self.running[ticket.user_id]:
+            del self.running[ticket.user_id]
+        self._admit_waiting()
+
+    def _order(self, ticket):
+        return (ticket.priority, self.running.get(ticket.user_id, 0), ticket.arrival)
+
+    def _admit_waiting(self):
+        self.waiting.sort(key=self._order)
+        while self.num_running() < self.max_running:
+            ticket = next((t for t in self.waiting if self.running.get(t.user_id, 0) < self.max_per_user), None)
+            if ticket is None:
+                break
+            self.waiting.remove(ticket)
+            self.running[ticket.user_id] = self.running.get(ticket.user_id, 0) + 1
+            self.total_admitted += 1
+            self.recent_waits.append(time.monotonic() - ticket.submitted_at)
+            ticket.position = None
+            ticket.admitted.set()
+            # Admitting a task changes the fair-share order of the rest
+            self.waiting.sort(key=self._order)
+        self._update_positions()
+
+    def _update_positions(self):
+        for position, ticket in enumerate(self.waiting, 1):
+            if ticket.position != position:
+                ticket.position = position
+                if ticket.on_position is not None:
+                    task = asyncio.create_task(ticket.on_position(position))
+                    self.notifications.add(task)
+                    task.add_done_callback(self._notified)
+
+    def _notified(self, task):
+        self.notifications.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Could not report queue position: {task.exception()!r}")
+
+    def get_stats(self):
+        waits = sorted(self.recent_waits)
+        now = time.monotonic()
+        return {
+            "running": self.num_running(),
+            "max_running": self.max_running,
+            "waiting": len(self.waiting),
+            "waiting_by_lane": {
+                name: sum(t.priority == priority for t in self.waiting) for priority, name in PRIORITY_NAMES.items()
+            },
+            "running_by_user": dict(self.running),
+            "admitted": self.total_admitted,
+            "rejected": self.total_rejected,
+            "cancelled": self.total_cancelled,
+            "avg_wait": round(sum(waits) / len(waits), 1) if waits else 0.0,
+            "p95_wait": round(waits[int(len(waits) * 0.95)], 1) if waits else 0.0,
+            "longest_waiting": round(max((now - t.submitted_at for t in self.waiting), default=0.0), 1),
+        }
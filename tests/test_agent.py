@@ -0,0 +1,71 @@
+import pytest
+
+from agent import is_read_only_command, is_simple_task
+
+
+@pytest.mark.parametrize("task", [
+    "what's my disk usage",
+    "how much memory is free",
+    "show the gpu status",
+    "list the files in /tmp",
+    "which python version is installed",
+    "is numpy installed?",
+])
+def test_lookups_are_simple(task):
+    assert is_simple_task(task)
+
+
+@pytest.mark.parametrize("task", [
+    "get rid of all docker containers",
+    "find and rm all .pyc files",
+    "list files in /tmp and wipe them",
+    "check disk usage and kill the biggest process",
+    "find all log files and truncate them",
+    "show the logs, then clear them",
+    "list processes; kill -9 1234",
+    "show me what restart does to nginx",
+    "delete the cache",
+    "install numpy",
+])
+def test_compound_or_mutating_requests_are_not_simple(task):
+    assert not is_simple_task(task)
+
+
+@pytest.mark.parametrize("command", [
+    "df -h",
+    "du -sh /tmp",
+    "ls -la /tmp | head -20",
+    "nvidia-smi",
+    "pip show numpy",
+    "grep -i error /var/log/syslog | tail -5",
+    "find /tmp -name '*.log'",
+    "find /usr/bin -executable -name 'py*'",
+    "sort -k3 -r data.txt",
+    "git status",
+])
+def test_read_only_commands(command):
+    assert is_read_only_command(command)
+
+
+@pytest.mark.parametrize("command", [
+    "docker rm -f $(docker ps -aq)",
+    "find . -name '*.pyc' -delete",
+    "find . -name '*.log' -exec truncate -s 0 {} +",
+    "rm -rf /tmp/*",
+    "ls /tmp && rm -rf /tmp/*",
+    "ps aux | sort -k3 -r | head -1; kill 1",
+    "echo hi > /etc/motd",
+    "pip install numpy",
+    "sort -o data.txt data.txt",
+    "sort -o/tmp/x a",
+    "sort --output=/tmp/x a",
+    "tree -o/tmp/x",
+    "git show --ext-diff",
+    "git diff --ext-diff HEAD~1",
+    "awk 'BEGIN { system(\"rm x\") }'",
+    "git branch -D main",
+    "env rm -rf /",
+    "",
+])
+def test_commands_that_write_or_chain_are_not_read_only(command):
+    assert not is_read_only_command(command)
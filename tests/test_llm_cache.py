@@ -0,0 +1,35 @@
+from pydantic import BaseModel
+
+from llm_cache import ResponseCache, normalize_prompt
+
+
+class Plan(BaseModel):
+    steps: list[str]
+
+
+def test_whitespace_is_normalised():
+    assert normalize_prompt("  install   numpy \n\n\tplease ") == "install numpy\nplease"
+
+
+def test_case_and_punctuation_are_kept():
+    assert normalize_prompt("cat Foo.py") != normalize_prompt("cat foo.py")
+    assert normalize_prompt("ls Docs") != normalize_prompt("ls docs")
+    assert normalize_prompt("run it.") != normalize_prompt("run it")
+
+
+def test_entries_are_keyed_on_model_and_prompt(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    cache.put("planning", "gpt-4o", "cat Foo.py", Plan(steps=["cat Foo.py"]))
+
+    assert cache.get("planning", "gpt-4o", "cat  Foo.py ", Plan) == Plan(steps=["cat Foo.py"])
+    assert cache.get("planning", "gpt-4o", "cat foo.py", Plan) is None
+    assert cache.get("planning", "mistral-large-latest", "cat Foo.py", Plan) is None
+
+
+def test_failed_calls_are_not_stored(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    cache.put("planning", None, "cat Foo.py", None)
+    cache.put("planning", "gpt-4o", "cat Foo.py", None)
+
+    assert cache.get("planning", "gpt-4o", "cat Foo.py", Plan) is None
+    assert cache.get_stats()["entries"] == 0
@@ -0,0 +1,52 @@
+from output_compressor import compress_output
+
+PACKAGES = [f"{name}{suffix}" for suffix in ("", "-core", "-utils", "-extras") for name in (
+    "numpy", "scipy", "pandas", "requests", "urllib3", "idna", "certifi", "jinja", "markupsafe", "click",
+    "flask", "django", "attrs", "pyyaml", "tornado", "pygments", "jedi", "parso", "six", "wcwidth",
+)]
+
+
+def stdout(lines):
+    return [("stdout", line) for line in lines]
+
+
+def test_requirement_already_satisfied_run_collapses():
+    lines = [
+        f"Requirement already satisfied: {package} in /usr/lib/python3/site-packages (from app) ({i % 7}.{i % 13}.0)"
+        for i in range(4000) for package in [PACKAGES[i % len(PACKAGES)]]
+    ]
+    compressed = compress_output(stdout(lines))
+    assert len(compressed.entries) == 7
+    assert "3994 more lines like these omitted (lines 4-3997)" in compressed.text
+    assert compressed.ratio > 100
+
+
+def test_collecting_and_downloading_run_collapses():
+    lines = []
+    for package in PACKAGES:
+        lines += [
+            f"Collecting {package} (from app)",
+            f"  Downloading {package}-1.0-py3-none-any.whl (120 kB)",
+            "     ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━ 120.0/120.0 kB 8.1 MB/s eta 0:00:00",
+        ]
+    lines += ["Installing collected packages: " + ", ".join(PACKAGES), "Successfully installed " + " ".join(PACKAGES)]
+    compressed = compress_output(stdout(lines))
+    texts = [entry.text for entry in compressed.entries]
+    assert texts[0] == "Collecting numpy (from app)"
+    assert texts[-2:] == lines[-2:]
+    assert len(texts) == 8
+    assert texts[3] == f"[... {len(lines) - 7} more lines like these omitted (lines 4-{len(lines) - 4}) ...]"
+
+
+def test_errors_in_a_run_are_kept():
+    lines = [f"Collecting {package}" for package in PACKAGES]
+    lines.insert(40, "ERROR: Could not find a version that satisfies the requirement nosuchpackage")
+    compressed = compress_output(stdout(lines))
+    assert lines[40] in compressed.text
+    assert len(compressed.entries) < len(lines)
+
+
+def test_listings_are_not_collapsed():
+    lines = [f"-rw-r--r--  1 root root  {100 + i} Oct  4  2025 {package}.py" for i, package in enumerate(PACKAGES)]
+    lines += [f"lrwxrwxrwx  1 root root  {i} Jan  8  2023 {package} -> {package}-12" for i, package in enumerate(PACKAGES)]
+    assert compress_output(stdout(lines)).text == "\n".join(lines)
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import retry_policy
+from retry_policy import BREAKER_COOLDOWN, BREAKER_FAILURES, CircuitBreaker
+
+
+def half_open_breaker():
+    breaker = CircuitBreaker("test")
+    for _ in range(BREAKER_FAILURES):
+        breaker.record_failure()
+    breaker.opened_at -= BREAKER_COOLDOWN
+    assert breaker.state() == "half_open"
+    return breaker
+
+
+def test_callers_wait_out_a_slow_probe(monkeypatch):
+    monkeypatch.setattr(retry_policy, "BREAKER_PROBE_POLL", 0.01)
+    breaker = half_open_breaker()
+    order = []
+
+    async def caller(name, call_time):
+        assert await breaker.wait(time.monotonic() + 5)
+        order.append(name)
+        await asyncio.sleep(call_time)
+        breaker.record_success()
+
+    async def main():
+        # The probe takes far more polls than there are retries; the other caller still gets through after it
+        await asyncio.gather(caller("probe", 0.2), caller("waiter", 0))
+
+    asyncio.run(main())
+    assert order == ["probe", "waiter"]
+    assert breaker.state() == "closed"
+
+
+def test_waiting_gives_up_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(retry_policy, "BREAKER_PROBE_POLL", 0.01)
+    breaker = half_open_breaker()
+
+    async def main():
+        assert await breaker.wait(time.monotonic() + 5)     # Claims the probe, which never reports back
+        started = time.monotonic()
+        assert not await breaker.wait(time.monotonic() + 0.1)
+        return time.monotonic() - started
+
+    assert asyncio.run(main()) < 1
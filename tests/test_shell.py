@@ -0,0 +1,99 @@
+import asyncio
+
+import shell
+from shell import AsyncShell
+
+
+def run_in_shell(main):
+    async def wrapper():
+        sh = AsyncShell()
+        await sh.start()
+        try:
+            return await main(sh)
+        finally:
+            await sh.stop()
+
+    return asyncio.run(wrapper())
+
+
+def test_exit_codes_and_output():
+    async def main(sh):
+        ok = await sh.run("echo hello; echo oops >&2")
+        failed = await sh.run("false")
+        code = await sh.run("(exit 3)")
+        return ok, failed, code
+
+    ok, failed, code = run_in_shell(main)
+    assert ok.exit_code == 0 and ok.ok
+    assert sorted(ok.lines) == [("stderr", "oops"), ("stdout", "hello")]
+    assert failed.exit_code == 1 and not failed.ok
+    assert code.exit_code == 3
+
+
+def test_state_carries_over_between_commands():
+    async def main(sh):
+        await sh.run("cd /tmp && export MEGATRON_TEST=1")
+        return await sh.run("pwd; echo $MEGATRON_TEST")
+
+    assert run_in_shell(main).output == ["/tmp", "1"]
+
+
+def test_timeout_leaves_the_shell_usable(monkeypatch):
+    monkeypatch.setattr(shell, "CANCEL_GRACE", 0.5)
+
+    async def main(sh):
+        timed_out = await sh.run("echo before; sleep 30", timeout=0.5)
+        after = await sh.run("echo after")
+        return timed_out, after, sh.is_alive()
+
+    timed_out, after, alive = run_in_shell(main)
+    assert timed_out.cancelled == "timeout" and not timed_out.ok
+    assert timed_out.output == ["before"]
+    assert after.output == ["after"] and after.exit_code == 0
+    assert alive
+
+
+def test_cancel_leaves_the_shell_usable(monkeypatch):
+    monkeypatch.setattr(shell, "CANCEL_GRACE", 0.5)
+
+    async def main(sh):
+        await sh.run("cd /tmp")
+        task = asyncio.create_task(sh.run("sleep 30"))
+        await asyncio.sleep(0.3)
+        assert await sh.cancel(wait=5)
+        cancelled = await task
+        after = await sh.run("pwd")
+        return cancelled, after, await sh.cancel()
+
+    cancelled, after, nothing_to_cancel = run_in_shell(main)
+    assert cancelled.cancelled == "cancel"
+    assert after.output == ["/tmp"]
+    assert not nothing_to_cancel
+
+
+def test_background_jobs_are_left_alone(monkeypatch):
+    monkeypatch.setattr(shell, "CANCEL_GRACE", 0.5)
+
+    async def main(sh):
+        await sh.run("sleep 30 &")
+        await sh.run("sleep 30", timeout=0.3)
+        return await sh.run("jobs -r | wc -l; kill %1")
+
+    assert run_in_shell(main).output[0] == "1"
+
+
+def test_abandoned_output_is_not_credited_to_the_next_command():
+    async def main(sh):
+        task = asyncio.create_task(sh.run("sleep 0.5; echo late"))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        async for line in sh.stream("for i in 1 2 3; do echo line$i; sleep 0.2; done"):
+            break
+        return await sh.run("echo next")
+
+    assert run_in_shell(main).output == ["next"]
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+import pytest
+
+from llm_scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from task_queue import TaskQueue, TaskQueueFull
+
+
+def test_global_and_per_user_caps():
+    queue = TaskQueue(max_running=3, max_per_user=2)
+    tickets = [queue.submit(user) for user in ("a", "a", "a", "b", "c")]
+
+    assert [t.admitted.is_set() for t in tickets] == [True, True, False, True, False]
+    assert queue.num_running() == 3
+    # "c" has nothing running yet, so it waits ahead of "a"'s third task
+    assert [t.position for t in tickets] == [None, None, 2, None, 1]
+
+    # A freed slot goes to the user with fewer running tasks, even though "a" asked first
+    queue.release(tickets[3])
+    assert tickets[4].admitted.is_set() and not tickets[2].admitted.is_set()
+    assert queue.get_stats()["running_by_user"] == {"a": 2, "c": 1}
+
+
+def test_waiting_limit():
+    queue = TaskQueue(max_running=1, max_waiting=1)
+    queue.submit("a")
+    queue.submit("b")
+    with pytest.raises(TaskQueueFull):
+        queue.submit("c")
+    assert queue.get_stats()["rejected"] == 1
+
+
+def test_interactive_lane_goes_first():
+    queue = TaskQueue(max_running=1)
+    first = queue.submit("a")
+    background = queue.submit("b", PRIORITY_BACKGROUND)
+    interactive = queue.submit("c", PRIORITY_INTERACTIVE)
+    assert (interactive.position, background.position) == (1, 2)
+
+    queue.release(first)
+    assert interactive.admitted.is_set() and not background.admitted.is_set()
+
+
+def test_cancel_while_waiting():
+    async def main():
+        queue = TaskQueue(max_running=1)
+        queue.submit("a")
+        ticket = queue.submit("b")
+        waiter = asyncio.create_task(queue.wait(ticket))
+        await asyncio.sleep(0)
+        queue.cancel(ticket)
+        assert await waiter is False
+        assert queue.get_stats()["waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_position_callbacks(caplog):
+    async def main():
+        queue = TaskQueue(max_running=1)
+        first = queue.submit("a")
+        reported = []
+
+        async def report(position):
+            reported.append(position)
+
+        async def broken(position):
+            raise RuntimeError("message was deleted")
+
+        second, third, fourth = queue.submit("b"), queue.submit("c"), queue.submit("d")
+        third.on_position, fourth.on_position = broken, report
+        queue.release(first)
+        await asyncio.sleep(0)
+        queue.release(second)
+        await asyncio.sleep(0.01)
+        assert not queue.notifications
+        return reported
+
+    with caplog.at_level(logging.WARNING, logger="discord"):
+        assert asyncio.run(main()) == [2, 1]
+    assert "message was deleted" in caplog.text